@@ -1,8 +1,12 @@
 #!/usr/bin/env python3
 
-import argparse, bz2, gzip, lzma, re
+import argparse, itertools, os, re, sys, time
+from concurrent.futures import ProcessPoolExecutor
 from enum import Enum
 
+import magicopen
+from glyphstore import BITREV, write_store
+
 class ParseState(Enum):
     NONE=0
     SKIPCHAR=1
@@ -10,102 +14,167 @@ class ParseState(Enum):
     BITMAP=3
 
 class Char():
-    def expected_len(self):
-        return self.width * 4
+    """A glyph being parsed. The bitmap rows are decoded straight into a
+    preallocated buffer rather than accumulated as a string."""
+    def __init__(self, *, height, width):
+        self.height = height
+        self.width = width
+        # One buffer per glyph width, reused for every glyph of that width.
+        self.buffers = {
+            "single": bytearray(height * ((width + 7) // 8)),
+            "double": bytearray(height * ((width * 2 + 7) // 8)),
+        }
+
+    def start(self):
+        self.code = None
+        self.type = None
+
+    def set_bbx(self, w, h):
+        if h != self.height:
+            raise Exception("Bad char height {}".format(h))
+        if w == self.width:
+            self.type = "single"
+        elif w == self.width * 2:
+            self.type = "double"
+        else:
+            raise Exception("Bad char width {}".format(w))
+        self.data = self.buffers[self.type]
+
+    def read_bitmap(self, rows):
+        hexdata = "".join([row.strip() for row in rows])
+        if len(hexdata) != len(self.data) * 2:
+            raise Exception("Bad char length {}".format(len(hexdata)))
+        self.data[:] = bytes.fromhex(hexdata)
 
     def output(self, f):
         if self.code >= 65536:
-            f.write("%06X" % self.code)
+            f.write("%06X:%s\n" % (self.code, self.data.hex().upper()))
         else:
-            f.write("%04X" % self.code)
-        f.write(":")
-        f.write(self.data)
-        f.write("\n")
+            f.write("%04X:%s\n" % (self.code, self.data.hex().upper()))
 
-def parse_bdf(f, of, *, height=16, width=8):
-    char = None
+def parse_bdf(f, emit, *, height=16, width=8):
+    """Parse the BDF font in f, calling emit with each glyph in turn. The
+    glyph's buffer is reused for the next one. Returns the number of glyphs
+    emitted."""
+    char = Char(height=height, width=width)
     state = ParseState.NONE
-    for line in f:
-        words = line.rstrip().split(" ")
+    count = 0
+    lines = iter(f)
+    for line in lines:
         if state == ParseState.NONE:
-            if words[0] == "STARTCHAR":
-                char = Char()
+            if line.startswith("STARTCHAR"):
+                char.start()
                 state = ParseState.CHAR
         elif state == ParseState.CHAR:
-            if words[0] == "ENCODING":
-                char.code = int(words[1])
-                print(char.code, end="\r")
-            elif words[0] == "BBX":
-                char.width = int(words[1])
-                char.height = int(words[2])
-                if char.height != height:
-                    raise Exception("Bad char height {}", char.height)
-                if char.width == width:
-                    char.type = "single"
-                elif char.width == width * 2:
-                    char.type = "double"
-                else:
-                    raise Exception("Bad char width {}", width)
-            elif words[0] == "BITMAP":
+            if line.startswith("ENCODING"):
+                char.code = int(line.split()[1])
+                # unencoded glyphs have nowhere to go in the charmap
+                if char.code < 0:
+                    state = ParseState.SKIPCHAR
+            elif line.startswith("BBX"):
+                words = line.split()
+                char.set_bbx(int(words[1]), int(words[2]))
+            elif line.startswith("BITMAP"):
+                if char.type is None:
+                    raise Exception("No BBX for char {}".format(char.code))
+                # the bitmap is always exactly one line per pixel row
+                char.read_bitmap(itertools.islice(lines, height))
                 state = ParseState.BITMAP
-                char.data = ""
         elif state == ParseState.BITMAP:
-            if words[0] == "ENDCHAR":
-                if len(char.data) != char.expected_len():
-                    raise Exception("Bad char length {}", len(char.data))
-                char.output(of)
-                state = ParseState.NONE
-            else:
-                char.data += line.rstrip()
-
+            if not line.startswith("ENDCHAR"):
+                raise Exception("Bad char length for char {}".format(char.code))
+            emit(char)
+            count += 1
+            state = ParseState.NONE
         elif state == ParseState.SKIPCHAR:
-            if words[0] == "ENDCHAR":
+            if line.startswith("ENDCHAR"):
                 state = ParseState.NONE
+    return count
+
+def output_name(fn):
+    """Map input.bdf[.gz|.bz2|.xz] to input.hex with the same compression."""
+    ft = magicopen.filetype(fn)
+    if ft == "":
+        return re.sub(r"(\.bdf)?$", ".hex", fn, count=1)
+    ext = fn[fn.rindex("."):]
+    return re.sub(r"(\.bdf)?" + re.escape(ext) + "$", ".hex" + ext, fn, count=1)
+
+def store_name(fn):
+    """Map input.bdf[.gz|.bz2|.xz] to input.glyphs. Glyph stores are never
+    compressed, so that they can be mapped."""
+    if magicopen.filetype(fn) != "":
+        fn = fn[:fn.rindex(".")]
+    return re.sub(r"(\.bdf)?$", ".glyphs", fn, count=1)
 
+def convert_file(fn, *, height, width, store=False):
+    """Convert one (optionally compressed) BDF file, streaming it from disk to
+    disk, or collecting it into a glyph store. Returns (output filename,
+    glyph count, seconds taken)."""
+    start = time.perf_counter()
+    if store:
+        ofn = store_name(fn)
+        glyphs = {}
+        def add(char):
+            # the first glyph for a codepoint wins, as in build_font.py
+            glyphs.setdefault(char.code, (char.type, char.data.translate(BITREV)))
+        with magicopen.magic_open(fn, "rt") as f:
+            count = parse_bdf(f, add, width=width, height=height)
+        with open(ofn, "wb") as of:
+            write_store(of, glyphs, height=height, width=width)
+    else:
+        ofn = output_name(fn)
+        with magicopen.magic_open(fn, "rt") as f, magicopen.magic_open(ofn, "wt") as of:
+            count = parse_bdf(f, lambda char: char.output(of), width=width, height=height)
+    return ofn, count, time.perf_counter() - start
 
+def report(name, count, seconds):
+    rate = count / seconds if seconds > 0 else 0
+    print(f"{name}: {count} glyphs in {seconds:.2f}s ({rate:.0f} glyphs/s)",
+          file=sys.stderr)
 
-# read a BDF file (optionally compressed) and output a .hex file
+# read BDF files (optionally compressed) and output .hex files
 # in unifont's .hex format.
 def main():
     a = argparse.ArgumentParser(
             description="Convert a BDF file with monospace characters to unifont HEX format. " +
             "The font should have all characters be the same height, and a consistent single " +
             "or double width.",
-            epilog="The files can be plain, or in gz, bz2, or xz compressed format")
+            epilog="The files can be plain, or in gz, bz2, or xz compressed format. " +
+            "Output files are compressed the same way as their inputs.")
     a.add_argument("files", metavar="input.bdf", nargs="*",
             help="BDF files to process")
     a.add_argument("--height", type=int, default=16,
             help="font height")
     a.add_argument("--width", type=int, default=8,
             help="basic width of font")
+    a.add_argument("-j", "--jobs", type=int, default=os.cpu_count(),
+            help="number of files to convert in parallel (default: number of CPUs)")
+    a.add_argument("--store", action="store_true",
+            help="write a binary glyph store, input.glyphs, instead of .hex")
     options = a.parse_args()
 
     if len(options.files) == 0:
-        f = sys.stdin
-        of = sys.stdout
-    else:
-        for fn in options.files:
-            if fn[-3:] == ".gz":
-                # use gzip
-                ofn = re.sub("(\.bdf)?.gz$", ".hex.gz", fn, count=1)
-                f = gzip.open(fn, "r")
-                of = gzip.open(ofn, "w")
-            elif fn[-4:] == ".bz2":
-                # use bz2
-                ofn = re.sub("(\.bdf)?.bz2", ".hex.bz2", fn, count=1)
-                f = bzip2.open(fn, "r")
-                of = bzip2.open(ofn, "w")
-            elif fn[-3:] == ".xz":
-                # use lzma
-                ofn = re.sub("(\.bdf)?.xz", ".hex.xz", fn, count=1)
-                f = lzma.open(fn, "r")
-                of = lzma.open(ofn, "w")
-            else:
-                ofn = re.sub('(\.bdf)?$', '.hex', fn, count=1)
-                f = open(fn, "r")
-                of = open(ofn, "w")
-
-    parse_bdf(f, of, width=options.width, height=options.height)
+        start = time.perf_counter()
+        if options.store:
+            a.error("--store needs input files")
+        count = parse_bdf(sys.stdin, lambda char: char.output(sys.stdout),
+                          width=options.width, height=options.height)
+        report("<stdin>", count, time.perf_counter() - start)
+        return
+
+    start = time.perf_counter()
+    total = 0
+    jobs = max(1, min(options.jobs or 1, len(options.files)))
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        futures = [pool.submit(convert_file, fn, height=options.height, width=options.width,
+                               store=options.store)
+                   for fn in options.files]
+        for future in futures:
+            ofn, count, seconds = future.result()
+            report(ofn, count, seconds)
+            total += count
+    if len(options.files) > 1:
+        report("total", total, time.perf_counter() - start)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,275 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for the font tooling. Generates Unifont-sized synthetic fonts,
+runs each stage of the pipeline on them, and records wall time, peak RSS and
+glyphs per second to a JSON history. Exits with an error if any stage got
+slower or bigger than the previous runs by more than the threshold.
+
+Each stage runs in a freshly spawned worker process, so that its peak RSS
+is its own, not inherited from this one.
+"""
+import argparse, concurrent.futures, contextlib, gzip, json, lzma, multiprocessing
+import os, pathlib, random, resource, statistics, subprocess, sys, tempfile, time
+
+import bdf2hex, build_font, pack_data
+from blocks import *
+from glyphstore import GlyphStore
+
+# Codepoints that get double-wide glyphs in the synthetic fonts, roughly
+# where Unifont has them.
+DOUBLE_RANGES = [(0x2e80, 0xa4d0), (0xac00, 0xd7a4), (0xf900, 0xfb00), (0xff01, 0xff61)]
+
+def is_double(code):
+    return any(start <= code < end for start, end in DOUBLE_RANGES)
+
+def synthetic_glyphs(count, seed):
+    """Yields (codepoint, bitmap) for count glyphs of plane 0, with random
+    bitmaps that have some empty rows, like real glyphs do."""
+    rng = random.Random(seed)
+    codes = [code for code in range(0x20, 0x10000) if not 0xd800 <= code < 0xe000]
+    for code in codes[:count]:
+        width = 2 if is_double(code) else 1
+        rows = []
+        for row in range(16):
+            if rng.random() < 0.3:
+                rows.append(bytes(width))
+            else:
+                rows.append(rng.randbytes(width))
+        yield code, b"".join(rows)
+
+def write_bdf(f, glyphs):
+    f.write("STARTFONT 2.1\nFONT -synthetic-bench\nSIZE 16 75 75\n"
+            f"FONTBOUNDINGBOX 16 16 0 -2\nCHARS {len(glyphs)}\n")
+    for code, data in glyphs:
+        width = len(data) // 2
+        f.write(f"STARTCHAR U+{code:04X}\nENCODING {code}\nSWIDTH 500 0\n"
+                f"DWIDTH {width} 0\nBBX {width} 16 0 -2\nBITMAP\n")
+        step = len(data) // 16
+        for i in range(0, len(data), step):
+            f.write(data[i:i + step].hex().upper() + "\n")
+        f.write("ENDCHAR\n")
+    f.write("ENDFONT\n")
+
+def write_hex(f, glyphs):
+    for code, data in glyphs:
+        f.write(f"{code:04X}:{data.hex().upper()}\n")
+
+def generate(workdir, count, seed):
+    """Write the synthetic fonts, plain and compressed."""
+    glyphs = list(synthetic_glyphs(count, seed))
+    for name, opener in [("bench.bdf", open), ("bench.bdf.gz", gzip.open)]:
+        with opener(workdir / name, "wt") as f:
+            write_bdf(f, glyphs)
+    for name, opener in [("synthetic.hex", open), ("synthetic.hex.xz", lzma.open)]:
+        with opener(workdir / name, "wt") as f:
+            write_hex(f, glyphs)
+    return len(glyphs)
+
+# The stages. Each takes the working directory and returns the number of
+# glyphs it processed.
+
+def stage_parse(workdir):
+    with open(workdir / "bench.bdf") as f:
+        return bdf2hex.parse_bdf(f, lambda char: None)
+
+def stage_convert(workdir):
+    ofn, count, seconds = bdf2hex.convert_file(str(workdir / "bench.bdf"), height=16, width=8)
+    return count
+
+def stage_convert_gz(workdir):
+    ofn, count, seconds = bdf2hex.convert_file(str(workdir / "bench.bdf.gz"), height=16, width=8)
+    return count
+
+def stage_store(workdir):
+    ofn, count, seconds = bdf2hex.convert_file(str(workdir / "bench.bdf"), height=16, width=8,
+                                               store=True)
+    return count
+
+def stage_read_hex(workdir):
+    chars = {}
+    with open(workdir / "synthetic.hex") as f:
+        build_font.read_hex(chars, CHARS_FULL, f)
+    return len(chars)
+
+def stage_read_hex_xz(workdir):
+    chars = {}
+    with lzma.open(workdir / "synthetic.hex.xz", "rt") as f:
+        build_font.read_hex(chars, CHARS_FULL, f)
+    return len(chars)
+
+def stage_map_store(workdir):
+    return len(build_font.store_chars(GlyphStore(workdir / "bench.glyphs"), CHARS_FULL))
+
+def stage_blobs(workdir):
+    chars = build_font.store_chars(GlyphStore(workdir / "bench.glyphs"), CHARS_FULL)
+    builddir = workdir / "build"
+    builddir.mkdir(exist_ok=True)
+    build_font.build_variant(builddir, "full", CHARS_FULL, chars)
+    return len(chars)
+
+def stage_blobs_compressed(workdir):
+    chars = build_font.store_chars(GlyphStore(workdir / "bench.glyphs"), CHARS_FULL)
+    builddir = workdir / "build-compressed"
+    builddir.mkdir(exist_ok=True)
+    build_font.build_variant(builddir, "full", CHARS_FULL, chars, compress=True)
+    return len(chars)
+
+def pack(workdir):
+    builddir = workdir / "build"
+    flash_start = pack_data.FLASH_START["upduino"]
+    layout = pack_data.FlashLayout(flash_start, 4 << 20)
+    config = pack_data.gather_files(builddir, pack_data.ITEMS_FULL, "full", layout)
+    pack_data.write_config(builddir, "full", config)
+    return builddir, config, flash_start
+
+def glyph_count(builddir):
+    return sum((builddir / f"font{n}-full.bin").stat().st_size // (16 * n) for n in (1, 2))
+
+def stage_pack(workdir):
+    builddir, config, flash_start = pack(workdir)
+    return glyph_count(builddir)
+
+def stage_image(workdir):
+    builddir, config, flash_start = pack(workdir)
+    pack_data.write_uniblob(builddir, "full", config, flash_start, 4 << 20)
+    return glyph_count(builddir)
+
+STAGES = {
+    "parse bdf": stage_parse,
+    "convert bdf": stage_convert,
+    "convert bdf.gz": stage_convert_gz,
+    "convert to store": stage_store,
+    "read hex": stage_read_hex,
+    "read hex.xz": stage_read_hex_xz,
+    "map store": stage_map_store,
+    "write blobs": stage_blobs,
+    "write compressed blobs": stage_blobs_compressed,
+    "pack": stage_pack,
+    "write image": stage_image,
+}
+
+def run_stage(name, workdir):
+    """Runs in the worker process. Returns (glyphs, seconds, peak RSS in KB)."""
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull), \
+         contextlib.redirect_stderr(devnull):
+        start = time.perf_counter()
+        glyphs = STAGES[name](workdir)
+        seconds = time.perf_counter() - start
+    return glyphs, seconds, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def measure(name, workdir, repeat):
+    """Best of repeat runs, each in a new process. The time and peak RSS are
+    those of the fastest run, and runs has both for every run."""
+    best = None
+    runs = []
+    # a forked worker would start out with this process's peak RSS
+    context = multiprocessing.get_context("spawn")
+    for i in range(repeat):
+        with concurrent.futures.ProcessPoolExecutor(1, mp_context=context) as pool:
+            glyphs, seconds, rss = pool.submit(run_stage, name, workdir).result()
+        runs.append({"seconds": seconds, "peak_rss_kb": rss})
+        if best is None or seconds < best["seconds"]:
+            best = {"seconds": seconds, "peak_rss_kb": rss,
+                    "glyphs_per_s": glyphs / seconds if seconds else 0, "glyphs": glyphs}
+    best["runs"] = runs
+    return best
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+# Differences smaller than these are noise, whatever the threshold.
+MIN_DELTA = {"seconds": 0.005, "peak_rss_kb": 1024}
+
+def regressions(results, history, threshold, window):
+    """Compare against the median of the last window runs with the same
+    parameters. Returns a list of messages."""
+    problems = []
+    for name, result in results.items():
+        past = [run["stages"][name] for run in history[-window:] if name in run["stages"]]
+        if not past:
+            continue
+        for metric in ("seconds", "peak_rss_kb"):
+            baseline = statistics.median(p[metric] for p in past)
+            if (result[metric] > baseline * (1 + threshold) and
+                result[metric] - baseline > MIN_DELTA[metric]):
+                problems.append(f"{name}: {metric} {result[metric]:.4g} vs {baseline:.4g} "
+                                f"(+{result[metric] / baseline - 1:.0%})")
+    return problems
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the font tools on synthetic Unifont-sized fonts")
+    parser.add_argument("-n", "--glyphs", type=int, default=60000,
+        help="number of glyphs in the synthetic fonts (default: 60000)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("-r", "--repeat", type=int, default=3,
+        help="runs per stage, the fastest counts (default: 3)")
+    parser.add_argument("-t", "--threshold", type=float, default=0.25,
+        help="fail if a stage is this much slower or bigger than the median of "
+        "previous runs (default: 0.25)")
+    parser.add_argument("-w", "--window", type=int, default=5,
+        help="number of previous runs to compare against (default: 5)")
+    parser.add_argument("--history", type=pathlib.Path,
+        default=pathlib.Path("build/bench-history.json"))
+    parser.add_argument("--no-record", action="store_true",
+        help="don't add this run to the history")
+    parser.add_argument("stages", nargs="*", metavar="stage",
+        help=f"stages to run (default: all): {', '.join(STAGES)}")
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    for name in args.stages:
+        if name not in STAGES:
+            sys.exit(f"unknown stage {name}")
+    stages = args.stages or list(STAGES)
+
+    try:
+        history = json.loads(args.history.read_text())
+    except FileNotFoundError:
+        history = []
+    params = {"glyphs": args.glyphs, "seed": args.seed}
+    comparable = [run for run in history if run["params"] == params]
+
+    results = {}
+    with tempfile.TemporaryDirectory(prefix="fontbench") as workdir:
+        workdir = pathlib.Path(workdir)
+        start = time.perf_counter()
+        count = generate(workdir, args.glyphs, args.seed)
+        print(f"generated {count} glyphs in {time.perf_counter() - start:.2f}s")
+        # later stages work from the outputs of the conversions
+        for name in ["convert bdf", "convert to store"]:
+            if name not in stages:
+                measure(name, workdir, 1)
+        if "pack" in stages or "write image" in stages:
+            if "write blobs" not in stages:
+                measure("write blobs", workdir, 1)
+        for name in STAGES:
+            if name not in stages:
+                continue
+            results[name] = result = measure(name, workdir, args.repeat)
+            print(f"{name:24} {result['seconds'] * 1000:9.1f} ms {result['peak_rss_kb'] / 1024:7.1f} MB "
+                  f"{result['glyphs_per_s']:11.0f} glyphs/s")
+            if len(result["runs"]) > 1:
+                print(" " * 24 + "  all runs: " + ", ".join(
+                    f"{run['seconds'] * 1000:.1f} ms {run['peak_rss_kb'] / 1024:.1f} MB"
+                    for run in result["runs"]))
+
+    problems = regressions(results, comparable, args.threshold, args.window)
+    if not args.no_record:
+        history.append({"time": time.strftime("%Y-%m-%dT%H:%M:%S"), "revision": git_revision(),
+                        "params": params, "stages": results})
+        args.history.parent.mkdir(parents=True, exist_ok=True)
+        args.history.write_text(json.dumps(history, indent=1))
+    if problems:
+        print("regressions:")
+        for problem in problems:
+            print(f" {problem}")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
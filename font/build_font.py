@@ -1,9 +1,17 @@
 #!/usr/bin/env python3
-import os, pathlib, struct, sys
+import argparse, array, collections, hashlib, itertools, json, os, pathlib, sys
 
 from blocks import *
+from charmapformat import *
+from glyphstore import BITREV, GlyphStore, write_store
+from pack_data import FLASH_START, layout_fits
 import magicopen
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 """
 Build the font binaries to be flashed. The binaries are output to the build/
 directory. There are two variants: a reduced character set for parts with 1M
@@ -14,106 +22,766 @@ Each variant produces 3 files:
 * font2-$variant.bin for double-wide characters
 * charmap-$variant.bin as a character map, mapping unicode codepoints to
   indices into the above files.
+The full variant also gets the emoji read from .chx files, see below:
+* fonte-$variant.bin with the emoji bitmaps
+* epal-$variant.bin with their palettes
+
+The charmap covers all 17 planes as a two-level table. It starts with a page
+directory of CHARMAP_PAGES 16-bit page numbers, one per 256 codepoints,
+followed at CHARMAP_PAGES_OFFSET by the pages themselves, each 256 16-bit
+glyph indices. Identical pages are stored once, and page 0 is always the
+all-empty page, see charmapformat.py. The gateware looks up a codepoint
+with two reads, see gateware/charmap.py.
+
+With --compress, the glyph blobs store each glyph as a 16-bit little-endian
+row mask, bit r set if pixel row r has any pixels set, followed by only the
+non-empty rows. Glyphs are grouped into pools by their number of non-empty
+rows, so that within a pool every glyph has the same size, and glyph indices
+are assigned pool by pool. A glyph is then found at
+pool offset + (index - pool first index) * pool stride. Glyphs with no rows
+set take no space at all, and those with every row set are stored without
+the mask. The pools are listed in fontpools-$variant.json for pack_data.py
+to pass on to the gateware, see gateware/rowfiller.py.
+
+Emoji are 16x16 pixels, each pixel an index into a palette of 4 or 16 of
+the 256 terminal colors, depending on how many colors the emoji uses. Their
+glyph indices start at EMOJI_FIRST, 2 bit per pixel emoji first. fonte holds
+their bitmaps, 64 or 128 bytes each, with the leftmost pixel of each byte in
+its low bits. epal starts with the 16-bit numbers of 2bpp and of 4bpp emoji,
+followed by the 16-bit offset into epal of each emoji's palette, then the
+palettes themselves, 4 or 16 bytes each, shared between emoji.
 """
-class Char():
-    def __init__(self, code, hexdata):
-        if len(hexdata) == 32:
-            self.type = "single"
-        elif len(hexdata) == 64:
-            self.type = "double"
-        else:
-            raise Exception("Bad character length %d" % len(hexdata))
+# Bitmaps are flashed bit-reversed, see glyphstore.BITREV.
+if np is not None:
+    BITREV_NP = np.frombuffer(BITREV, dtype=np.uint8)
 
-        self.data = bytearray() 
-        if self.type == "single":
-            for i in range(0, len(hexdata), 2):
-                self.data.append(int('{:08b}'.format(int(hexdata[i:i+2], 16))[::-1],2))
-        else:
-            for i in range(0, len(hexdata), 4):
-                datum = int('{:016b}'.format(int(hexdata[i:i+4], 16))[::-1], 2)
-                self.data.append(datum & 0xff)
-                self.data.append(datum >> 8)
+# .hex data length -> (glyph type, bytes per glyph)
+GLYPH_TYPES = {32: ("single", 16), 64: ("double", 32)}
+
+# Compressed glyph rows, see above.
+GLYPH_ROWS = 16
+
+# A blob with no glyphs in it still gets one blank glyph, which nothing
+# points at, so that every blob has a place in flash.
+BLANK_GLYPH = {chartype: size for chartype, size in GLYPH_TYPES.values()}
 
+def blob_size(size, chartype):
+    """The size of a blob of chartype glyphs taking size bytes."""
+    return size or BLANK_GLYPH[chartype]
+
+# Glyph indices from here on are emoji. Those below are double-wide from
+# 16384, and 0xffff means no glyph.
+EMOJI_FIRST = 0xF000
+EMOJI_SIZE = 16
+
+class Char():
+    def __init__(self, code, type, data):
         self.code = code
+        self.type = type
+        self.data = data
+
+class EmojiChar(Char):
+    """A palette-indexed emoji. data holds the packed pixels, bpp bits each,
+    and palette the 1 << bpp colors they index."""
+    def __init__(self, code, bpp, palette, data):
+        super().__init__(code, "emoji", data)
+        self.bpp = bpp
+        self.palette = palette
+
+def parse_emoji(line):
+    """Parse a .chx line, CODE:PALETTE:PIXELS, where PALETTE is up to 16 hex
+    color numbers of 2 digits and PIXELS 256 hex digits, each a pixel's index
+    into the palette, left to right and top to bottom. The palette is reduced
+    to the colors used, in ascending order so that emoji using the same
+    colors share it, and the pixels are packed at 2 bits if that is enough."""
+    hexcode, palette, pixels = line.strip().split(":")
+    code = int(hexcode, 16)
+    palette = bytes.fromhex(palette)
+    if len(pixels) != EMOJI_SIZE * EMOJI_SIZE:
+        raise Exception(f"Bad emoji length {len(pixels)} for {hexcode}")
+    pixels = [int(pixel, 16) for pixel in pixels]
+    if max(pixels) >= len(palette):
+        raise Exception(f"Emoji {hexcode} uses colors beyond its palette")
+    colors = sorted({palette[pixel] for pixel in pixels})
+    bpp = 2 if len(colors) <= 4 else 4
+    index = {color: i for i, color in enumerate(colors)}
+    perbyte = 8 // bpp
+    data = bytearray()
+    for i in range(0, len(pixels), perbyte):
+        byte = 0
+        # pixels are shifted out LSB first, like the other glyphs' bits
+        for j, pixel in enumerate(pixels[i:i + perbyte]):
+            byte |= index[palette[pixel]] << (j * bpp)
+        data.append(byte)
+    palette = bytes(colors) + bytes((1 << bpp) - len(colors))
+    return EmojiChar(code, bpp, palette, bytes(data))
+
+def read_chx(chars, charset, infile):
+    for line in infile:
+        if not line.strip():
+            continue
+        char = parse_emoji(line)
+        if char.code in charset:
+            chars.setdefault(char.code, char)
+
+def decode_glyphs(hexdata):
+    """Decode a list of equal-length hex bitmaps into one bit-reversed buffer.
+    Double-wide rows come out as left byte then right byte, the same as
+    reversing each 16-bit row and storing it little-endian."""
+    raw = bytes.fromhex("".join(hexdata))
+    if np is None:
+        return raw.translate(BITREV)
+    return BITREV_NP[np.frombuffer(raw, dtype=np.uint8)].tobytes()
 
 def read_hex(chars, charset, infile):
+    # Collect the wanted glyphs per width, then convert each width in one batch.
+    pending = {hexlen: ([], []) for hexlen in GLYPH_TYPES}
+    seen = set()
     ctr = 0
     for line in infile:
         (hexcode, data) = line.rstrip().split(":")
         charnum = int(hexcode, 16)
-        if charnum in charset and charnum not in chars:
-            chars[charnum] = Char(charnum, data)
+        if charnum in charset and charnum not in chars and charnum not in seen:
+            if len(data) not in pending:
+                raise Exception("Bad character length %d" % len(data))
+            codes, hexdata = pending[len(data)]
+            codes.append(charnum)
+            hexdata.append(data)
+            seen.add(charnum)
         ctr = ctr + 1
         if ctr % 100 == 0:
             print(ctr, end="\r")
+    for hexlen, (codes, hexdata) in pending.items():
+        chartype, size = GLYPH_TYPES[hexlen]
+        glyphs = memoryview(decode_glyphs(hexdata))
+        for i, code in enumerate(codes):
+            chars[code] = Char(code, chartype, glyphs[i * size:(i + 1) * size])
 
-def write_blobs(chars, charset, *, singlefile, doublefile, charmapfile):
-    single_idx = double_idx = emoji_idx = 0
-    charmap = [0xffff] * 65536
-    # TODO: deduplicate images
-    for chnum in charset:
-        if chnum not in chars: continue
+def compress_glyph(data):
+    """Returns the number of non-empty rows of a glyph and its compressed
+    form."""
+    stride = len(data) // GLYPH_ROWS
+    rows = [data[i:i + stride] for i in range(0, len(data), stride)]
+    mask = 0
+    for i, row in enumerate(rows):
+        if any(row):
+            mask |= 1 << i
+    nrows = bin(mask).count("1")
+    if nrows == 0:
+        return 0, b""
+    if nrows == GLYPH_ROWS:
+        return nrows, bytes(data)
+    return nrows, mask.to_bytes(2, "little") + b"".join(
+        row for i, row in enumerate(rows) if mask & (1 << i))
+
+def compress_pool(glyphs, first):
+    """Compress a list of glyphs, grouping them into pools by the number of
+    non-empty rows. Returns the compressed blob, a list of pools and the new
+    index of each glyph."""
+    compressed = [compress_glyph(data) for data in glyphs]
+    order = sorted(range(len(glyphs)), key=lambda i: compressed[i][0])
+    newidx = [0] * len(glyphs)
+    pools = []
+    blob = bytearray()
+    for i, old in enumerate(order):
+        nrows, data = compressed[old]
+        newidx[old] = i
+        if not pools or pools[-1]["rows"] != nrows:
+            pools.append({"first": first + i, "count": 0, "rows": nrows,
+                          "stride": len(data), "offset": len(blob)})
+        pools[-1]["count"] += 1
+        blob += data
+    return blob, pools, newidx
+
+def write_blobs(chars, charset, *, singlefile, doublefile, charmapfile, compress=False,
+                order=(), emoji_ids={}, identity=False):
+    """Write the glyph blobs and charmap for the codepoints of charset.
+    Identical bitmaps are stored once, in separate pools for singles and
+    doubles, with every codepoint that uses them pointing at the same index.
+    Glyph indices are assigned in codepoint order, except that the
+    codepoints listed in order come first. emoji_ids maps the codepoints of
+    the emoji, written by write_emoji(), to their glyph indices.
+    With identity set, the first IDENTITY_CODEPOINTS single-wide indices are
+    those codepoints' own, blank where they have no glyph, even if that
+    means storing a bitmap more than once, and they are never compressed.
+    Returns the chars whose bitmap was shared with an earlier one, and if
+    compress is set, the pools of the compressed blobs and the compressed
+    size of each glyph."""
+    charmap = array.array("H", [0xffff]) * CHARMAP_CODEPOINTS
+    for code, glyphid in emoji_ids.items():
+        charmap[code] = glyphid
+    # the bitmaps of each type in glyph index order, and the index of each
+    singles, seen_singles = [], {}
+    doubles, seen_doubles = [], {}
+    dupes = []
+    assigned = []
+    fixed = 0
+    if identity:
+        fixed = IDENTITY_CODEPOINTS
+        for code in range(fixed):
+            char = chars.get(code) if code in charset else None
+            if char is not None and char.type != 'single':
+                raise Exception(f"U+{code:04X} isn't single-wide, can't use --identity")
+            singles.append(bytes(GLYPH_ROWS) if char is None else char.data)
+            seen_singles.setdefault(singles[-1], code)
+            charmap[code] = code
+    order = [code for code in order if code in charset]
+    for chnum in itertools.chain(order, charset - order):
+        if chnum not in chars or chnum < fixed: continue
         char = chars[chnum]
         if char.type == 'single':
-            # write single
-            if single_idx >= 16384:
-                raise Exception("Too many single-wides!")
-            charmap[char.code] = single_idx
-            single_idx = single_idx + 1
-            singlefile.write(char.data)
+            pool, seen = singles, seen_singles
         elif char.type == 'double':
-            if double_idx >= 49151:
-                raise Exception("Too many double-wides!")
-            charmap[char.code] = double_idx + 16384
-            double_idx = double_idx + 1
-            doublefile.write(char.data)
+            pool, seen = doubles, seen_doubles
         else:
             raise Exception("Uknown character type")
-    # write charmap
-    for ch in charmap:
-        charmapfile.write(struct.pack('<H', ch))
+        idx = seen.setdefault(char.data, len(pool))
+        if idx == len(pool):
+            pool.append(char.data)
+        else:
+            dupes.append(char)
+        if len(singles) > 16384:
+            raise Exception("Too many single-wides!")
+        if len(doubles) + 16384 > EMOJI_FIRST:
+            raise Exception("Too many double-wides!")
+        assigned.append((char, idx))
+    if not compress:
+        singlefile.write(b"".join(singles) or bytes(BLANK_GLYPH["single"]))
+        doublefile.write(b"".join(doubles) or bytes(BLANK_GLYPH["double"]))
+        for char, idx in assigned:
+            charmap[char.code] = idx + (16384 if char.type == 'double' else 0)
+        write_charmap(charmapfile, charmap)
+        return dupes, None
+    single_blob, single_pools, single_idx = compress_pool(singles[fixed:], fixed)
+    double_blob, double_pools, double_idx = compress_pool(doubles, 16384)
+    if fixed:
+        # the identity glyphs go first, as they are, in a pool of full glyphs
+        single_pools = [{"first": 0, "count": fixed, "rows": GLYPH_ROWS,
+                         "stride": GLYPH_ROWS, "offset": 0},
+                        *({**pool, "offset": pool["offset"] + fixed * GLYPH_ROWS}
+                          for pool in single_pools)]
+        single_blob = b"".join(singles[:fixed]) + single_blob
+        single_idx = list(range(fixed)) + [fixed + idx for idx in single_idx]
+    for char, idx in assigned:
+        if char.type == 'single':
+            charmap[char.code] = single_idx[idx]
+        else:
+            charmap[char.code] = double_idx[idx] + 16384
+    singlefile.write(single_blob or bytes(BLANK_GLYPH["single"]))
+    doublefile.write(double_blob or bytes(BLANK_GLYPH["double"]))
+    write_charmap(charmapfile, charmap)
+    return dupes, {"font1": single_pools, "font2": double_pools}
 
-WARNING = "\e[1;31mWARNING\e[0m"
+def write_emoji(chars, *, emojifile, palettefile):
+    """Write the emoji blob and their palettes. Identical emoji are stored
+    once, and identical palettes once. Returns a dict mapping codepoints to
+    glyph indices, and the emoji written."""
+    emoji = {}
+    for code in CHARS_EMOJI:
+        char = chars.get(code)
+        if isinstance(char, EmojiChar):
+            emoji.setdefault((char.bpp, char.data, char.palette), []).append(code)
+    if len(emoji) > 0xffff - EMOJI_FIRST:
+        raise Exception("Too many emoji!")
+    # 2bpp emoji first, then 4bpp
+    glyphs = sorted(emoji, key=lambda glyph: glyph[0])
+    palettes = {}
+    pos = 4 + len(glyphs) * 2
+    offsets = array.array("H")
+    for bpp, data, palette in glyphs:
+        if palette not in palettes:
+            palettes[palette] = pos
+            pos += len(palette)
+        offsets.append(palettes[palette])
+    if pos > 0x10000:
+        raise Exception("Too many emoji palettes!")
+    counts = array.array("H", [sum(1 for glyph in glyphs if glyph[0] == bpp) for bpp in (2, 4)])
+    if sys.byteorder == "big":
+        counts.byteswap()
+        offsets.byteswap()
+    counts.tofile(palettefile)
+    offsets.tofile(palettefile)
+    palettefile.write(b"".join(palettes))
+    emojifile.write(b"".join(data for bpp, data, palette in glyphs))
+    ids = {code: EMOJI_FIRST + i for i, glyph in enumerate(glyphs) for code in emoji[glyph]}
+    return ids, [chars[emoji[glyph][0]] for glyph in glyphs]
 
-def main():
+def write_charmap(charmapfile, charmap):
+    """Write a flat array of glyph indices as a paged charmap."""
+    directory = array.array("H", [0]) * CHARMAP_PAGES
+    # all flash data is little-endian
+    if sys.byteorder == "big":
+        charmap = array.array("H", charmap)
+        charmap.byteswap()
+    empty = array.array("H", [0xffff]) * CHARMAP_PAGE_SIZE
+    pages = {empty.tobytes(): 0}
+    for i in range(CHARMAP_PAGES):
+        page = charmap[i * CHARMAP_PAGE_SIZE:(i + 1) * CHARMAP_PAGE_SIZE].tobytes()
+        directory[i] = pages.setdefault(page, len(pages))
+    if sys.byteorder == "big":
+        directory.byteswap()
+    directory.tofile(charmapfile)
+    charmapfile.write(b"".join(pages))
+
+def report_dedup(dupes):
+    saved = collections.Counter()
+    for char in dupes:
+        saved[block_name(char.code)] += len(char.data)
+    if not saved:
+        return
+    print(" bytes saved by deduplication:")
+    for name, nbytes in saved.most_common():
+        print(f"  {name}: {nbytes}")
+    print(f"  total: {sum(saved.values())} bytes, {len(dupes)} glyphs")
+
+# Pixel clocks in which a row of cells must be filled: 16 scanlines of 800
+# pixel clocks at 640x480, see gateware/flashreader.py.
+FILL_DEADLINE_CLOCKS = 16 * 800
+# Flash clocks per read transaction before the data, and per byte of data.
+READ_SETUP_CLOCKS = 21
+READ_BYTE_CLOCKS = 2
+
+def report_emoji(emoji):
+    """Print the emoji's sizes and what they cost per row fill, compared to
+    double-wide glyphs. An emoji takes three reads: its palette offset, the
+    palette and the bitmap."""
+    if not emoji:
+        return
+    palettes = {char.palette for char in emoji}
+    print(f" emoji: {len(emoji)} glyphs, {sum(len(char.data) for char in emoji)} bytes, "
+          f"{len(palettes)} palettes, {sum(len(p) for p in palettes)} bytes")
+    double = READ_SETUP_CLOCKS + 32 * READ_BYTE_CLOCKS
+    print(f"  double-wide: 32 bytes, {double} clocks per fill")
+    for bpp in (2, 4):
+        count = sum(1 for char in emoji if char.bpp == bpp)
+        nbytes = 2 + (1 << bpp) + EMOJI_SIZE * EMOJI_SIZE * bpp // 8
+        clocks = 3 * READ_SETUP_CLOCKS + nbytes * READ_BYTE_CLOCKS
+        row = 40 * clocks
+        print(f"  {bpp}bpp: {count} emoji, {nbytes} bytes, {clocks} clocks per fill "
+              f"({clocks / double:.1f}x a double-wide); a row of 40 takes {row} clocks, "
+              f"{row / FILL_DEADLINE_CLOCKS:.0%} of the fill deadline")
+
+def report_compression(chars, charset, pools):
+    """Print the compression ratio per block. Each distinct bitmap is counted
+    against the block of its first codepoint."""
+    raw = collections.Counter()
+    packed = collections.Counter()
+    seen = set()
+    for chnum in charset:
+        char = chars.get(chnum)
+        if char is None or char.data in seen:
+            continue
+        seen.add(char.data)
+        name = block_name(chnum)
+        raw[name] += len(char.data)
+        packed[name] += len(compress_glyph(char.data)[1])
+    print(" compression:")
+    for name in raw:
+        print(f"  {name}: {raw[name]} -> {packed[name]} bytes ({packed[name] / raw[name]:.0%})")
+    total_raw, total_packed = sum(raw.values()), sum(packed.values())
+    print(f"  total: {total_raw} -> {total_packed} bytes ({total_packed / total_raw:.0%})")
+    for font, fontpools in pools.items():
+        print(f"  {font}: {len(fontpools)} pools")
+
+def glyph_cost(char, compress=False):
+    """Bytes of flash a glyph takes, unless it duplicates another."""
+    if compress:
+        return len(compress_glyph(char.data)[1])
+    return len(char.data)
+
+def charmap_size(codes):
+    """Size of the paged charmap for the sorted codepoints, assuming no two
+    non-empty pages are identical."""
+    pages = {code // CHARMAP_PAGE_SIZE for code in codes}
+    return CHARMAP_PAGES_OFFSET + (1 + len(pages)) * CHARMAP_PAGE_SIZE * 2
+
+def predict_footprint(chars, charset, compress=False):
+    """Predict the sizes of a variant's blobs without building them. Returns
+    the bytes of singles and of doubles taken by each block, and the size of
+    the charmap."""
+    blocks = collections.defaultdict(collections.Counter)
+    seen = set()
+    present = [code for code in charset if code in chars]
+    for code in present:
+        char = chars[code]
+        if char.data in seen:
+            continue
+        seen.add(char.data)
+        blocks[block_name(code)][char.type] += glyph_cost(char, compress)
+    return blocks, charmap_size(present)
+
+def report_footprint(variant, blocks, charmap):
+    singles = blob_size(sum(sizes["single"] for sizes in blocks.values()), "single")
+    doubles = blob_size(sum(sizes["double"] for sizes in blocks.values()), "double")
+    print(f"{variant} predicted footprint:")
+    for name, sizes in sorted(blocks.items(), key=lambda b: -sum(b[1].values())):
+        print(f"  {name}: {sizes['single']} + {sizes['double']} bytes")
+    print(f" singles: {singles} bytes, doubles: {doubles} bytes, charmap: {charmap} bytes")
+    for platform, flash_start in FLASH_START.items():
+        fits = [size for size in (1, 2, 4, 8, 16)
+                if layout_fits([singles, doubles, charmap], flash_start, size << 20)]
+        where = f"{fits[0]}MB and up" if fits else "nothing"
+        print(f" fits {platform}: {where}")
+
+def read_corpus(paths):
+    """Count the codepoints of text files, optionally compressed."""
+    counts = collections.Counter()
+    for path in paths:
+        with magicopen.magic_open(path, "rt") as f:
+            for line in f:
+                counts.update(line)
+    # control characters don't take glyphs
+    return collections.Counter({ord(ch): n for ch, n in counts.items()
+                                if ord(ch) >= 0x20 and not 0x7f <= ord(ch) < 0xa0})
+
+def choose_subset(chars, counts, *, flash_start, flash_end, compress=False):
+    """Greedily pick the glyphs that cover the most of the corpus per byte of
+    flash, as long as the blobs still fit the flash range. Basic Latin is
+    always included."""
+    sizes = {"single": 0, "double": 0}
+    chosen = set()
+    pages = set()
+    seen = set()
+    def add(code, *, check):
+        char = chars[code]
+        cost = 0 if char.data in seen else glyph_cost(char, compress)
+        page = code // CHARMAP_PAGE_SIZE
+        new_pages = len(pages) + (page not in pages)
+        charmap = CHARMAP_PAGES_OFFSET + (1 + new_pages) * CHARMAP_PAGE_SIZE * 2
+        new_sizes = dict(sizes)
+        new_sizes[char.type] += cost
+        blobs = [blob_size(size, chartype) for chartype, size in new_sizes.items()]
+        if check and not layout_fits([*blobs, charmap], flash_start, flash_end):
+            return
+        sizes.update(new_sizes)
+        chosen.add(code)
+        pages.add(page)
+        seen.add(char.data)
+    for code in BLOCKS["Basic Latin"]:
+        if code in chars:
+            add(code, check=False)
+    candidates = [code for code in counts if code in chars and code not in chosen]
+    candidates.sort(key=lambda code: counts[code] / max(glyph_cost(chars[code], compress), 1),
+                    reverse=True)
+    for code in candidates:
+        add(code, check=True)
+    return Charset.coerce(chosen)
+
+def read_pairs(paths):
+    """Count the pairs of codepoints next to each other in text files, which
+    end up in adjacent cells on screen."""
+    pairs = collections.Counter()
+    for path in paths:
+        with magicopen.magic_open(path, "rt") as f:
+            for line in f:
+                line = line.rstrip("\n")
+                pairs.update(zip(map(ord, line), map(ord, line[1:])))
+    return pairs
+
+def usage_order(chars, pairs):
+    """Order codepoints so that those most often next to each other on
+    screen get adjacent glyph indices, which the row filler then reads from
+    consecutive flash addresses. The most frequent pairs are greedily linked
+    into chains, and the chains are ordered by how much they are used.
+    Space always comes first, as glyph 0 is what the terminal clears to."""
+    succ = {}
+    pred = {}
+    parent = {}
+    def find(code):
+        while parent.setdefault(code, code) != code:
+            parent[code] = parent[parent[code]]
+            code = parent[code]
+        return code
+    use = collections.Counter()
+    for (a, b), n in pairs.most_common():
+        if a == b or a not in chars or b not in chars:
+            continue
+        use[a] += n
+        use[b] += n
+        if a in succ or b in pred or find(a) == find(b):
+            continue
+        succ[a] = b
+        pred[b] = a
+        parent[find(a)] = find(b)
+    chains = []
+    for code in use:
+        if code in pred:
+            continue
+        chain = [code]
+        while chain[-1] in succ:
+            chain.append(succ[chain[-1]])
+        chains.append(chain)
+    chains.sort(key=lambda chain: sum(use[code] for code in chain), reverse=True)
+    order = [0x20]
+    order.extend(code for chain in chains for code in chain if code != 0x20)
+    return order
+
+def report_coverage(counts, charset, chars):
+    total = sum(counts.values())
+    if total == 0:
+        return
+    def covered(codes):
+        return sum(n for code, n in counts.items() if code in codes) / total
+    print(f"corpus: {total} characters, {len(counts)} distinct")
+    print(f" covered by the fonts: {covered(chars):.2%}")
+    print(f" covered by the core charset: {covered(CHARS_CORE & Charset.coerce(chars)):.2%}")
+    print(f" covered by the subset: {covered(charset):.2%}, {len(charset)} glyphs")
+
+WARNING = "\033[1;31mWARNING\033[0m"
+
+# Flash budget for the core variant on 1M parts, see pack_data.py.
+CORE_DOUBLES_BUDGET = 512*1024
+CORE_TOTAL_BUDGET = 704*1024
+
+# Bump whenever the blob formats or the way they are generated change, so
+# that stale cached outputs are rebuilt.
+FORMAT_VERSION = 1
+
+VARIANTS = {"core": CHARS_CORE, "full": CHARS_FULL}
+
+def file_hash(fn):
+    h = hashlib.sha256()
+    with open(fn, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+def charset_hash(charset):
+    return hashlib.sha256(repr(charset).encode()).hexdigest()
+
+class BuildCache():
+    """Content-addressed cache of parsed input files and built variants,
+    kept in build/cache. Parsed glyphs are stored per input file as glyph
+    stores, keyed by the file's contents, the charset it was filtered with
+    and FORMAT_VERSION. The manifest records the key each variant's blobs
+    were last built from."""
+    def __init__(self, cachedir):
+        self.dir = cachedir
+        self.dir.mkdir(parents=True, exist_ok=True)
+        self.manifest_path = self.dir / "manifest.json"
+        try:
+            self.manifest = json.loads(self.manifest_path.read_text())
+        except (FileNotFoundError, ValueError):
+            self.manifest = {}
+        self.hits = self.misses = 0
+
+    @staticmethod
+    def key(*parts):
+        return hashlib.sha256("\n".join([str(FORMAT_VERSION), *parts]).encode()).hexdigest()
+
+    def count(self, hit, what):
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+        print(f"cache {'hit' if hit else 'miss'}: {what}")
+
+    def load_chars(self, key):
+        try:
+            return store_chars(GlyphStore(self.dir / f"glyphs-{key}.glyphs"))
+        except FileNotFoundError:
+            return None
+
+    def save_chars(self, key, chars):
+        with open(self.dir / f"glyphs-{key}.glyphs", "wb") as f:
+            write_store(f, {code: (char.type, char.data) for code, char in chars.items()})
+
+    def variant_current(self, variant, key, outputs):
+        return self.manifest.get(variant) == key and all(p.exists() for p in outputs)
+
+    def variant_built(self, variant, key):
+        self.manifest[variant] = key
+        self.manifest_path.write_text(json.dumps(self.manifest, indent=1))
+
+def store_chars(store, charset=None):
+    """The chars of a glyph store, optionally only those in charset. Their
+    bitmaps stay in the store's mapping."""
+    if (store.height, store.width) != (16, 8):
+        raise Exception(f"Bad glyph store size {store.width}x{store.height}")
+    intervals = None if charset is None else charset.intervals
+    return {code: Char(code, chartype, data)
+            for code, chartype, data in store.items(intervals)}
+
+def is_emoji_file(fn):
+    basename = fn[:fn.rindex(".")] if magicopen.filetype(fn) else fn
+    return basename.endswith(".chx")
+
+def load_fonts(fonts, cache):
+    """Read the font files in priority order, using cached parses of files
+    that have been seen before. Glyph stores are mapped directly, and emoji
+    files are small enough to always be read."""
     chars = {}
-    status = 0
+    for fn, key in fonts:
+        if is_emoji_file(fn):
+            with magicopen.magic_open(fn, "rt") as f:
+                read_chx(chars, CHARS_EMOJI, f)
+            continue
+        if fn.endswith(".glyphs"):
+            for code, char in store_chars(GlyphStore(fn), CHARS_FULL).items():
+                chars.setdefault(code, char)
+            continue
+        parsed = cache.load_chars(key) if cache else None
+        if cache:
+            cache.count(parsed is not None, fn)
+        if parsed is None:
+            parsed = {}
+            with magicopen.magic_open(fn, "rt") as f:
+                read_hex(parsed, CHARS_FULL, f)
+            if cache:
+                cache.save_chars(key, parsed)
+        for code, char in parsed.items():
+            chars.setdefault(code, char)
+    return chars
+
+# Only the full variant has room for emoji.
+EMOJI_VARIANTS = {"full"}
+
+def emoji_paths(builddir, variant):
+    return [builddir/f"fonte-{variant}.bin", builddir/f"epal-{variant}.bin"]
+
+def variant_outputs(builddir, variant, compress=False, emoji=False):
+    outputs = [builddir/f"font1-{variant}.bin", builddir/f"font2-{variant}.bin",
+               builddir/f"charmap-{variant}.bin"]
+    if emoji and variant in EMOJI_VARIANTS:
+        outputs += emoji_paths(builddir, variant)
+    if compress:
+        outputs.append(pools_path(builddir, variant))
+    return outputs
+
+def pools_path(builddir, variant):
+    return builddir/f"fontpools-{variant}.json"
+
+def build_variant(builddir, variant, charset, chars, compress=False, order=(),
+                  identity=False):
+    singles, doubles, charmap = variant_outputs(builddir, variant)
+    emojis, palettes = emoji_paths(builddir, variant)
+    emoji_ids, emoji = {}, []
+    # without any emoji there are no emoji blobs, and pack_data.py leaves
+    # them out of the flash layout
+    if variant in EMOJI_VARIANTS and any(isinstance(char, EmojiChar) for char in chars.values()):
+        with open(emojis, "wb") as emojis, open(palettes, "wb") as palettes:
+            emoji_ids, emoji = write_emoji(chars, emojifile=emojis, palettefile=palettes)
+    else:
+        emojis.unlink(missing_ok=True)
+        palettes.unlink(missing_ok=True)
+    with open(singles, "wb") as singles, \
+         open(doubles, "wb") as doubles, \
+         open(charmap, "wb") as charmap:
+        dupes, pools = write_blobs(chars, charset, singlefile=singles,
+                                   doublefile=doubles, charmapfile=charmap,
+                                   compress=compress, order=order, emoji_ids=emoji_ids,
+                                   identity=identity)
+    # the pools file tells pack_data.py that the blobs are compressed
+    if pools is None:
+        pools_path(builddir, variant).unlink(missing_ok=True)
+    else:
+        pools_path(builddir, variant).write_text(json.dumps(pools, indent=1))
+    print(f"{variant} charset:")
+    report_dedup(dupes)
+    if pools is not None:
+        report_compression(chars, charset, pools)
+    report_emoji(emoji)
 
-    if len(sys.argv) < 2:
-        print("usage: build.py fontfile.hex [fontfile.hex ...]")
-        sys.exit(1)
-    for fn in sys.argv[1:]:
-        f = magicopen.magic_open(fn, "rt")
-        read_hex(chars, set(CHARS_FULL), f)
+def check_budget(builddir, variant):
+    """Print the sizes of a built variant. Returns False if it is the core
+    variant and it doesn't fit the flash budget."""
+    singles, doubles, charmap = (p.stat().st_size for p in variant_outputs(builddir, variant)[:3])
+    print(f"{variant}: singles: {singles} bytes, doubles: {doubles} bytes, charmap: {charmap} bytes")
+    fits = doubles <= CORE_DOUBLES_BUDGET and doubles + singles + charmap <= CORE_TOTAL_BUDGET
+    if variant != "core":
+        print(" fits the 1M core budget" if fits else " does not fit the 1M core budget")
+        return True
+    if doubles > CORE_DOUBLES_BUDGET:
+        print(WARNING + " doublewide font too big! Packing will fail.")
+    if doubles + singles + charmap > CORE_TOTAL_BUDGET:
+        print(WARNING + " total size too big! Packing will fail.")
+    return fits
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Build the font blobs to be flashed into build/")
+    parser.add_argument("files", metavar="fontfile.hex", nargs="+",
+        help="unifont .hex files or .chx emoji files, optionally compressed, or "
+        ".glyphs glyph stores from bdf2hex.py --store, in priority order")
+    parser.add_argument("--no-cache", action="store_true",
+        help="ignore and don't update the build cache in build/cache")
+    parser.add_argument("--compress", action="store_true",
+        help="store glyphs without their empty rows")
+    parser.add_argument("--analyze", action="store_true",
+        help="predict the size of each variant per block, without building anything")
+    parser.add_argument("--corpus", metavar="text", action="append", default=[],
+        help="build the core variant from the glyphs that best cover this text, "
+        "optionally compressed (can be given more than once)")
+    parser.add_argument("--order", metavar="text", action="append", default=[],
+        help="order glyphs so that those next to each other in this text are "
+        "adjacent in flash, see fillsim.py (can be given more than once)")
+    parser.add_argument("--identity", action="store_true",
+        help="give ASCII and Latin-1 their codepoints as glyph indices, so that "
+        "the gateware maps them without reading the charmap")
+    parser.add_argument("-p", "--platform", choices=FLASH_START.keys(), default="tinyfpga",
+        help="platform whose flash the --corpus subset must fit (default: tinyfpga)")
+    parser.add_argument("-s", "--size", type=int, default=1,
+        help="flash size in MB the --corpus subset must fit (default: 1)")
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    status = 0
 
     builddir = pathlib.Path("build")
     if not builddir.exists():
         builddir.mkdir()
+    cache = None if args.no_cache else BuildCache(builddir/"cache")
 
-    with open(builddir/"font1-core.bin", "wb") as singles, \
-         open(builddir/"font2-core.bin", "wb") as doubles, \
-         open(builddir/"charmap-core.bin", "wb") as charmap:
-        write_blobs(chars, CHARS_CORE, singlefile=singles,
-                    doublefile=doubles, charmapfile=charmap)
-        print("core chars:")
-        print(f" singles: {singles.tell()} bytes," +
-              f" doubles: {doubles.tell()} bytes")
-        if doubles.tell() > 512*1024:
-            print(WARNING + " doublewide font too big! Packing will fail.")
-            status = 1
-        if doubles.tell() + singles.tell() + charmap.tell() > 704*1024:
-            print(WARNING + " total size too big! Packing will fail.")
-            status = 1
+    fulls = charset_hash(CHARS_FULL)
+    fonts = [(fn, BuildCache.key(file_hash(fn), fulls)) for fn in args.files]
+    chars = None
+    variants = dict(VARIANTS)
+    if args.corpus:
+        chars = load_fonts(fonts, cache)
+        counts = read_corpus(args.corpus)
+        variants["core"] = choose_subset(chars, counts, compress=args.compress,
+                                         flash_start=FLASH_START[args.platform],
+                                         flash_end=args.size << 20)
+        report_coverage(counts, variants["core"], chars)
+    order = ()
+    if args.order:
+        if chars is None:
+            chars = load_fonts(fonts, cache)
+        order = usage_order(chars, read_pairs(args.order))
+    if args.analyze:
+        if chars is None:
+            chars = load_fonts(fonts, cache)
+        for variant, charset in variants.items():
+            report_footprint(variant, *predict_footprint(chars, charset, args.compress))
+        return
 
-    with open(builddir/"font1-full.bin", "wb") as singles, \
-         open(builddir/"font2-full.bin", "wb") as doubles, \
-         open(builddir/"charmap-full.bin", "wb") as charmap:
-        write_blobs(chars, CHARS_FULL, singlefile=singles,
-                    doublefile=doubles, charmapfile=charmap)
-        print("full charset:")
-        print(f" singles: {singles.tell()} bytes," +
-              f" doubles: {doubles.tell()} bytes")
+    emoji = any(is_emoji_file(fn) for fn, key in fonts)
+    for variant, charset in variants.items():
+        if not emoji:
+            # left over from a build with emoji
+            for path in emoji_paths(builddir, variant):
+                path.unlink(missing_ok=True)
+        key = BuildCache.key(*(key for fn, key in fonts), charset_hash(charset),
+                             f"compress={args.compress}", f"order={order}",
+                             f"identity={args.identity}")
+        outputs = variant_outputs(builddir, variant, args.compress, emoji)
+        if cache and cache.variant_current(variant, key, outputs):
+            cache.count(True, f"{variant} blobs")
+        else:
+            if cache:
+                cache.count(False, f"{variant} blobs")
+            if chars is None:
+                chars = load_fonts(fonts, cache)
+            build_variant(builddir, variant, charset, chars, args.compress, order,
+                          args.identity)
+            if cache:
+                cache.variant_built(variant, key)
+        if not check_budget(builddir, variant):
+            status = 1
 
+    if cache:
+        print(f"cache: {cache.hits} hits, {cache.misses} misses")
     sys.exit(status)
 
 if __name__ == "__main__":
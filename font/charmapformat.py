@@ -0,0 +1,22 @@
+"""
+The layout of charmap-$variant.bin, shared by build_font.py, which writes
+it, and pack_data.py and fillsim.py, which read it. It must match
+gateware/charmap.py.
+
+The charmap starts with a page directory of CHARMAP_PAGES 16-bit page
+numbers, one per CHARMAP_PAGE_SIZE codepoints, followed at
+CHARMAP_PAGES_OFFSET by the pages themselves, each CHARMAP_PAGE_SIZE 16-bit
+glyph indices, all little-endian.
+"""
+
+CHARMAP_CODEPOINTS = 0x110000
+CHARMAP_PAGE_SIZE = 256
+CHARMAP_PAGES = CHARMAP_CODEPOINTS // CHARMAP_PAGE_SIZE
+CHARMAP_PAGES_OFFSET = CHARMAP_PAGES * 2
+# With build_font.py --identity, the codepoints of ASCII and Latin-1 are
+# their own glyph indices, so the gateware can map them without reading the
+# charmap.
+IDENTITY_CODEPOINTS = 0x100
+
+__all__ = ["CHARMAP_CODEPOINTS", "CHARMAP_PAGE_SIZE", "CHARMAP_PAGES",
+           "CHARMAP_PAGES_OFFSET", "IDENTITY_CODEPOINTS"]
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+"""
+End to end checks of the font tooling: builds the fonts for some corner
+cases, each in a scratch directory, packs them and checks the flash map the
+gateware would be built with. Exits with an error if any case fails.
+"""
+import argparse, pathlib, runpy, subprocess, sys, tempfile
+
+FONTDIR = pathlib.Path(__file__).resolve().parent
+FONTS = [FONTDIR / "ter-u16n.hex.xz", FONTDIR / "unifont_all-15.0.06.hex.xz"]
+
+# Printable ASCII: a core font without a single double-wide glyph.
+ASCII = "".join(chr(code) for code in range(0x20, 0x7f)) + "\n"
+
+# name -> (build_font.py options, corpus text, pack_data.py options)
+CASES = {
+    "ascii": (["--corpus", "corpus.txt"], ASCII, ["-p", "tinyfpga", "-s", "1"]),
+    "ascii-compressed": (["--compress", "--corpus", "corpus.txt"], ASCII,
+                         ["-p", "tinyfpga", "-s", "1"]),
+}
+
+def check_flash_map(path):
+    """The gateware ORs glyph indices into the font offsets, so every item
+    must be non-empty and aligned to its size."""
+    flash_map = runpy.run_path(str(path))
+    for name in ("FONT1", "FONT2", "CHARMAP"):
+        offset, size = flash_map[f"{name}_OFFSET"], flash_map[f"{name}_SIZE"]
+        if size == 0:
+            raise Exception(f"{name} is empty")
+        if (size - 1) & offset:
+            raise Exception(f"{name} of size {size:#x} at {offset:#x} isn't aligned")
+
+def run_case(name, build_args, corpus, pack_args, verbose):
+    with tempfile.TemporaryDirectory() as workdir:
+        workdir = pathlib.Path(workdir)
+        (workdir / "corpus.txt").write_text(corpus)
+        output = None if verbose else subprocess.DEVNULL
+        for command in ([sys.executable, str(FONTDIR / "build_font.py"), *build_args, *map(str, FONTS)],
+                        [sys.executable, str(FONTDIR / "pack_data.py"), *pack_args]):
+            subprocess.run(command, cwd=workdir, stdout=output, check=True)
+        suffix = "core" if pack_args[pack_args.index("-s") + 1] == "1" else "full"
+        check_flash_map(workdir / "build" / f"flash_map_{suffix}.py")
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="End to end checks of the font tooling")
+    parser.add_argument("cases", metavar="case", nargs="*",
+        help=f"cases to run, of {', '.join(CASES)} (default: all)")
+    parser.add_argument("-v", "--verbose", action="store_true",
+        help="show the output of the tools")
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    for name in args.cases:
+        if name not in CASES:
+            print(f"Unknown case {name}")
+            sys.exit(1)
+    failed = []
+    for name in args.cases or CASES:
+        try:
+            run_case(name, *CASES[name], args.verbose)
+            print(f"{name}: ok")
+        except Exception as e:
+            print(f"{name}: FAILED: {e}")
+            failed.append(name)
+    if failed:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+"""
+Replay text through the built font blobs the way the row filler would read
+them, and count how many glyph reads start at the flash address right after
+the previous read. Every such read could be a continuation of the previous
+SPI transaction instead of a new one, saving the command, address, mode and
+dummy clocks. Compare builds with and without build_font.py --order to see
+what glyph ordering gains.
+"""
+import argparse, collections, json, pathlib, sys
+
+from charmapformat import CHARMAP_PAGE_SIZE, CHARMAP_PAGES_OFFSET
+import magicopen
+
+# Clocks of a quad I/O read transaction before the first data byte: CS, 8
+# command, 6 address, 2 mode and 4 dummy clocks. See gateware/flashreader.py.
+TRANSACTION_CLOCKS = 1 + 8 + 6 + 2 + 4
+# Clocks per byte of data.
+BYTE_CLOCKS = 2
+
+class Font():
+    """The glyph lookup of one built variant."""
+    def __init__(self, builddir, variant):
+        self.charmap = (builddir / f"charmap-{variant}.bin").read_bytes()
+        poolsfile = builddir / f"fontpools-{variant}.json"
+        self.pools = None
+        if poolsfile.exists():
+            pools = json.loads(poolsfile.read_text())
+            self.pools = sorted((pool["first"], pool["stride"], pool["offset"], font)
+                                for font, fontpools in pools.items() for pool in fontpools)
+
+    def glyphid(self, code):
+        page = int.from_bytes(self.charmap[(code >> 8) * 2:(code >> 8) * 2 + 2], "little")
+        entry = CHARMAP_PAGES_OFFSET + (page * CHARMAP_PAGE_SIZE + code % CHARMAP_PAGE_SIZE) * 2
+        return int.from_bytes(self.charmap[entry:entry + 2], "little")
+
+    def extent(self, glyphid):
+        """The blob, offset and length of a glyph's read, or None if reading
+        it takes no flash access."""
+        if self.pools is None:
+            if glyphid >= 16384:
+                return "font2", (glyphid - 16384) * 32, 32
+            return "font1", glyphid * 16, 16
+        first, stride, offset, font = [p for p in self.pools if p[0] <= glyphid][-1]
+        if stride == 0:
+            return None
+        return font, offset + (glyphid - first) * stride, stride
+
+def screen_rows(lines, cols, font):
+    """Lay lines of text out on a screen cols wide, wrapping long lines.
+    Yields each screen row as a list of glyph ids, with empty cells 0."""
+    for line in lines:
+        row = []
+        for ch in line.rstrip("\n").expandtabs():
+            if ord(ch) < 0x20:
+                continue
+            glyphid = font.glyphid(ord(ch))
+            width = 2 if 16384 <= glyphid < 0xffff else 1
+            if len(row) + width > cols:
+                yield row + [0] * (cols - len(row))
+                row = []
+            row.append(glyphid)
+            if width == 2:
+                row.append(None)
+        yield row + [0] * (cols - len(row))
+
+def simulate(rows, font):
+    stats = collections.Counter()
+    for row in rows:
+        stats["fills"] += 1
+        prev = None
+        for glyphid in row:
+            if glyphid is None:
+                # right half of a double-wide
+                continue
+            stats["cells"] += 1
+            extent = font.extent(glyphid)
+            if extent is None:
+                stats["no read"] += 1
+                continue
+            blob, offset, length = extent
+            stats["reads"] += 1
+            stats["bytes"] += length
+            if prev == (blob, offset):
+                stats["sequential"] += 1
+            prev = (blob, offset + length)
+    return stats
+
+def report(stats):
+    reads = stats["reads"]
+    print(f"{stats['fills']} row fills, {stats['cells']} cells, {reads} glyph reads")
+    if not reads:
+        return
+    print(f" sequential: {stats['sequential']} ({stats['sequential'] / reads:.1%} of reads)")
+    print(f" blank cells without a read: {stats['no read']}")
+    clocks = reads * TRANSACTION_CLOCKS + stats["bytes"] * BYTE_CLOCKS
+    saved = stats["sequential"] * TRANSACTION_CLOCKS
+    print(f" flash clocks: {clocks}, {clocks - saved} with continuous reads "
+          f"({saved / clocks:.1%} saved), {clocks / stats['fills']:.0f} per fill")
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Replay text through the built fonts and count sequential glyph reads")
+    parser.add_argument("files", metavar="text", nargs="+",
+        help="text files, optionally compressed")
+    parser.add_argument("-v", "--variant", choices=["core", "full"], default="full")
+    parser.add_argument("-c", "--cols", type=int, default=80,
+        help="screen width in cells")
+    args = parser.parse_args()
+
+    font = Font(pathlib.Path("build"), args.variant)
+    stats = collections.Counter()
+    for fn in args.files:
+        with magicopen.magic_open(fn, "rt") as f:
+            stats += simulate(screen_rows(f, args.cols, font), font)
+    report(stats)
+
+if __name__ == "__main__":
+    main()
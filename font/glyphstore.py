@@ -0,0 +1,113 @@
+"""
+Binary glyph store, an indexed alternative to unifont .hex files that can be
+memory-mapped and used without any parsing. It is written by bdf2hex.py
+--store and read by build_font.py, which also keeps its cache in this format.
+
+The layout, all little-endian, is:
+* header: magic "UGS1", 16-bit glyph height and width in pixels, 32-bit
+  number of single-wide and of double-wide glyphs
+* the codepoints of the single-wides, sorted, 32 bits each
+* the codepoints of the double-wides, likewise
+* the bitmaps of the single-wides, in codepoint order, each height rows of
+  (width + 7) // 8 bytes
+* the bitmaps of the double-wides, with rows twice as wide
+
+Bitmaps are stored bit-reversed, the way they are flashed, so that they can
+be copied into the font blobs as they are.
+"""
+import array, bisect, mmap, struct, sys
+
+# The video hardware shifts pixels out of each byte LSB first, whereas .hex
+# and BDF bitmaps have the leftmost pixel in the MSB, so every byte gets
+# bit-reversed.
+BITREV = bytes(int('{:08b}'.format(i)[::-1], 2) for i in range(256))
+
+MAGIC = b"UGS1"
+HEADER = struct.Struct("<4sHHII")
+GLYPH_TYPES = ("single", "double")
+
+def glyph_sizes(height, width):
+    row = (width + 7) // 8
+    return {"single": height * row, "double": height * row * 2}
+
+class GlyphStore():
+    """A glyph store mapped from a file. Looking a codepoint up is a binary
+    search of the index, and bitmaps are memoryviews into the mapping."""
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        buf = memoryview(self._mmap)
+        magic, self.height, self.width, *counts = HEADER.unpack_from(buf)
+        if magic != MAGIC:
+            raise Exception(f"{path} is not a glyph store")
+        pos = HEADER.size
+        self.codes = {}
+        for chartype, n in zip(GLYPH_TYPES, counts):
+            codes = buf[pos:pos + n * 4]
+            if sys.byteorder == "big":
+                codes = array.array("I", codes)
+                codes.byteswap()
+            else:
+                codes = codes.cast("I")
+            self.codes[chartype] = codes
+            pos += n * 4
+        self.sizes = glyph_sizes(self.height, self.width)
+        self.data = {}
+        for chartype, n in zip(GLYPH_TYPES, counts):
+            size = self.sizes[chartype]
+            self.data[chartype] = buf[pos:pos + n * size]
+            pos += n * size
+        if pos != len(buf):
+            raise Exception(f"{path} is truncated or corrupt")
+
+    def lookup(self, code):
+        """Returns the glyph type and bitmap of a codepoint, or None."""
+        for chartype, codes in self.codes.items():
+            i = bisect.bisect_left(codes, code)
+            if i < len(codes) and codes[i] == code:
+                size = self.sizes[chartype]
+                return chartype, self.data[chartype][i * size:(i + 1) * size]
+        return None
+
+    def __contains__(self, code):
+        return self.lookup(code) is not None
+
+    def __len__(self):
+        return sum(len(codes) for codes in self.codes.values())
+
+    def items(self, intervals=None):
+        """Yields (codepoint, glyph type, bitmap) for the single-wides, then
+        the double-wides, each in codepoint order. If given a list of sorted
+        half-open (start, end) intervals, only for the codepoints in them."""
+        for chartype, codes in self.codes.items():
+            size = self.sizes[chartype]
+            data = self.data[chartype]
+            if intervals is None:
+                ranges = [(0, len(codes))]
+            else:
+                ranges = [(bisect.bisect_left(codes, start), bisect.bisect_left(codes, end))
+                          for start, end in intervals]
+            for first, last in ranges:
+                for i in range(first, last):
+                    yield codes[i], chartype, data[i * size:(i + 1) * size]
+
+def write_store(f, glyphs, *, height=16, width=8):
+    """Write a glyph store of the glyphs in a dict mapping codepoints to
+    (glyph type, bit-reversed bitmap)."""
+    sizes = glyph_sizes(height, width)
+    codes = {chartype: array.array("I") for chartype in GLYPH_TYPES}
+    for code in sorted(glyphs):
+        chartype, data = glyphs[code]
+        if len(data) != sizes[chartype]:
+            raise Exception(f"Bad bitmap size {len(data)} for {code:#x}")
+        codes[chartype].append(code)
+    f.write(HEADER.pack(MAGIC, height, width, *(len(c) for c in codes.values())))
+    for codelist in codes.values():
+        if sys.byteorder == "big":
+            codelist = array.array("I", codelist)
+            codelist.byteswap()
+        codelist.tofile(f)
+    for codelist in codes.values():
+        f.write(b"".join(glyphs[code][1] for code in codelist))
+
+__all__ = ["BITREV", "GlyphStore", "write_store"]
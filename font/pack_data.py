@@ -1,5 +1,7 @@
 #!/usr/bin/env python3
-import argparse, pathlib, os, subprocess
+import argparse, hashlib, json, pathlib, os, shutil, subprocess, sys
+
+from charmapformat import CHARMAP_PAGE_SIZE, CHARMAP_PAGES_OFFSET, IDENTITY_CODEPOINTS
 
 def ctz(i):
     if i == 0: return 0
@@ -9,7 +11,7 @@ def ctz(i):
         i >>= 1
     return cnt
 
-# Helper function for BlockAllocator
+# Split [start, end) into the largest naturally aligned power of two blocks.
 def adjust_block(start, end):
     blocks = []
     blocksize = 1 << ctz(start)
@@ -25,33 +27,91 @@ def adjust_block(start, end):
         blocksize >>= 1
     return blocks
 
-class BlockAllocator():
+def align_of(size):
+    """Every item must sit at an offset aligned to its size rounded up to a
+    power of two, so the gateware can OR the offset with an index."""
+    return 1 << max(size - 1, 0).bit_length()
+
+class FlashLayout():
+    """Places items in a flash range, each at an offset aligned to its
+    align_of(). Items are placed largest alignment first, each into the
+    smallest free interval that can hold it, at the lowest aligned address
+    there. Only an item's actual size is taken out of the free space, so the
+    slack between an item's end and its next alignment boundary is left for
+    smaller items."""
     def __init__(self, start, end):
-        self.blocks = adjust_block(start, end) 
-        self.blocks.sort(key = lambda x: x[1])
-
-    def allocate(self, size):
-        # blocks are sorted smallest-first
-        for i in range(len(self.blocks)):
-            start, blocksize = self.blocks[i]
-            if blocksize > size:
-                self.blocks[i:i+1] = adjust_block(start + size, start + blocksize)
-                self.blocks.sort(key = lambda x: x[1])
-                return start
-        raise Exception(f"Out of blocks, couldn't get size {size}")
+        self.start = start
+        self.end = end
+        self.free = [(start, end)]
+
+    def place(self, items):
+        items = sorted(items, key=lambda x: (align_of(x.size), x.size), reverse=True)
+        for item in items:
+            item.offset = self.allocate(item.size, name=item.name)
+        return items
+
+    def allocate(self, size, *, name=""):
+        if size == 0:
+            raise Exception(f"Can't place {name} of size 0")
+        align = align_of(size)
+        best = None
+        for i, (start, end) in enumerate(self.free):
+            offset = (start + align - 1) & ~(align - 1)
+            if offset + size <= end and (best is None or end - start < best[2]):
+                best = (i, offset, end - start)
+        if best is None:
+            raise Exception(f"Out of flash, couldn't place {name} of size {size}")
+        i, offset, _ = best
+        start, end = self.free[i]
+        self.free[i:i+1] = [(s, e) for s, e in ((start, offset), (offset + size, end)) if s < e]
+        return offset
+
+    def report(self):
+        total = self.end - self.start
+        free = sum(end - start for start, end in self.free)
+        # the largest aligned blocks still available for another item
+        blocks = [b for start, end in self.free for b in adjust_block(start, end)]
+        largest = max((size for start, size in blocks), default=0)
+        fragmentation = 1 - largest / free if free else 0
+        print(f"used {total - free:#x} of {total:#x} bytes, {free:#x} free in "
+              f"{len(self.free)} fragments")
+        print(f"largest free aligned block: {largest:#x} bytes, "
+              f"fragmentation {fragmentation:.0%}")
+        for start, end in self.free:
+            print("{:06x}\t{:06x}\tfree".format(start, end - start))
 
 def parse_args():
     parser = argparse.ArgumentParser(
         description="Pack font and other files into one blob for writing to the device's flash"
     )
-    parser.add_argument("-p", "--platform", choices=["upduino","tinyfpga"], required=True)
+    parser.add_argument("-p", "--platform", choices=FLASH_START.keys(), required=True)
     parser.add_argument("-s", "--size", type=int, help="Flash size in MB", required=True )
     parser.add_argument("-f", "--flash", action="store_true")
+    parser.add_argument("-n", "--dry-run", action="store_true",
+        help="print what flashing would write, without running the programmer")
+    parser.add_argument("--full", action="store_true",
+        help="flash the whole image, not just what changed since the last flash")
 
     return parser.parse_args()
 
+# Where the data area starts, after the bitstream(s).
+FLASH_START = {"tinyfpga": 0x50000, "upduino": 0x20000}
+
+def layout_fits(sizes, flash_start, flash_end):
+    """Whether items of the given sizes could all be placed in the flash
+    range, the same way FlashLayout.place() places them."""
+    layout = FlashLayout(flash_start, flash_end)
+    try:
+        for size in sorted(sizes, key=lambda size: (align_of(size), size), reverse=True):
+            layout.allocate(size)
+    except Exception:
+        return False
+    return True
+
 ITEMS_CORE = ["font1", "font2", "charmap"]
-ITEMS_FULL = ["font1", "font2", "charmap"]
+ITEMS_FULL = ["font1", "font2", "charmap", "fonte", "epal"]
+# Items that build_font.py only writes if there is something in them.
+ITEMS_OPTIONAL = {"fonte", "epal"}
 
 class ConfigObject():
     def __init__(self, name, filepath):
@@ -61,60 +121,219 @@ class ConfigObject():
         self.path = filepath
         self.name = name
 
-def gather_files(builddir, items, suffix, alloc):
-    config = [ ConfigObject(item, builddir / (f"{item}-{suffix}.bin")) for item in items]
-    config.sort(key=lambda x: x.size, reverse=True)
-    for item in config:
-        item.offset = alloc.allocate(item.size)
-    return config
+def gather_files(builddir, items, suffix, layout):
+    config = [ ConfigObject(item, builddir / (f"{item}-{suffix}.bin")) for item in items
+               if item not in ITEMS_OPTIONAL or (builddir / f"{item}-{suffix}.bin").exists()]
+    return layout.place(config)
 
 def write_config(builddir, suffix, config):
-    configfile = open(builddir / f"flash_map_{suffix}.py", "w")
-    for item in config:
-        print("{:06x}\t{:06x}\t{}".format(item.offset, item.size, item.name))
-        configfile.write("{}_OFFSET = {:#08x}\n".format(item.name.upper(), item.offset))
-        configfile.write("{}_SIZE   = {:#08x}\n".format(item.name.upper(), item.size))
+    with open(builddir / f"flash_map_{suffix}.py", "w") as configfile:
+        for item in config:
+            print("{:06x}\t{:06x}\t{}".format(item.offset, item.size, item.name))
+            configfile.write("{}_OFFSET = {:#08x}\n".format(item.name.upper(), item.offset))
+            configfile.write("{}_SIZE   = {:#08x}\n".format(item.name.upper(), item.size))
+        write_pools(builddir, suffix, config, configfile)
+        write_identity(config, configfile)
+
+def write_pools(builddir, suffix, config, configfile):
+    """If the fonts were built compressed, pass the glyph pools on to the
+    gateware as (first glyph index, rows per glyph, stride, flash address)."""
+    poolsfile = builddir / f"fontpools-{suffix}.json"
+    if not poolsfile.exists():
+        return
+    pools = json.loads(poolsfile.read_text())
+    offsets = {item.name: item.offset for item in config}
+    configfile.write("FONT_POOLS = [\n")
+    for font, fontpools in pools.items():
+        for pool in fontpools:
+            configfile.write("    ({:#06x}, {:2}, {:2}, {:#08x}),\n".format(
+                pool["first"], pool["rows"], pool["stride"],
+                offsets[font] + pool["offset"]))
+    configfile.write("]\n")
+
+def write_identity(config, configfile):
+    """If the charmap maps the first IDENTITY_CODEPOINTS codepoints to
+    themselves, tell the gateware it can skip looking them up."""
+    charmap = {item.name: item for item in config}["charmap"].path
+    with open(charmap, "rb") as f:
+        page = int.from_bytes(f.read(2), "little")
+        f.seek(CHARMAP_PAGES_OFFSET + page * CHARMAP_PAGE_SIZE * 2)
+        entries = f.read(IDENTITY_CODEPOINTS * 2)
+    if entries == b"".join(code.to_bytes(2, "little") for code in range(IDENTITY_CODEPOINTS)):
+        configfile.write("CHARMAP_IDENTITY = {:#06x}\n".format(IDENTITY_CODEPOINTS))
+
+# Erased flash reads as 0xff, so that's what goes between the items.
+FILL = b"\xff" * (1 << 16)
+
+def fill_range(outfile, offset, length):
+    outfile.seek(offset)
+    fill = memoryview(FILL)
+    while length > 0:
+        length -= outfile.write(fill[:min(length, len(fill))])
+
+def copy_range(outfile, path, offset, size, src_offset=0):
+    """Copy size bytes from src_offset in the file at path into outfile at
+    offset, in the kernel where possible."""
+    copied = 0
+    with open(path, "rb", buffering=0) as infile:
+        if hasattr(os, "copy_file_range"):
+            try:
+                while copied < size:
+                    n = os.copy_file_range(infile.fileno(), outfile.fileno(), size - copied,
+                                           src_offset + copied, offset + copied)
+                    if n == 0:
+                        break
+                    copied += n
+            except OSError:
+                # e.g. unsupported by the filesystem, fall back to copying
+                pass
+        while copied < size:
+            infile.seek(src_offset + copied)
+            outfile.seek(offset + copied)
+            chunk = infile.read(min(size - copied, len(FILL)))
+            if not chunk:
+                break
+            outfile.write(chunk)
+            copied += len(chunk)
 
 def write_uniblob(builddir, suffix, config, flash_start, flash_end):
-    outfile = open(builddir / f"uniblob-{suffix}.bin", "wb")
-    outfile.write(bytearray(0xff for _ in range(flash_start, flash_end)))
-    for item in config:
-        outfile.seek(item.offset - flash_start)
-        with open(item.path, "rb") as infile:
-            contents = infile.read()
-            outfile.write(contents)
-
-def flash_items(config):
-    iceprog = os.environ.get("ICEPROG", "iceprog")
-    for item in config:
-        subprocess.check_call([iceprog, "-o", str(item.offset), item.path])
- 
-def flash_uniblob(builddir, suffix):
+    """Write the whole flash range as one image, with the items at their
+    offsets and 0xff in the gaps. Memory use doesn't depend on the image
+    size."""
+    with open(builddir / f"uniblob-{suffix}.bin", "wb", buffering=0) as outfile:
+        pos = flash_start
+        for item in sorted(config, key=lambda x: x.offset):
+            fill_range(outfile, pos - flash_start, item.offset - pos)
+            copy_range(outfile, item.path, item.offset - flash_start, item.size)
+            pos = item.offset + item.size
+        fill_range(outfile, pos - flash_start, flash_end - pos)
+        outfile.truncate(flash_end - flash_start)
+
+# Flashing is incremental: the image last written to the device is recorded
+# as one hash per SECTOR_SIZE sector, and only the sectors whose hashes
+# changed are written again, merged into contiguous runs. The record is kept
+# per device, by platform and where the data area starts, so that flashing
+# the core and the full variant in turn compares each with what is really
+# on the flash. Runs are widened
+# to the erase granularity of the programmer, since it erases whole blocks
+# around whatever it writes: iceprog erases 64K blocks, tinyprog 4K sectors.
+SECTOR_SIZE = 0x1000
+ERASE_SIZE = {"upduino": 0x10000, "tinyfpga": SECTOR_SIZE}
+
+def sector_hashes(path):
+    hashes = []
+    with open(path, "rb") as f:
+        for sector in iter(lambda: f.read(SECTOR_SIZE), b""):
+            hashes.append(hashlib.blake2b(sector, digest_size=8).hexdigest())
+    return hashes
+
+def manifest_path(builddir, platform, flash_start):
+    """The record of what was last flashed to the data area of a device,
+    whichever variant that was."""
+    return builddir / f"flashed-{platform}-{flash_start:06x}.json"
+
+def dirty_runs(old, new, flash_start, erase_size):
+    """Returns the (offset, length) runs of flash that differ between the
+    sector hashes old and new, widened to erase_size blocks. If old is None,
+    the whole image is one run."""
+    image_size = len(new) * SECTOR_SIZE
+    if old is None:
+        return [(flash_start, image_size)]
+    runs = []
+    for i, sector in enumerate(new):
+        if i < len(old) and old[i] == sector:
+            continue
+        start = (flash_start + i * SECTOR_SIZE) & ~(erase_size - 1)
+        end = min((start + erase_size), flash_start + image_size)
+        start = max(start, flash_start)
+        if runs and start <= runs[-1][1]:
+            runs[-1] = (runs[-1][0], max(runs[-1][1], end))
+        else:
+            runs.append((start, end))
+    return [(start, end - start) for start, end in runs]
+
+def flash_plan(builddir, platform, suffix, flash_start, *, full=False):
+    """Returns the runs of the image that need flashing and the image's
+    sector hashes. The whole image is flashed if the device last had an
+    image of another size."""
+    uniblob = builddir / f"uniblob-{suffix}.bin"
+    new = sector_hashes(uniblob)
+    old = None
+    if not full:
+        try:
+            manifest = json.loads(manifest_path(builddir, platform, flash_start).read_text())
+            if (manifest["image_size"] == uniblob.stat().st_size and
+                manifest["sector_size"] == SECTOR_SIZE):
+                old = manifest["sectors"]
+        except (FileNotFoundError, ValueError, KeyError):
+            pass
+    return dirty_runs(old, new, flash_start, ERASE_SIZE[platform]), new
+
+def flash_commands(builddir, platform, suffix, flash_start, flash_end, runs):
+    """Returns (command, run file) pairs, where the run file, if any, needs to
+    be cut from the image before running the command, and is deleted after."""
+    uniblob = builddir / f"uniblob-{suffix}.bin"
+    if platform == "upduino":
+        iceprog = os.environ.get("ICEPROG", "iceprog")
+        return [([iceprog, "-o", str(offset), str(builddir / f"flashrun-{offset:06x}.bin")],
+                 (offset, length)) for offset, length in runs]
     tinyprog = os.environ.get("TINYPROG", "tinyprog")
+    if runs == [(flash_start, flash_end - flash_start)]:
+        # the image is the user data area
+        return [([tinyprog, "-u", str(uniblob)], None)]
+    return [([tinyprog, "-a", hex(offset), "--program-image",
+              str(builddir / f"flashrun-{offset:06x}.bin")], (offset, length))
+            for offset, length in runs]
+
+def flash_uniblob(builddir, platform, suffix, flash_start, flash_end, *, full=False, dry_run=False):
+    runs, hashes = flash_plan(builddir, platform, suffix, flash_start, full=full)
+    total = sum(length for offset, length in runs)
+    print(f"flashing {len(runs)} runs, {total:#x} of {flash_end - flash_start:#x} bytes")
+    for offset, length in runs:
+        print("{:06x}\t{:06x}".format(offset, length))
+    commands = flash_commands(builddir, platform, suffix, flash_start, flash_end, runs)
     uniblob = builddir / f"uniblob-{suffix}.bin"
-    subprocess.check_call([tinyprog, "-u", uniblob])
+    for command, run in commands:
+        print(" ".join(command))
+        if dry_run:
+            continue
+        if run is None:
+            subprocess.check_call(command)
+            continue
+        offset, length = run
+        runpath = pathlib.Path(command[-1])
+        try:
+            with open(runpath, "wb", buffering=0) as runfile:
+                copy_range(runfile, uniblob, 0, length, offset - flash_start)
+            subprocess.check_call(command)
+        finally:
+            runpath.unlink(missing_ok=True)
+    if not dry_run:
+        manifest_path(builddir, platform, flash_start).write_text(json.dumps({
+            "image_size": flash_end - flash_start,
+            "sector_size": SECTOR_SIZE,
+            "sectors": hashes,
+        }))
 
 def main():
     args = parse_args()
-    if args.platform == "tinyfpga":
-        flash_start = 0x50000
-    else:
-        flash_start = 0x20000
+    flash_start = FLASH_START[args.platform]
     if args.size <= 0 or args.size > 16:
         print(f"Unsupported flash size {args.size}MB")
         sys.exit(1)
     suffix = "core" if args.size == 1 else "full"
     items = ITEMS_CORE if args.size == 1 else ITEMS_FULL
     flash_end = args.size * 1024 * 1024
-    allocator = BlockAllocator(flash_start, flash_end)
+    layout = FlashLayout(flash_start, flash_end)
     builddir = pathlib.Path("build")
-    config = gather_files(builddir, items, suffix, allocator)
+    config = gather_files(builddir, items, suffix, layout)
     write_config(builddir, suffix, config)
-    if args.flash and args.platform == "upduino":
-        flash_items(config)
-    elif args.flash and args.platform == "tinyfpga":
+    print(f"{suffix} layout:")
+    layout.report()
+    if args.flash or args.dry_run:
         write_uniblob(builddir, suffix, config, flash_start, flash_end)
-        flash_uniblob(builddir, suffix)
+        flash_uniblob(builddir, args.platform, suffix, flash_start, flash_end,
+                      full=args.full, dry_run=args.dry_run)
 
 if __name__ == "__main__":
     main()
@@ -57,6 +57,22 @@ def parse_args():
             default="640x480")
     parser.add_argument("-f", "--flash",
             action="store_true")
+    parser.add_argument("--rowbuf-rows", type=int, default=2,
+            help="text rows in the row buffer, a power of 2 (default: 2)")
+    parser.add_argument("--fill-ahead", type=int, default=1,
+            help="how many rows ahead of the display to fill, less than "
+            "--rowbuf-rows (default: 1)")
+    parser.add_argument("--framebuffer", action="store_true",
+            help="render into a framebuffer in SPRAM, only the rows that change "
+            "(UP5K only)")
+    parser.add_argument("--xip", action="store_true",
+            help="keep the flash in continuous read mode, for faster reads. The "
+            "FPGA then only reconfigures from flash after a power cycle, not "
+            "after CRESET or a warm boot")
+    parser.add_argument("--qpi", action="store_true",
+            help="put the flash in QPI mode, for shorter read commands. The "
+            "FPGA then only reconfigures from flash after a power cycle, not "
+            "after CRESET or a warm boot")
 
     return parser.parse_args()
 
@@ -74,7 +90,10 @@ def main():
     # copy file to build/
     shutil.copy(flashmapfile, "build/flash_map.py")
     import toplevel
-    pdata.platform.build(toplevel.Toplevel(pdata, timings),
+    pdata.platform.build(toplevel.Toplevel(pdata, timings, rowbuf_rows=options.rowbuf_rows,
+                                           fill_ahead=options.fill_ahead,
+                                           framebuffer=options.framebuffer,
+                                           xip=options.xip, qpi=options.qpi),
                          do_program=options.flash, icepack_opts="-s")
 
 
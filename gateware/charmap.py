@@ -2,11 +2,37 @@ from amaranth import *
 from amaranth.lib.wiring import *
 from flasharb import arbClientSig, flashReaderSig
 from build.flash_map import *
+import build.flash_map as flash_map
 
-assert ((CHARMAP_SIZE - 1) & CHARMAP_OFFSET) == 0
-CHARMAP_MASK = CHARMAP_SIZE - 1
+# The charmap is a directory of 16-bit page numbers, one per 256 codepoints of
+# all 17 planes, followed by the 256-entry pages of 16-bit glyph ids. See
+# font/build_font.py.
+CHARMAP_PAGES = 0x110000 >> 8
+CHARMAP_PAGES_OFFSET = CHARMAP_PAGES * 2
+
+CHARMAP_MASK = (1 << (CHARMAP_SIZE - 1).bit_length()) - 1
+assert (CHARMAP_MASK & CHARMAP_OFFSET) == 0
+
+# The codepoints below this have glyph ids equal to themselves, if the fonts
+# were built with build_font.py --identity.
+CHARMAP_IDENTITY = getattr(flash_map, "CHARMAP_IDENTITY", 0)
+
+# The most clocks a lookup holds the flash for: two 2-byte reads, and the
+# first one puts the flash in QPI mode if the reader does that.
+LOOKUP_CLOCKS = 72
 
 class CharMap(Component):
+    """Looks up the glyph id for a codepoint in the flash charmap, first
+    reading the codepoint's page number from the directory and then the
+    glyph id from that page. The codepoint is taken with en.
+
+    The results are kept in a direct-mapped cache of cache_size entries
+    (a power of 2, or 0 for none) in block RAM, indexed by the low bits of
+    the codepoint, and a hit is valid two clocks after en without going
+    to flash. hits and misses count the lookups since reset.
+
+    Codepoints below identity are their own glyph ids, which is valid the
+    clock after en, without the cache or the flash."""
     ctrl: Out(Signature({
         "codepoint": In(21),
         "glyphid": Out(16),
@@ -14,27 +40,73 @@ class CharMap(Component):
         "valid": Out(1),
     }))
     flash: Out(arbClientSig(flashReaderSig()))
-    def __init__(self):
+    hits: Out(32)
+    misses: Out(32)
+    def __init__(self, *, cache_size=64, identity=CHARMAP_IDENTITY):
+        if cache_size & (cache_size - 1):
+            raise Exception(f"cache size must be a power of 2, not {cache_size}")
+        self.cache_size = cache_size
+        self.identity = identity
         super().__init__()
 
+    def start(self, m, codepoint, probe):
+        """Start a lookup if en is set, reading the cache entry for the
+        codepoint if it isn't mapped by identity."""
+        with m.If(self.ctrl.en):
+            m.d.sync += codepoint.eq(self.ctrl.codepoint)
+            with m.If(self.ctrl.codepoint < self.identity):
+                m.d.sync += self.ctrl.glyphid.eq(self.ctrl.codepoint)
+                m.d.sync += self.ctrl.valid.eq(1)
+                m.next = "DONE"
+            with m.Else():
+                if self.cache_size:
+                    m.d.comb += probe.eq(1)
+                    m.next = "CHECK"
+                else:
+                    m.next = "REQUEST"
+                    m.d.sync += self.flash.request.eq(1)
+
     def elaborate(self, platform):
         m = Module()
 
-        m.d.comb += [
-            self.flash.client.read_size.eq(2),
-            self.flash.client.addr.eq(CHARMAP_OFFSET | ((self.ctrl.codepoint[0:16] << 1) & CHARMAP_MASK)),
-        ]
+        page = Signal(16)
+        # the codepoint being looked up
+        codepoint = Signal(21)
+        # the glyph id read from flash is complete and goes into the cache
+        fill = Signal()
+        probe = Signal()
+        dir_addr = codepoint[8:21] << 1
+        page_addr = CHARMAP_PAGES_OFFSET + (page << 9) + (codepoint[0:8] << 1)
+
+        m.d.comb += self.flash.client.read_size.eq(2)
 
         with m.FSM():
             with m.State("IDLE"):
-                with m.If(self.ctrl.en):
-                    m.next = "REQUEST"
-                    m.d.sync += self.flash.request.eq(1)
+                self.start(m, codepoint, probe)
+
+            if self.cache_size:
+                self.elaborate_cache(m, codepoint, fill, probe)
 
             with m.State("REQUEST"):
+                m.d.comb += self.flash.client.addr.eq(CHARMAP_OFFSET | (dir_addr & CHARMAP_MASK))
                 with m.If(self.flash.ok):
                     m.d.comb += self.flash.client.read_trigger.eq(1)
-                    m.next = "WAIT1"
+                    m.next = "DIR1"
+
+            with m.State("DIR1"):
+                with m.If(self.flash.client.valid):
+                    m.d.sync += page[0:8].eq(self.flash.client.data)
+                    m.next = "DIR2"
+
+            with m.State("DIR2"):
+                with m.If(self.flash.client.valid):
+                    m.d.sync += page[8:16].eq(self.flash.client.data)
+                    m.next = "PAGE"
+
+            with m.State("PAGE"):
+                m.d.comb += self.flash.client.addr.eq(CHARMAP_OFFSET | (page_addr & CHARMAP_MASK))
+                m.d.comb += self.flash.client.read_trigger.eq(1)
+                m.next = "WAIT1"
 
             with m.State("WAIT1"):
                 with m.If(self.flash.client.valid):
@@ -44,6 +116,8 @@ class CharMap(Component):
             with m.State("WAIT2"):
                 with m.If(self.flash.client.valid):
                     m.d.sync += self.ctrl.glyphid[8:16].eq(self.flash.client.data)
+                    if self.cache_size:
+                        m.d.comb += fill.eq(1)
                     m.d.sync += self.ctrl.valid.eq(1)
                     m.d.sync += self.flash.request.eq(0)
                     m.next = "DONE"
@@ -51,38 +125,91 @@ class CharMap(Component):
             with m.State("DONE"):
                 m.d.sync += self.ctrl.valid.eq(0)
                 m.next = "IDLE"
+                # the next lookup can start right away
+                self.start(m, codepoint, probe)
 
         return m
 
+    def elaborate_cache(self, m, codepoint, fill, probe):
+        """The cache, which is read when probe is set as a lookup starts,
+        and the state that checks the entry read, against the latched
+        codepoint. Misses go on to flash, and the result is written to the
+        cache as it comes in."""
+        idxbits = (self.cache_size - 1).bit_length()
+        # each entry is a valid bit, the rest of the codepoint and the glyph id
+        mem = Memory(width=1 + 21 - idxbits + 16, depth=self.cache_size)
+        m.submodules.cache_rd = cache_rd = mem.read_port(transparent=False)
+        m.submodules.cache_wr = cache_wr = mem.write_port()
+        index = codepoint[:idxbits]
+        tag = codepoint[idxbits:]
+        entry_valid = cache_rd.data[0]
+        entry_tag = cache_rd.data[1:1 + len(tag)]
+        entry_glyphid = cache_rd.data[1 + len(tag):]
+        m.d.comb += [
+            cache_rd.addr.eq(self.ctrl.codepoint[:idxbits]),
+            cache_rd.en.eq(probe),
+            cache_wr.addr.eq(index),
+            cache_wr.data.eq(Cat(1, tag, self.ctrl.glyphid[0:8], self.flash.client.data)),
+            cache_wr.en.eq(fill),
+        ]
+
+        with m.State("CHECK"):
+            with m.If(entry_valid & (entry_tag == tag)):
+                m.d.sync += self.hits.eq(self.hits + 1)
+                m.d.sync += self.ctrl.glyphid.eq(entry_glyphid)
+                m.d.sync += self.ctrl.valid.eq(1)
+                m.next = "DONE"
+            with m.Else():
+                m.d.sync += self.misses.eq(self.misses + 1)
+                m.d.sync += self.flash.request.eq(1)
+                m.next = "REQUEST"
+
 if __name__ == "__main__":
+    import sys
     from amaranth.sim import *
-    dut = CharMap()
-    sim = Simulator(dut)
+    from flasharb import FlashArbiter
+    from flashreader import spiflash_model
+
+    # Look codepoints up in a charmap built by font/build_font.py and check the
+    # results against a lookup done in Python.
+    charmap_bin = open(sys.argv[1] if len(sys.argv) > 1 else
+                       "../font/build/charmap-full.bin", "rb").read()
+    def lookup(cp):
+        page = int.from_bytes(charmap_bin[(cp >> 8) * 2:(cp >> 8) * 2 + 2], "little")
+        entry = CHARMAP_PAGES_OFFSET + page * 512 + (cp & 0xff) * 2
+        return int.from_bytes(charmap_bin[entry:entry + 2], "little")
+
+    m = Module()
+    m.submodules.dut = dut = CharMap()
+    m.submodules.arb = arb = FlashArbiter(dut.flash)
+    sim = Simulator(m)
     sim.add_clock(1e-6)
     def proc():
-        yield dut.codepoint.eq(0x262d)
-        yield Tick()
-        yield dut.en.eq(1)
-        for i in range(8):
+        codepoints = [0x41, 0xe9, 0x262d, 0x4e00, 0xac00, 0xfffd, 0x1f600, 0x10ffff]
+        # U+0041 and U+0081 share a cache entry, as do U+4E00, U+AC00 and
+        # U+1F600, so only the other four hit the second time round, unless
+        # the first page is mapped by identity and doesn't use the cache
+        for cp in codepoints + [0x81] + codepoints:
+            yield dut.ctrl.codepoint.eq(cp)
+            yield dut.ctrl.en.eq(1)
             yield Tick()
-        yield dut.flash_ok.eq(1)
-        for i in range(20):
+            yield dut.ctrl.en.eq(0)
+            yield Settle()
+            clocks = 1
+            while not (yield dut.ctrl.valid):
+                yield Tick()
+                yield Settle()
+                clocks += 1
+            glyphid = yield dut.ctrl.glyphid
+            assert glyphid == lookup(cp), f"U+{cp:04X}: got {glyphid:#x}, expected {lookup(cp):#x}"
+            print(f"U+{cp:04X} -> {glyphid:#06x} in {clocks} clocks")
             yield Tick()
-        yield dut.flash_data_valid.eq(1)
-        yield dut.flash_data.eq(42)
-        yield Settle()
-        yield Tick()
-        yield dut.flash_data_valid.eq(0)
-        yield Tick()
-        yield dut.flash_data_valid.eq(1)
-        yield Tick()
-        yield dut.flash_data_valid.eq(0)
-        yield Tick()
-        yield Tick()
-        yield Tick()
+        hits = yield dut.hits
+        misses = yield dut.misses
+        print(f"{hits} hits, {misses} misses")
+        assert (hits, misses) == ((3, 9) if dut.identity else (4, 13))
 
     sim.add_sync_process(proc)
+    sim.add_sync_process(spiflash_model(arb._flashmod.sim_pins, charmap_bin, base=CHARMAP_OFFSET))
     with sim.write_vcd("waves/charmap.vcd"):
         sim.run()
-
-
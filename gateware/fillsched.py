@@ -0,0 +1,354 @@
+from amaranth import *
+from amaranth.lib.wiring import *
+from amaranth.lib.coding import PriorityEncoder
+from signatures import *
+
+__all__ = ["rowFillSig", "fill_deadline", "FillScheduler", "DirtyRows"]
+
+def rowFillSig(timings, deadline=None):
+    """With deadline, the most clocks there are to fill a row, deadline is
+    how many clocks from start the row has to be filled in."""
+    members = {
+        "row": Out(range(timings.rows)),
+        "start": Out(1),
+        "busy": In(1),
+    }
+    if deadline is not None:
+        members["deadline"] = Out(range(deadline + 1))
+    return Signature(members)
+
+def fill_deadline(timings, ahead):
+    """The most clocks from the start of a fill until its row is displayed,
+    filling ahead rows ahead of the display: ahead rows less the lines of
+    the current row already displayed, or in vertical blanking, row ahead - 1
+    of the next frame."""
+    lines = max(16 * ahead, 16 * (ahead - 1) + timings.vtotal - timings.vactive)
+    return lines * timings.htotal + timings.hback
+
+class FillScheduler(Component):
+    """Tells the row filler which text row to fill next, and when.
+
+    The row buffer holds rowbuf_rows text rows, row r in slot r % rowbuf_rows.
+    Fills run back to back up to ahead rows ahead of the row being displayed,
+    so that a slow fill eats into the time of the ones after it rather than
+    showing on screen. Rows 0 to ahead - 1 are filled during vertical
+    blanking. fill.deadline is the clocks from fill.start until fill.row is
+    displayed, at most fill_deadline(timings, ahead).
+
+    underrun is set, and stays set, once a line is displayed from a row that
+    isn't completely filled, and underruns counts those lines. Both start
+    watching after the first frame, the rows of which are never filled in
+    time after a reset."""
+    def __init__(self, timings, *, rowbuf_rows=2, ahead=1):
+        if rowbuf_rows & (rowbuf_rows - 1):
+            raise Exception(f"rowbuf_rows must be a power of 2, not {rowbuf_rows}")
+        if not 0 < ahead < rowbuf_rows:
+            raise Exception(f"ahead must be from 1 to {rowbuf_rows - 1}, not {ahead}")
+        self.timings = timings
+        self.rowbuf_rows = rowbuf_rows
+        self.ahead = ahead
+        super().__init__({
+            "pos": In(videoPosSig(timings)),
+            "fill": Out(rowFillSig(timings, deadline=fill_deadline(timings, ahead))),
+            "underrun": Out(1),
+            "underruns": Out(32),
+        })
+
+    def elaborate(self, platform):
+        m = Module()
+
+        rows = self.timings.rows
+        vctr = self.pos.vctr
+        active = (vctr >= 0) & (vctr < self.timings.vactive)
+        row = vctr >> 4
+        new_frame = (vctr == self.timings.vactive) & (self.pos.hctr == 0)
+        armed = Signal()
+        # rows of this frame that have been, or are being, filled
+        next_row = Signal(range(rows + 1))
+        # start has been given, but busy isn't up yet
+        started = Signal()
+        m.d.sync += started.eq(self.fill.start)
+        filling = started | self.fill.busy
+
+        # the last row that may be filled, without overwriting a row that is
+        # still to be displayed
+        limit = Mux(active, row + self.ahead, self.ahead - 1)
+        m.d.comb += self.fill.row.eq(next_row)
+        # lines from the current one to the first of next_row, which in
+        # vertical blanking is in the next frame
+        lines = Signal(range(-self.timings.vtotal, self.timings.vtotal + 16 * rows))
+        m.d.comb += lines.eq(next_row * 16 - vctr)
+        with m.If(vctr >= self.timings.vactive):
+            m.d.comb += lines.eq(next_row * 16 - vctr + self.timings.vtotal)
+        deadline = lines * self.timings.htotal - self.pos.hctr
+        # a row that is already late has no time left at all
+        m.d.comb += self.fill.deadline.eq(Mux(deadline < 0, 0, deadline))
+        with m.If(~filling & ~new_frame & (next_row < rows) & (next_row <= limit)):
+            m.d.comb += self.fill.start.eq(1)
+            m.d.sync += next_row.eq(next_row + 1)
+        with m.If(new_frame):
+            m.d.sync += next_row.eq(0)
+            m.d.sync += armed.eq(1)
+
+        complete = (row < next_row) & ~(filling & (row == next_row - 1))
+        with m.If(armed & active & (self.pos.hctr == 0) & ~complete):
+            m.d.sync += self.underrun.eq(1)
+            m.d.sync += self.underruns.eq(self.underruns + 1)
+
+        return m
+
+class DirtyRows(Component):
+    """Tells the row filler which text rows to fill into a framebuffer, which
+    keeps every row, so that only the rows that have changed are filled.
+
+    Set mark.en with mark.row when a cell of that row is written, and
+    mark_all when all of them change, as on a scroll. Rows are marked after
+    a reset. A row is unmarked when its fill starts, so that a write while
+    it is being filled has it filled again."""
+    def __init__(self, timings):
+        self.timings = timings
+        super().__init__({
+            "mark": In(Signature({
+                "row": Out(range(timings.rows)),
+                "en": Out(1),
+            })),
+            "mark_all": In(1),
+            "fill": Out(rowFillSig(timings)),
+        })
+
+    def elaborate(self, platform):
+        m = Module()
+
+        rows = self.timings.rows
+        dirty = Signal(rows, reset=(1 << rows) - 1)
+        m.submodules.first = first = PriorityEncoder(rows)
+        m.d.comb += first.i.eq(dirty)
+        started = Signal()
+        m.d.sync += started.eq(self.fill.start)
+        filling = started | self.fill.busy
+
+        m.d.comb += self.fill.row.eq(first.o)
+        with m.If(~filling & ~first.n):
+            m.d.comb += self.fill.start.eq(1)
+            m.d.sync += dirty.bit_select(first.o, 1).eq(0)
+        with m.If(self.mark.en):
+            m.d.sync += dirty.bit_select(self.mark.row, 1).eq(1)
+        with m.If(self.mark_all):
+            m.d.sync += dirty.eq((1 << rows) - 1)
+
+        return m
+
+if __name__ == "__main__":
+    from amaranth.sim import *
+    from vgasync import VGASync
+    from vgatimings import TIMINGS
+
+    # Run two frames with a stand-in row filler that takes fill_clocks for
+    # most rows and slow_clocks for every fifth, and count the underruns in
+    # the second. The deadline of each fill is checked against when its row
+    # is first displayed.
+    timings = TIMINGS["640x480"]
+    frame = timings.htotal * timings.vtotal
+    def simulate(rowbuf_rows, ahead, fill_clocks, slow_clocks):
+        m = Module()
+        m.submodules.vgs = vgs = VGASync(timings)
+        m.submodules.dut = dut = FillScheduler(timings, rowbuf_rows=rowbuf_rows, ahead=ahead)
+        m.d.comb += dut.pos.hctr.eq(vgs.pos.hctr)
+        m.d.comb += dut.pos.vctr.eq(vgs.pos.vctr)
+        clock = Signal(32)
+        m.d.sync += clock.eq(clock + 1)
+        sim = Simulator(m)
+        sim.add_clock(1e-6)
+        filled = []
+        # (row, deadline, clock) of each fill, and the clock each row is shown
+        deadlines = []
+        shown = []
+        def filler():
+            yield Passive()
+            while True:
+                if (yield dut.fill.start):
+                    row = yield dut.fill.row
+                    filled.append(row)
+                    deadlines.append((row, (yield dut.fill.deadline), (yield clock)))
+                    yield Tick()
+                    yield dut.fill.busy.eq(1)
+                    for i in range(slow_clocks if row % 5 == 4 else fill_clocks):
+                        yield Tick()
+                    yield dut.fill.busy.eq(0)
+                yield Tick()
+        def proc():
+            # to the end of the second frame's active lines
+            for i in range(frame + timings.vactive * timings.htotal):
+                vctr, hctr = (yield vgs.pos.vctr), (yield vgs.pos.hctr)
+                if vctr % 16 == 0 and 0 <= vctr < timings.vactive and hctr == 0:
+                    shown.append((vctr // 16, (yield clock)))
+                yield Tick()
+            results.append((yield dut.underruns))
+            print(f"{rowbuf_rows} rows in the row buffer, filling {ahead} ahead, "
+                  f"{fill_clocks} clocks per fill and {slow_clocks} for every fifth: "
+                  f"{results[-1]} underruns")
+            # every row filled once a frame, in order
+            for prev, row in zip(filled, filled[1:]):
+                assert row in (0, prev + 1)
+            assert filled.count(timings.rows - 1) == 2
+            for row, deadline, start in deadlines:
+                # a fill with no time left is of a row already displayed
+                due = [when for shown_row, when in shown if shown_row == row and when >= start]
+                if deadline and due:
+                    assert deadline == due[0] - start, \
+                        f"row {row}: deadline {deadline}, displayed {due[0] - start} clocks on"
+                assert deadline <= fill_deadline(timings, ahead)
+        sim.add_sync_process(filler)
+        sim.add_sync_process(proc)
+        sim.run()
+
+    # Drive a real RowFiller, on a small screen to keep it quick. Row r of its
+    # glyph buffer is all glyph r + 1, and single-wide glyph g in flash is all
+    # bytes g, so each fill shows in the row buffer which row it read and
+    # which slot it wrote.
+    import build.flash_map as flash_map
+    from flasharb import FlashArbiter
+    from flashreader import spiflash_model
+    from rowfiller import RowFiller
+    from vgatimings import Timings
+    small = Timings(25.175, hactive=128, hfront=8, hsync=16, hback=8,
+                    vactive=96, vfront=2, vsync=2, vback=4)
+    def fill_rows(m, fill, rowbuf_rows, proc, *, deadline=None):
+        """Add a RowFiller to m, filling the rows that fill asks for, and run
+        proc(filled) with every fill checked as it ends and appended to
+        filled. With deadline, the fills have the deadlines fill gives."""
+        cols, rows = small.cols, small.rows
+        m.submodules.rowfill = rowfill = RowFiller(small, pools=None, deadline=deadline,
+                                                   rowbuf_rows=rowbuf_rows)
+        if deadline is not None:
+            m.d.comb += rowfill.deadline.eq(fill.deadline)
+        m.submodules.arb = arb = FlashArbiter(rowfill.flash)
+        gbuf = Memory(width=16, depth=rows * cols,
+                      init=[row + 1 for row in range(rows) for col in range(cols)])
+        m.submodules.gbuf_rd = gbuf_rd = gbuf.read_port()
+        rowbuf = Memory(width=8, depth=cols * 16 * rowbuf_rows)
+        m.submodules.rowbuf_wr = rowbuf_wr = rowbuf.write_port()
+        m.d.comb += [
+            gbuf_rd.addr.eq(rowfill.gbuf_rd.row * cols + rowfill.gbuf_rd.col),
+            gbuf_rd.en.eq(rowfill.gbuf_rd.en),
+            rowfill.gbuf_rd.data.eq(gbuf_rd.data),
+            rowfill.char_row.eq(fill.row),
+            rowfill.start_fill.eq(fill.start),
+            fill.busy.eq(rowfill.busy),
+            rowbuf_wr.addr.eq(rowfill.rowbuf_wr.addr),
+            rowbuf_wr.data.eq(rowfill.rowbuf_wr.data),
+            rowbuf_wr.en.eq(rowfill.rowbuf_wr.en),
+        ]
+        # the row asked for, as of the last start
+        started_row = Signal.like(fill.row)
+        with m.If(fill.start):
+            m.d.sync += started_row.eq(fill.row)
+        image = bytes(glyph for glyph in range(rows + 1) for i in range(16))
+
+        sim = Simulator(m)
+        sim.add_clock(1e-6)
+        filled = []
+        def checker():
+            yield Passive()
+            was_busy = False
+            while True:
+                yield Settle()
+                busy = yield rowfill.busy
+                row = yield started_row
+                if busy and (yield rowfill.gbuf_rd.en):
+                    got = yield rowfill.gbuf_rd.row
+                    assert got == row, f"filling row {row}, but reading the glyphs of row {got}"
+                if was_busy and not busy:
+                    slot = row % rowbuf_rows
+                    for i in range(cols * 16):
+                        got = yield rowbuf[slot * cols * 16 + i]
+                        assert got == row + 1, f"row {row}: got {got:#04x} in slot {slot}"
+                    filled.append(row)
+                was_busy = busy
+                yield Tick()
+        def run():
+            yield from proc(filled)
+            if deadline is not None:
+                assert (yield rowfill.deadline_misses) == 0
+        sim.add_sync_process(checker)
+        sim.add_sync_process(run)
+        sim.add_sync_process(spiflash_model(arb._flashmod.sim_pins, image,
+                                            base=flash_map.FONT1_OFFSET))
+        sim.run()
+
+    # FillScheduler: every row filled once a frame, in order, with the
+    # right glyphs and into the right slot, and by its deadline
+    m = Module()
+    m.submodules.vgs = vgs = VGASync(small)
+    m.submodules.sched = sched = FillScheduler(small)
+    connect(m, vgs.pos, sched.pos)
+    def sched_proc(filled):
+        for i in range(2 * small.htotal * small.vtotal):
+            yield Tick()
+        assert filled[:2 * small.rows] == list(range(small.rows)) * 2, filled
+        assert (yield sched.underruns) == 0
+        print(f"FillScheduler drives a RowFiller to fill rows {filled}")
+    fill_rows(m, sched.fill, 2, sched_proc, deadline=fill_deadline(small, 1))
+
+    # DirtyRows into a framebuffer's worth of slots: every row after reset,
+    # then the rows marked, each filled while the next dirty row changes
+    from framebuffer import framebuffer_rows
+    m = Module()
+    m.submodules.dirty = dirty = DirtyRows(small)
+    fill_clocks = 2000
+    def dirty_rows_proc(filled):
+        for i in range(small.rows * fill_clocks):
+            yield Tick()
+        assert filled == list(range(small.rows)), filled
+        filled.clear()
+        for row in (4, 1, 3):
+            yield dirty.mark.row.eq(row)
+            yield dirty.mark.en.eq(1)
+            yield Tick()
+        yield dirty.mark.en.eq(0)
+        for i in range(3 * fill_clocks):
+            yield Tick()
+        assert filled == [4, 1, 3], filled
+        print(f"DirtyRows drives a RowFiller to fill rows {list(range(small.rows))}, "
+              f"then the rows marked, {filled}")
+    fill_rows(m, dirty.fill, framebuffer_rows(small), dirty_rows_proc)
+
+    # DirtyRows: all rows are filled after reset, then only those marked,
+    # and a row marked while it's filled is filled again
+    m = Module()
+    m.submodules.dirty = dirty = DirtyRows(timings)
+    sim = Simulator(m)
+    sim.add_clock(1e-6)
+    def dirty_proc():
+        fills = []
+        def run(clocks, marks={}):
+            for i in range(clocks):
+                if i in marks:
+                    yield dirty.mark.row.eq(marks[i])
+                    yield dirty.mark.en.eq(1)
+                else:
+                    yield dirty.mark.en.eq(0)
+                if (yield dirty.fill.start):
+                    fills.append((yield dirty.fill.row))
+                    yield dirty.fill.busy.eq(1)
+                elif i % 10 == 0:
+                    yield dirty.fill.busy.eq(0)
+                yield Tick()
+        yield from run(timings.rows * 10 + 20)
+        assert fills == list(range(timings.rows))
+        fills.clear()
+        yield from run(100, {1: 17, 2: 5, 15: 5})
+        assert fills == [17, 5, 5], fills
+        print("DirtyRows fills every row after reset, then only the rows written")
+    sim.add_sync_process(dirty_proc)
+    sim.run()
+
+    # fills take a third of a row's time, or for every fifth row, more than
+    # a row's time, which only a row buffer of more than two rows absorbs
+    line16 = timings.htotal * 16
+    results = []
+    simulate(2, 1, line16 // 3, line16 // 3)
+    simulate(2, 1, line16 // 3, line16 * 3 // 2)
+    simulate(4, 3, line16 // 3, line16 * 3 // 2)
+    simulate(4, 3, line16 // 3, line16 * 5 // 2)
+    assert results[0] == 0 and results[1] > 0 and results[2] == 0
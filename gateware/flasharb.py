@@ -5,33 +5,72 @@ from amaranth.lib.wiring import *
 
 def arbClientSig(clientSig):
     return Signature({
-        "request": Out(1),
-        "ok":      In(1),
-        "client":  Out(clientSig),
+        "request":   Out(1),
+        "ok":        In(1),
+        # another client is waiting for the flash and would get it: a client
+        # holding it for several reads can hand it over between them
+        "contended": In(1),
+        "client":    Out(clientSig),
     })
 
 class FlashArbiter(Elaboratable):
-    def __init__(self, *clients):
+    """Grants the flash to one client at a time, and a client keeps it until
+    it drops request. Without slack, the first client requesting in the
+    order given wins.
+
+    With slack, the first client has a deadline, and slack is how many
+    clocks it can still wait for the flash and meet it. The other clients
+    then go first, but are only granted the flash while slack is at least
+    lease, the most clocks any of them holds it for. So the first client is
+    never held up for longer than it can afford, and the others are granted
+    the flash as soon as the first one has time to spare, or at the latest
+    when it is done.
+
+    wait_cycles counts, for each client, the clocks it has spent requesting
+    the flash without having it."""
+    def __init__(self, *clients, xip=False, qpi=False, slack=None, lease=0):
         self.clients = clients
-        self._flashmod = FlashReader(4)
+        self.slack = slack
+        self.lease = lease
+        self.wait_cycles = [Signal(32, name=f"wait_cycles{i}") for i in range(len(clients))]
+        self._flashmod = FlashReader(4, xip=xip, qpi=qpi)
+
+    def priority(self):
+        """The client numbers, the one that wins first."""
+        order = list(range(len(self.clients)))
+        if self.slack is not None:
+            order = order[1:] + order[:1]
+        return order
+
+    def grantable(self, i):
+        """Whether client i can be granted the flash now, if it requests it."""
+        if self.slack is None or i == 0:
+            return self.clients[i].request
+        return self.clients[i].request & (self.slack >= self.lease)
 
     def elaborate(self, platform):
         m = Module()
 
         fmreset = Signal(reset=1)
         m.submodules.flashmod = flashmod = ResetInserter(fmreset)(self._flashmod)
-        for c in self.clients:
+        for c, waits in zip(self.clients, self.wait_cycles):
             m.d.comb += c.ok.eq(0)
+            m.d.comb += c.contended.eq(0)
+            with m.If(c.request & ~c.ok):
+                m.d.sync += waits.eq(waits + 1)
 
+        order = self.priority()
         with m.FSM():
             with m.State("IDLE"):
-                for i, c in reversed(list(enumerate(self.clients))):
-                    with m.If(c.request):
+                for i in reversed(order):
+                    with m.If(self.grantable(i)):
                         m.next = "CLIENT" + str(i)
 
             for i, c in enumerate(self.clients):
                 with m.State("CLIENT" + str(i)):
                     m.d.comb += c.ok.eq(1)
+                    m.d.comb += c.contended.eq(
+                        Cat(self.grantable(j) for j in order[:order.index(i)]).any())
                     m.d.comb += fmreset.eq(0)
                     connect(m, c.client, flashmod)
                     with m.If(~c.request):
@@ -9,6 +9,18 @@ DUAL_IO_READ = 0xBB
 QUAD_IO_READ = 0xEB
 QUAD_OUTPUT_READ = 0x6B
 
+# Commands to switch the flash to QPI mode, where commands are sent on all
+# four lines too, and to set the number of dummy clocks of QPI reads, in
+# which the mode bits count. 0x20 makes it 6, as for quad I/O reads in SPI mode.
+ENABLE_QPI = 0x38
+SET_READ_PARAMS = 0xC0
+QPI_READ_PARAMS = 0x20
+
+# Mode bits sent after the address of a quad I/O read. 0xAx keeps the flash in
+# continuous read mode, where the next read starts with the address, without
+# a command. Anything else ends it.
+XIP_MODE = 0xA0
+
 __all__ = ["flashReaderSig", "FlashReader"]
 
 def flashReaderSig():
@@ -21,11 +33,28 @@ def flashReaderSig():
     })
 
 class FlashReader(Component):
+    """With xip set, quad I/O reads leave the flash in continuous read mode,
+    so that later reads skip the command. A read also doesn't end when its
+    last byte is in: CS is kept low with the clock stopped, and if the next
+    read starts at the address right after it, the flash just carries on,
+    without command, address or dummy clocks. Nothing ends continuous read
+    mode, so the FPGA can't reconfigure itself from flash until the flash is
+    power cycled, like with QPI mode below.
+
+    With qpi set, the first read puts the flash in QPI mode, where commands
+    take 2 clocks instead of 8. The flash stays in QPI mode until it's power
+    cycled, which the FPGA's own configuration from flash needs too."""
     COMMANDS = {1: READ_ARRAY, 2: DUAL_IO_READ, 4: QUAD_IO_READ}
-    def __init__(self, width=1):
+    def __init__(self, width=1, *, xip=False, qpi=False):
         if width not in (1,2,4):
             raise Exception(f"invalid width {width}")
+        if (xip or qpi) and width != 4:
+            raise Exception("continuous reads and QPI need quad I/O")
         self.width = width
+        self.xip = xip
+        self.qpi = qpi
+        # stand-in pins when simulating, see spiflash_model()
+        self.sim_pins = DummySPI(width)
         super().__init__(flashReaderSig().flip())
         # how to use: set read_trigger to 1 and addr to desired address.
         # once the SPI starts talking, read data_out when valid is high
@@ -37,14 +66,19 @@ class FlashReader(Component):
         if platform is not None:
             spipins = platform.request(f"spi_flash_{self.width}x", 0)
         else:
-            spipins = DummySPI(self.width)
+            spipins = self.sim_pins
 
         # BASIC THEORY OF OPERATION
         # the SPI flash reads data on the rising edge, we can change it on the falling edge.
         # we use the inverted clock as the SPI clock, gated by CS.
+        # With hold set, the clock is stopped between reads of a continued
+        # transaction.
         cs = Signal()
-        m.d.comb += spipins.clk.o.eq(cs & ~ClockSignal("sync"))
+        hold = Signal()
+        m.d.comb += spipins.clk.o.eq(cs & ~hold & ~ClockSignal("sync"))
         m.d.comb += spipins.cs.o.eq(cs)
+        if platform is None:
+            m.d.comb += spipins.clk_en.eq(cs & ~hold)
 
         # Now we have a state machine. We start with basic SPI mode. We count on the icepack
         # option to disable the SPI flash sleep mode.
@@ -54,23 +88,50 @@ class FlashReader(Component):
         addr_latched = Signal(24)
         size_latched = Signal(16)
 
+        # Whether the flash is in continuous read mode. This outlives the
+        # resets of the flash arbiter, as the flash stays in that mode.
+        continuous = Signal(reset_less=True)
+        # Whether the flash is in QPI mode, likewise.
+        qpi_mode = Signal(reset_less=True)
+        # where the current transaction would carry on from
+        next_addr = Signal(24)
+
         shiftreg = Signal(24)
         m.d.comb += self.data.eq(shiftreg)
+
+        def start(m, addr):
+            # later assignments take precedence
+            m.d.sync += cs.eq(1)
+            m.d.sync += ctr.eq(4 if self.qpi else 7)
+            m.d.sync += shiftreg.eq(self.COMMANDS[self.width])
+            m.next = "WRITECMD"
+            if self.xip:
+                with m.If(continuous):
+                    m.d.sync += ctr.eq(28)
+                    m.d.sync += shiftreg.eq(addr)
+                    m.next = "WRITEADDR"
+            if self.qpi:
+                with m.If(~qpi_mode):
+                    m.d.sync += ctr.eq(7)
+                    m.d.sync += shiftreg.eq(ENABLE_QPI)
+                    m.next = "QPI_ENABLE"
+
         with m.FSM():
             with m.State("IDLE"):
                 with m.If(self.read_trigger):
-                    m.d.sync += cs.eq(1)
-                    m.d.sync += ctr.eq(7)
                     m.d.sync += addr_latched.eq(self.addr)
                     m.d.sync += size_latched.eq(self.read_size)
-                    m.d.sync += shiftreg.eq(self.COMMANDS[self.width])
-                    m.next = "WRITECMD"
+                    m.d.sync += next_addr.eq(self.addr + self.read_size)
+                    start(m, self.addr)
                 with m.Else():
                     m.d.sync += cs.eq(0)
 
             with m.State("WRITECMD"):
                 if self.width == 1:
                     m.d.comb += spipins.copi.o.eq(shiftreg[7])
+                elif self.qpi:
+                    m.d.comb += spipins.dq.oe.eq(0b1111)
+                    m.d.comb += spipins.dq.o.eq(shiftreg[4:8])
                 else:
                     m.d.comb += spipins.dq.oe[0].eq(1)
                     m.d.comb += spipins.dq.o[0].eq(shiftreg[7])
@@ -82,8 +143,9 @@ class FlashReader(Component):
                     m.d.sync += shiftreg.eq(addr_latched)
                     m.next = "WRITEADDR"
                 with m.Else():
-                    m.d.sync += shiftreg.eq(shiftreg << 1)
-                    m.d.sync += ctr.eq(ctr - 1)
+                    cmdbits = 4 if self.qpi else 1
+                    m.d.sync += shiftreg.eq(shiftreg << cmdbits)
+                    m.d.sync += ctr.eq(ctr - cmdbits)
 
             with m.State("WRITEADDR"):
                 if self.width == 1:
@@ -91,6 +153,13 @@ class FlashReader(Component):
                 else:
                     m.d.comb += spipins.dq.oe.eq(Const(1).replicate(self.width))
                     m.d.comb += spipins.dq.o.eq(shiftreg[24-self.width:24])
+                if self.xip:
+                    # the last two clocks are the mode bits
+                    with m.If(ctr == 4):
+                        m.d.comb += spipins.dq.o.eq(XIP_MODE >> 4)
+                    with m.If(ctr == 0):
+                        m.d.comb += spipins.dq.o.eq(XIP_MODE & 0xf)
+                        m.d.sync += continuous.eq(1)
                 with m.If(ctr == 0):
                     if self.width == 4:
                         m.d.sync += ctr.eq(12)
@@ -118,12 +187,65 @@ class FlashReader(Component):
                     m.d.sync += ctr.eq(8 - self.width)
                     m.d.sync += size_latched.eq(size_latched - 1)
                     m.d.sync += self.valid.eq(1)
+                    if self.xip:
+                        # stop the clock right after the last byte
+                        with m.If(size_latched == 1):
+                            m.d.sync += hold.eq(1)
+                            m.next = "HOLD"
                 with m.Else():
                     m.d.sync += self.valid.eq(0)
                 with m.If(size_latched == 0):
                     m.d.sync += cs.eq(0)
                     m.next = "IDLE"
 
+            if self.xip:
+                with m.State("HOLD"):
+                    m.d.sync += self.valid.eq(0)
+                    with m.If(self.read_trigger):
+                        m.d.sync += addr_latched.eq(self.addr)
+                        m.d.sync += size_latched.eq(self.read_size)
+                        m.d.sync += next_addr.eq(self.addr + self.read_size)
+                        with m.If(self.addr == next_addr):
+                            # carry on where the last read stopped
+                            m.d.sync += hold.eq(0)
+                            m.next = "DATAREAD"
+                        with m.Else():
+                            # end the transaction for a new one
+                            m.d.sync += cs.eq(0)
+                            m.d.sync += hold.eq(0)
+                            m.next = "RESTART"
+
+            if self.xip or self.qpi:
+                with m.State("RESTART"):
+                    start(m, addr_latched)
+
+            if self.qpi:
+                # the enable command is sent in SPI mode, the rest in QPI mode
+                with m.State("QPI_ENABLE"):
+                    m.d.comb += spipins.dq.oe[0].eq(1)
+                    m.d.comb += spipins.dq.o[0].eq(shiftreg[7])
+                    m.d.sync += shiftreg.eq(shiftreg << 1)
+                    m.d.sync += ctr.eq(ctr - 1)
+                    with m.If(ctr == 0):
+                        m.d.sync += cs.eq(0)
+                        m.next = "QPI_GAP"
+
+                with m.State("QPI_GAP"):
+                    m.d.sync += cs.eq(1)
+                    m.d.sync += ctr.eq(12)
+                    m.d.sync += shiftreg.eq(((SET_READ_PARAMS << 8) | QPI_READ_PARAMS) << 8)
+                    m.next = "QPI_PARAMS"
+
+                with m.State("QPI_PARAMS"):
+                    m.d.comb += spipins.dq.oe.eq(0b1111)
+                    m.d.comb += spipins.dq.o.eq(shiftreg[20:24])
+                    m.d.sync += shiftreg.eq(shiftreg << 4)
+                    m.d.sync += ctr.eq(ctr - 4)
+                    with m.If(ctr == 0):
+                        m.d.sync += cs.eq(0)
+                        m.d.sync += qpi_mode.eq(1)
+                        m.next = "RESTART"
+
         return m
 
 class DummyPin():
@@ -136,6 +258,8 @@ class DummySPI():
   def __init__(self, width=1):
     self.cs   = DummyPin( 'cs' )
     self.clk  = DummyPin( 'clk' )
+    # whether clk is running, which the simulated flash can't tell from clk
+    self.clk_en = Signal( name = 'clk_en' )
     if width == 1:
         self.copi = DummyPin( 'copi' )
         self.cipo = DummyPin( 'cipo' )
@@ -144,6 +268,70 @@ class DummySPI():
 
 from amaranth.sim import *
 
+def spiflash_model(spipins, image, *, base=0, width=4):
+    """Simulation process standing in for the SPI flash on a DummySPI. It
+    decodes the command and address clocked out on the pins and plays back
+    the contents of image, which is mapped at flash address base, with 0xff
+    everywhere else. Quad I/O reads with XIP_MODE mode bits put it in
+    continuous read mode, where reads start with the address, and
+    ENABLE_QPI puts it in QPI mode."""
+    # clocks of address, and of mode + dummy bits, for each read command
+    addr_clocks = 24 // width
+    dummy_clocks = {1: 8, 2: 4, 4: 6}[width]
+    def byte_at(addr):
+        addr &= 0xffffff
+        if base <= addr < base + len(image):
+            return image[addr - base]
+        return 0xff
+
+    def proc():
+        yield Passive()
+        continuous = qpi = False
+        clock = cmd = addr = mode = 0
+        while True:
+            yield Tick()
+            yield Settle()
+            cmd_clocks = 2 if qpi else 8
+            if not (yield spipins.cs.o):
+                # in continuous read mode, the command is skipped
+                clock = cmd_clocks if continuous else 0
+                cmd = FlashReader.COMMANDS[width] if continuous else 0
+                addr = mode = 0
+                continue
+            if not (yield spipins.clk_en):
+                continue
+            if width == 1:
+                dq = (yield spipins.copi.o)
+            else:
+                dq = (yield spipins.dq.o)
+            if clock < cmd_clocks:
+                if qpi:
+                    cmd = (cmd << 4) | dq
+                else:
+                    cmd = (cmd << 1) | (dq & 1)
+                if clock == cmd_clocks - 1 and cmd == ENABLE_QPI:
+                    qpi = True
+            elif cmd == SET_READ_PARAMS:
+                assert qpi, "read parameters set outside QPI mode"
+            elif clock < cmd_clocks + addr_clocks:
+                assert cmd == FlashReader.COMMANDS[width], f"bad flash command {cmd:#x}"
+                addr = (addr << width) | dq
+            elif clock < cmd_clocks + addr_clocks + 2 and width == 4:
+                mode = (mode << 4) | dq
+                if clock == cmd_clocks + addr_clocks + 1:
+                    continuous = (mode & 0x30) == (XIP_MODE & 0x30)
+            elif clock >= cmd_clocks + addr_clocks + dummy_clocks:
+                # shift out data, MSB first
+                bitpos = (clock - cmd_clocks - addr_clocks - dummy_clocks) * width
+                byte = byte_at(addr + bitpos // 8)
+                nibble = (byte >> (8 - width - bitpos % 8)) & ((1 << width) - 1)
+                if width == 1:
+                    yield spipins.cipo.i.eq(nibble)
+                else:
+                    yield spipins.dq.i.eq(nibble)
+            clock += 1
+    return proc
+
 def test_spiflash(dut, clocks):
     yield dut.addr.eq(0x50000)
     yield dut.read_size.eq(16)
@@ -165,6 +353,14 @@ def test_spiflash(dut, clocks):
 # QSPI needs 1 clk CS, 8 clk cmd, 6 clk address, 2 clk mode, 4 clk dummy, 32 clk data
 # 80 * (1 + 8 + 6 + 2 + 4 + 32 + 1) = 3680 clks. Excellent. We have 9120 clks free.
 
+# With continuous reads (xip), only the first read sends the command:
+# 80 * (1 + 6 + 2 + 4 + 32 + 1) = 3680 - 640 = 3040 clks. A read that starts where
+# the last one stopped only needs its 32 data clks.
+
+# QPI sends the command in 2 clks instead of 8:
+# 80 * (1 + 2 + 6 + 2 + 4 + 32 + 1) = 3840 - 480 = 3200 clks, which matters when
+# continuous reads can't be used.
+
 def simulate_width(width):
     dut = FlashReader(width)
     print(f"Simulating {width}")
@@ -176,9 +372,51 @@ def simulate_width(width):
     with sim.write_vcd(f"waves/flashreader{width}.vcd"):
         sim.run()
 
+def simulate_reads(**modes):
+    """Count the clocks from read_trigger to the last byte of 16 and 32
+    byte reads, as for a single-wide and a double-wide glyph, after a first
+    read that puts the flash into the mode."""
+    dut = FlashReader(4, **modes)
+    image = bytes(range(256)) * 8
+    sim = Simulator(dut)
+    sim.add_clock(40e-9)
+    clocks = {}
+    def read(addr, size):
+        yield dut.addr.eq(addr)
+        yield dut.read_size.eq(size)
+        yield dut.read_trigger.eq(1)
+        got = bytearray()
+        count = 0
+        while len(got) < size:
+            yield Tick()
+            yield Settle()
+            yield dut.read_trigger.eq(0)
+            count += 1
+            if (yield dut.valid):
+                got.append((yield dut.data))
+        assert got == image[addr:addr + size], f"read {addr:#x}: got {got.hex()}"
+        yield Tick()
+        return count
+    def proc():
+        clocks["first"] = yield from read(0x100, 16)
+        clocks[16] = yield from read(0x200, 16)
+        clocks[32] = yield from read(0x300, 32)
+        clocks["following 32"] = yield from read(0x320, 32)
+    sim.add_sync_process(proc)
+    sim.add_sync_process(spiflash_model(dut.sim_pins, image))
+    with sim.write_vcd(f"waves/flashreader_{'_'.join(modes) or 'quad'}.vcd"):
+        sim.run()
+    return clocks
 
 if __name__ == "__main__":
     simulate_width(1)
     simulate_width(2)
     simulate_width(4)
+    print("clocks per read:")
+    for name, modes in [("quad I/O", {}), ("QPI", {"qpi": True}),
+                        ("quad I/O continuous", {"xip": True}),
+                        ("QPI continuous", {"qpi": True, "xip": True})]:
+        clocks = simulate_reads(**modes)
+        print(f" {name:20}  first {clocks['first']:3}, 16 bytes {clocks[16]:3}, "
+              f"32 bytes {clocks[32]:3}, following 32 bytes {clocks['following 32']:3}")
 
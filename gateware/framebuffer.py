@@ -0,0 +1,191 @@
+from amaranth import *
+from amaranth.lib.wiring import *
+from amaranth.lib.fifo import SyncFIFO
+from signatures import *
+
+__all__ = ["framebuffer_rows", "FrameBuffer"]
+
+# Words in one SB_SPRAM256KA
+SPRAM_WORDS = 16384
+
+def framebuffer_rows(timings):
+    """Text rows in the framebuffer: all of them, rounded up to a power of 2,
+    so that it is addressed like a row buffer, see RowFiller."""
+    return 1 << (timings.rows - 1).bit_length()
+
+class FrameBuffer(Component):
+    """The pixels of the whole screen, at 1 bit per pixel, in SPRAM on the
+    UP5K, laid out like the row buffer with a slot for every text row. The
+    row filler writes it and VideoOut reads it, as they would the row buffer.
+
+    SPRAM has a single port, which reads are given first, but VideoOut only
+    needs one 16 bit word per 16 pixels, so the reads take one clock in 16.
+    Writes go through a FIFO of write_depth bytes, which is drained in the
+    other clocks. The row filler writes at most a byte a clock, and at most
+    32 bytes in 35 clocks, copying a double-wide from the glyph cache, so it
+    never gets more than a few bytes ahead.
+    """
+    def __init__(self, timings, *, write_depth=4):
+        self.timings = timings
+        self.write_depth = write_depth
+        self.size = timings.cols * 16 * framebuffer_rows(timings)
+        super().__init__({
+            "read": Out(Signature({
+                "addr": In(range(self.size)),
+                "en": In(1),
+                "data": Out(8),
+            })),
+            "write": In(memWriterSig(addrbits=range(self.size), databits=8)),
+        })
+
+    def elaborate(self, platform):
+        m = Module()
+
+        abits = len(self.read.addr)
+        m.submodules.pending = pending = SyncFIFO(width=abits + 8, depth=self.write_depth)
+        m.d.comb += [
+            pending.w_data.eq(Cat(self.write.addr, self.write.data)),
+            pending.w_en.eq(self.write.en),
+        ]
+        wr_addr = pending.r_data[:abits]
+        wr_data = pending.r_data[abits:]
+
+        # read a word when VideoOut moves on to it
+        last_word = Signal(abits - 1)
+        last_valid = Signal()
+        fetch = Signal()
+        m.d.comb += fetch.eq(self.read.en &
+                             ~(last_valid & (self.read.addr[1:] == last_word)))
+        m.d.sync += [
+            last_valid.eq(self.read.en),
+            last_word.eq(self.read.addr[1:]),
+        ]
+        wren = Signal()
+        m.d.comb += [
+            wren.eq(~fetch & pending.r_rdy),
+            pending.r_en.eq(wren),
+        ]
+        word_addr = Mux(fetch, self.read.addr[1:], wr_addr[1:])
+        byte_en = Mux(wr_addr[0], 0b10, 0b01)
+
+        dataout = Signal(16)
+        if platform and platform.device == "iCE40UP5K":
+            banks = -(-self.size // 2 // SPRAM_WORDS)
+            assert banks <= 3, "the glyph buffer needs the fourth SPRAM"
+            bank = word_addr[14:]
+            bank_d = Signal.like(bank)
+            m.d.sync += bank_d.eq(bank)
+            bank_out = [Signal(16, name=f"dataout{i}") for i in range(banks)]
+            for i in range(banks):
+                m.submodules[f"spram{i}"] = Instance("SB_SPRAM256KA",
+                    i_ADDRESS = word_addr[:14],
+                    i_DATAIN = Cat(wr_data, wr_data),
+                    i_MASKWREN = Cat(byte_en[0], byte_en[0], byte_en[1], byte_en[1]),
+                    i_WREN = wren,
+                    i_CHIPSELECT = bank == i,
+                    i_CLOCK = ClockSignal("sync"),
+                    i_STANDBY = Const(0),
+                    i_SLEEP = Const(0),
+                    i_POWEROFF = Const(1),
+                    o_DATAOUT = bank_out[i],
+                )
+            m.d.comb += dataout.eq(Array(bank_out)[bank_d])
+        else:
+            mem = Memory(width=16, depth=-(-self.size // 2))
+            m.submodules.mem_rd = mem_rd = mem.read_port(transparent=False)
+            m.submodules.mem_wr = mem_wr = mem.write_port(granularity=8)
+            m.d.comb += [
+                mem_rd.addr.eq(word_addr),
+                mem_rd.en.eq(fetch),
+                mem_wr.addr.eq(word_addr),
+                mem_wr.data.eq(Cat(wr_data, wr_data)),
+                mem_wr.en.eq(Mux(wren, byte_en, 0)),
+                dataout.eq(mem_rd.data),
+            ]
+
+        # the word read comes out the clock after, and is kept for its
+        # second byte
+        fetched = Signal()
+        odd = Signal()
+        word = Signal(16)
+        m.d.sync += [
+            fetched.eq(fetch),
+            odd.eq(self.read.addr[0]),
+        ]
+        with m.If(fetched):
+            m.d.sync += word.eq(dataout)
+        current = Mux(fetched, dataout, word)
+        m.d.comb += self.read.data.eq(Mux(odd, current[8:], current[:8]))
+
+        return m
+
+if __name__ == "__main__":
+    import random
+    from amaranth.sim import *
+    from vgatimings import TIMINGS
+
+    # Scan the first text row out as VideoOut does, a byte per 8 clocks,
+    # while the others are written as fast as the row filler writes from the
+    # glyph cache, 32 bytes in 35 clocks, and check everything read.
+    timings = TIMINGS["640x480"]
+    row_size = timings.cols * 16
+    dut = FrameBuffer(timings)
+    sim = Simulator(dut)
+    sim.add_clock(1e-6)
+    rng = random.Random(1)
+    contents = {}
+    state = {"row 0 written": False, "scanned": False}
+
+    def write_bursts(addrs):
+        addrs = iter(addrs)
+        while not state["scanned"]:
+            for i in range(32):
+                addr = next(addrs, None)
+                if addr is None:
+                    yield dut.write.en.eq(0)
+                    return
+                contents[addr] = rng.randrange(256)
+                yield dut.write.addr.eq(addr)
+                yield dut.write.data.eq(contents[addr])
+                yield dut.write.en.eq(1)
+                yield Tick()
+            yield dut.write.en.eq(0)
+            for i in range(3):
+                yield Tick()
+        yield dut.write.en.eq(0)
+
+    def writer():
+        yield from write_bursts(range(row_size))
+        state["row 0 written"] = True
+        yield from write_bursts(iter(lambda: rng.randrange(row_size, dut.size), None))
+
+    def scan(addrs):
+        for addr in addrs:
+            yield dut.read.addr.eq(addr)
+            yield dut.read.en.eq(1)
+            yield Tick()
+            yield Settle()
+            got = yield dut.read.data
+            assert got == contents[addr], f"{addr:#x}: got {got:#04x}, expected {contents[addr]:#04x}"
+            for i in range(7):
+                yield Tick()
+        yield dut.read.en.eq(0)
+
+    def reader():
+        while not state["row 0 written"]:
+            yield Tick()
+        # let the last writes land
+        for i in range(dut.write_depth):
+            yield Tick()
+        yield from scan(range(row_size))
+        state["scanned"] = True
+        for i in range(dut.write_depth + 1):
+            yield Tick()
+        written = sorted(addr for addr in contents if addr >= row_size)
+        yield from scan(written)
+        print(f"scanned {row_size} bytes while {len(written)} others were written, "
+              f"and read those back")
+
+    sim.add_sync_process(writer)
+    sim.add_sync_process(reader)
+    sim.run()
@@ -2,6 +2,13 @@ from amaranth import *
 from amaranth.lib.wiring import *
 
 class GlyphBuffer(Component):
+    """The glyph ids of the text on screen. Rows are addressed through a
+    table of the physical row of each logical row, for both reads and
+    writes, so that scrolling only rotates the table.
+
+    Setting scroll.up for a clock moves rows scroll.top + 1 to scroll.bottom
+    up a row, and row scroll.top to scroll.bottom, which is then cleared
+    by writing it. scroll.down does the opposite."""
     def __init__(self, timings):
         self.timings = timings
         super().__init__({
@@ -18,7 +25,12 @@ class GlyphBuffer(Component):
                 "data": In(16),
                 "ack": Out(1),
             })),
-            "scroll_offset": In(range(timings.cols)),
+            "scroll": Out(Signature({
+                "top": In(range(timings.rows)),
+                "bottom": In(range(timings.rows)),
+                "up": In(1),
+                "down": In(1),
+            })),
         })
 
     def elaborate(self, platform):
@@ -30,8 +42,26 @@ class GlyphBuffer(Component):
         memsize = (1 << self.read.row.width) * (1 << self.read.col.width)
         real_read_row = Signal.like(self.read.row)
         real_write_row = Signal.like(self.write.row)
-        m.d.comb += real_read_row.eq((self.read.row + self.scroll_offset))
-        m.d.comb += real_write_row.eq((self.write.row + self.scroll_offset))
+        rows = self.timings.rows
+        remap = Array(Signal(range(rows), reset=i, name=f"remap{i}") for i in range(rows))
+        top = self.scroll.top
+        bottom = self.scroll.bottom
+        with m.If(self.scroll.up):
+            for i in range(rows):
+                with m.If(i == bottom):
+                    m.d.sync += remap[i].eq(remap[top])
+                if i < rows - 1:
+                    with m.Elif((i >= top) & (i < bottom)):
+                        m.d.sync += remap[i].eq(remap[i + 1])
+        with m.Elif(self.scroll.down):
+            for i in range(rows):
+                with m.If(i == top):
+                    m.d.sync += remap[i].eq(remap[bottom])
+                if i > 0:
+                    with m.Elif((i > top) & (i <= bottom)):
+                        m.d.sync += remap[i].eq(remap[i - 1])
+        m.d.comb += real_read_row.eq(remap[self.read.row])
+        m.d.comb += real_write_row.eq(remap[self.write.row])
         m.d.comb += self.read.data.eq(mem_dataout)
 
         if platform and platform.device == "iCE40UP5K":
@@ -0,0 +1,126 @@
+from amaranth import *
+from amaranth.lib.wiring import *
+
+__all__ = ["glyphCacheSig", "GlyphCache"]
+
+# Bytes per cache line: the 16 rows of a glyph, with the left and right halves
+# of each row of a double-wide in turn.
+LINE_SIZE = 32
+
+def glyphCacheSig():
+    return Signature({
+        "glyphid": Out(16),
+        "probe": Out(1),
+        "hit": In(1),
+        "allocate": Out(1),
+        "wr_offset": Out(range(LINE_SIZE)),
+        "wr_data": Out(8),
+        "wr_en": Out(1),
+        "rd_offset": Out(range(LINE_SIZE)),
+        "rd_data": In(8),
+    })
+
+class GlyphCache(Component):
+    """A set-associative cache of glyph bitmaps in block RAM, tagged by glyph
+    id, so that the row filler only goes to flash for glyphs it hasn't drawn
+    recently.
+
+    how to use: set glyphid and probe for a clock. On the next clock, hit is
+    valid. On a hit, read the glyph from the line with rd_offset, rd_data
+    follows a clock later. On a miss, set allocate in that same clock to
+    claim a line for the glyph, then write it with wr_offset, wr_data and
+    wr_en as it comes from flash.
+
+    Within a set, a hit moves the victim pointer off the way that hit, and
+    allocating moves it on to the next way, which for two ways is LRU.
+    hits and misses count probes since reset.
+    """
+    def __init__(self, *, sets=32, ways=2):
+        if sets & (sets - 1) or ways & (ways - 1):
+            raise Exception(f"sets and ways must be powers of 2, not {sets}, {ways}")
+        self.sets = sets
+        self.ways = ways
+        super().__init__({
+            "client": In(glyphCacheSig()),
+            "hits": Out(32),
+            "misses": Out(32),
+        })
+
+    def elaborate(self, platform):
+        m = Module()
+
+        setbits = (self.sets - 1).bit_length()
+        waybits = (self.ways - 1).bit_length()
+        tagbits = 16 - setbits
+        # one word per set: a valid bit and tag for each way, then the victim
+        entry = tagbits + 1
+        tags = Memory(width=entry * self.ways + waybits, depth=self.sets)
+        m.submodules.tags_rd = tags_rd = tags.read_port(transparent=False)
+        m.submodules.tags_wr = tags_wr = tags.write_port()
+        data = Memory(width=8, depth=self.sets * self.ways * LINE_SIZE)
+        m.submodules.data_rd = data_rd = data.read_port(transparent=False)
+        m.submodules.data_wr = data_wr = data.write_port()
+
+        tag = Signal(tagbits)
+        cur_set = Signal(setbits)
+        cur_way = Signal(waybits)
+        probed = Signal()
+        filling = Signal()
+        m.d.sync += probed.eq(self.client.probe)
+        with m.If(self.client.probe):
+            m.d.sync += [
+                tag.eq(self.client.glyphid[setbits:]),
+                cur_set.eq(self.client.glyphid[:setbits]),
+                filling.eq(0),
+            ]
+        m.d.comb += [
+            tags_rd.addr.eq(self.client.glyphid[:setbits]),
+            tags_rd.en.eq(self.client.probe),
+            tags_wr.addr.eq(cur_set),
+            tags_wr.data.eq(tags_rd.data),
+        ]
+
+        victim = tags_rd.data[entry * self.ways:]
+        hit = Signal()
+        hit_way = Signal(waybits)
+        for way in range(self.ways):
+            valid = tags_rd.data[entry * way]
+            way_tag = tags_rd.data[entry * way + 1:entry * (way + 1)]
+            with m.If(valid & (way_tag == tag)):
+                m.d.comb += hit.eq(1)
+                m.d.comb += hit_way.eq(way)
+        m.d.comb += self.client.hit.eq(hit)
+
+        with m.If(probed):
+            with m.If(hit):
+                m.d.sync += self.hits.eq(self.hits + 1)
+                m.d.sync += cur_way.eq(hit_way)
+                if self.ways > 1:
+                    with m.If(victim == hit_way):
+                        m.d.comb += tags_wr.data[entry * self.ways:].eq(hit_way + 1)
+                        m.d.comb += tags_wr.en.eq(1)
+            with m.Else():
+                m.d.sync += self.misses.eq(self.misses + 1)
+                with m.If(self.client.allocate):
+                    m.d.sync += cur_way.eq(victim)
+                    m.d.sync += filling.eq(1)
+                    with m.Switch(victim):
+                        for way in range(self.ways):
+                            with m.Case(way):
+                                m.d.comb += tags_wr.data[entry * way:entry * (way + 1)].eq(
+                                    Cat(1, tag))
+                    if self.ways > 1:
+                        m.d.comb += tags_wr.data[entry * self.ways:].eq(victim + 1)
+                    m.d.comb += tags_wr.en.eq(1)
+
+        line = Cat(cur_way, cur_set)
+        m.d.comb += [
+            data_rd.addr.eq(Cat(self.client.rd_offset, line)),
+            data_rd.en.eq(1),
+            self.client.rd_data.eq(data_rd.data),
+            data_wr.addr.eq(Cat(self.client.wr_offset, line)),
+            data_wr.data.eq(self.client.wr_data),
+            data_wr.en.eq(self.client.wr_en & filling),
+        ]
+
+        return m
@@ -1,8 +1,10 @@
 from amaranth import *
 from amaranth.lib.wiring import *
+from amaranth.lib.coding import PriorityEncoder
 from signatures import *
 from flashreader import flashReaderSig
 from flasharb import arbClientSig
+from glyphcache import glyphCacheSig
 
 import build.flash_map as flash_map
 assert ((flash_map.FONT1_SIZE - 1) & flash_map.FONT1_OFFSET) == 0
@@ -10,11 +12,43 @@ FONT1_MASK = 0x1ffff
 assert ((flash_map.FONT2_SIZE - 1) & flash_map.FONT2_OFFSET) == 0
 FONT2_MASK = 0x1fffff
 
+# Glyph pools of compressed fonts, see font/build_font.py. Each pool is
+# (first glyph index, non-empty rows per glyph, stride, flash address).
+FONT_POOLS = getattr(flash_map, "FONT_POOLS", None)
+
+# The most clocks filling one column takes, reading a single-wide from flash
+# without a continuous read to carry on from, for estimating the work left.
+COL_CLOCKS = 64
+
 class RowFiller(Component):
-    def __init__(self, timings):
+    """Fills the row buffer with the glyphs of a text row, from flash. With
+    cache set, glyphs are first looked up in a GlyphCache connected to the
+    cache port, and only the misses are read from flash, which is then only
+    requested from the arbiter once the first miss needs it.
+
+    A row has to be filled by the time it is displayed. With deadline set to
+    the most clocks a fill is given, the deadline input, taken with
+    start_fill, is how many clocks away that is. slack is how many clocks
+    the fill can still wait for the flash and make it, allowing COL_CLOCKS
+    for each column left. deadline_misses counts the fills that weren't
+    done in time. While another client is waiting for the flash, it's
+    handed over after each glyph.
+
+    The row buffer holds rowbuf_rows text rows, a power of 2, and char_row
+    goes in slot char_row % rowbuf_rows. char_row is taken with start_fill,
+    and can change during the fill."""
+    def __init__(self, timings, *, pools=FONT_POOLS, cache=False, deadline=None,
+                 rowbuf_rows=2):
+        if rowbuf_rows & (rowbuf_rows - 1):
+            raise Exception(f"rowbuf_rows must be a power of 2, not {rowbuf_rows}")
         self.timings = timings
-        super().__init__({
-            "rowbuf_wr": Out(memWriterSig(addrbits = range(self.timings.cols * 32), databits = 8)),
+        self.pools = pools
+        self.cached = cache
+        self.rowbuf_rows = rowbuf_rows
+        self.max_deadline = deadline
+        members = {
+            "rowbuf_wr": Out(memWriterSig(addrbits = range(self.timings.cols * 16 * rowbuf_rows),
+                                          databits = 8)),
             "gbuf_rd": Out(Signature({
                 "row": Out(range(self.timings.rows)),
                 "col": Out(range(self.timings.cols)),
@@ -22,12 +56,50 @@ class RowFiller(Component):
                 "data": In(16),
             })),
             "start_fill": In(1),
+            "busy": Out(1),
             "char_row": In(range(self.timings.rows)),
             "flash": Out(arbClientSig(flashReaderSig())),
-        })
- 
+        }
+        if deadline is not None:
+            members["deadline"] = In(range(deadline + 1))
+            members["slack"] = Out(range(deadline + 1))
+            members["deadline_misses"] = Out(32)
+        if cache:
+            members["cache"] = Out(glyphCacheSig())
+        super().__init__(members)
+        # the text row being filled, char_row as of start_fill
+        self._row = Signal(range(self.timings.rows))
+
     def gen_addr(self, *, row, col):
-        return (((self.char_row[0] << 4) + row) * self.timings.cols + col)
+        slot = self._row[:(self.rowbuf_rows - 1).bit_length()]
+        return (((slot << 4) + row) * self.timings.cols + col)
+
+    def write_at(self, m, charctr, *, row, right=0):
+        """Point the row buffer write at a row of the current char, or its
+        right half, and the cache write at the same place in its line."""
+        m.d.comb += self.rowbuf_wr.addr.eq(self.gen_addr(col=charctr + right, row=row))
+        if self.cached:
+            m.d.comb += self.cache.wr_offset.eq(Cat(right, row))
+
+    def fetch_state(self):
+        """The state that reads the glyph of the current char from flash."""
+        return "REQUEST_READ" if self.pools is None else "LOOKUP"
+
+    def glyph_state(self):
+        """The state to go to once the glyph id of the next char is read."""
+        return "PROBE" if self.cached else self.fetch_state()
+
+    def next_char(self, m, charctr, col):
+        """Go on to the char at col, letting go of the flash for now if
+        another client is waiting for it."""
+        m.d.sync += charctr.eq(col)
+        m.d.comb += self.gbuf_rd.en.eq(1)
+        m.d.comb += self.gbuf_rd.col.eq(col)
+        m.next = self.glyph_state()
+        with m.If(self.flash.contended):
+            m.d.sync += self.flash.request.eq(0)
+            if not self.cached:
+                m.next = "RELEASE"
 
     def elaborate(self, platform):
         m = Module()
@@ -40,24 +112,57 @@ class RowFiller(Component):
             self.flash.client.read_trigger.eq(0),
             self.rowbuf_wr.data.eq(self.flash.client.data),
             self.rowbuf_wr.en.eq(self.flash.client.valid),
-            chwidth.eq(self.gbuf_rd.data[15] != 0),
+            chwidth.eq(self.gbuf_rd.data[14:16] != 0),
             self.gbuf_rd.en.eq(0),
-            self.gbuf_rd.row.eq(self.char_row),
+            self.gbuf_rd.row.eq(self._row),
         ]
 
-        with m.FSM():
+        if self.max_deadline is not None:
+            # clocks until the row being filled is displayed
+            left = Signal(range(self.max_deadline + 1))
+            cols_left = Mux(self.busy, self.timings.cols - charctr, self.timings.cols)
+            work = Signal(range(self.timings.cols * COL_CLOCKS + 1))
+            m.d.comb += work.eq(cols_left * COL_CLOCKS)
+            m.d.comb += self.slack.eq(Mux(left > work, left - work, 0))
+            with m.If(~self.busy):
+                m.d.sync += left.eq(self.deadline)
+            with m.Elif(left != 0):
+                m.d.sync += left.eq(left - 1)
+                with m.If(left == 1):
+                    m.d.sync += self.deadline_misses.eq(self.deadline_misses + 1)
+
+        with m.FSM() as fsm:
+            m.d.comb += self.busy.eq(~fsm.ongoing("IDLE"))
             with m.State("IDLE"):
                 with m.If(self.start_fill):
+                    m.d.sync += self._row.eq(self.char_row)
                     m.d.sync += charctr.eq(0)
-                    m.d.sync += self.flash.request.eq(1)
+                    m.d.comb += self.gbuf_rd.row.eq(self.char_row)
                     m.d.comb += self.gbuf_rd.col.eq(0)
                     m.d.comb += self.gbuf_rd.en.eq(1)
-                    m.next = "WAIT_FLASH"
+                    if self.cached:
+                        m.next = "PROBE"
+                    else:
+                        m.d.sync += self.flash.request.eq(1)
+                        m.next = "WAIT_FLASH"
+
+            with m.State("RELEASE"):
+                # back in line for the flash, once the arbiter has seen it go
+                m.d.comb += self.gbuf_rd.en.eq(1)
+                m.d.comb += self.gbuf_rd.col.eq(charctr)
+                m.d.sync += self.flash.request.eq(1)
+                m.next = "WAIT_FLASH"
 
             with m.State("WAIT_FLASH"):
                 m.d.comb += self.gbuf_rd.en.eq(1)
+                m.d.comb += self.gbuf_rd.col.eq(charctr)
                 with m.If(self.flash.ok):
-                    m.next = "REQUEST_READ"
+                    m.next = self.fetch_state()
+
+            if self.pools is not None:
+                self.elaborate_compressed(m, charctr)
+            if self.cached:
+                self.elaborate_cached(m, charctr, chwidth)
 
             with m.State("REQUEST_READ"):
                 swaddr = flash_map.FONT1_OFFSET | ((self.gbuf_rd.data << 4) & FONT1_MASK)
@@ -72,22 +177,19 @@ class RowFiller(Component):
                     m.next = "COPY"
 
             with m.State("COPY"):
-                m.d.comb += self.rowbuf_wr.addr.eq(self.gen_addr(col=charctr, row=rowctr))
+                self.write_at(m, charctr, row=rowctr)
                 with m.If(self.flash.client.valid):
                     with m.If(rowctr == 15):
                         with m.If(charctr == self.timings.cols - 1):
                             m.d.sync += self.flash.request.eq(0)
                             m.next = "IDLE"
                         with m.Else():
-                            m.d.sync += charctr.eq(charctr + 1)
-                            m.d.comb += self.gbuf_rd.en.eq(1)
-                            m.d.comb += self.gbuf_rd.col.eq(charctr + 1)
-                            m.next = "REQUEST_READ"
+                            self.next_char(m, charctr, charctr + 1)
                     with m.Else():
                         m.d.sync += rowctr.eq(rowctr + 1)
 
             with m.State("COPYW1"):
-                m.d.comb += self.rowbuf_wr.addr.eq(self.gen_addr(col=charctr, row=rowctr))
+                self.write_at(m, charctr, row=rowctr)
                 with m.If(self.flash.client.valid):
                     with m.If((rowctr == 15) & (charctr == self.timings.cols - 1)):
                         m.d.sync += self.flash.request.eq(0)
@@ -98,20 +200,403 @@ class RowFiller(Component):
                         m.next = "COPYW2"
 
             with m.State("COPYW2"):
-                m.d.comb += self.rowbuf_wr.addr.eq(self.gen_addr(col=charctr + 1, row=rowctr))
+                self.write_at(m, charctr, row=rowctr, right=1)
                 with m.If(self.flash.client.valid):
                     with m.If(rowctr == 15):
                         with m.If(charctr == self.timings.cols - 2):
                             m.d.sync += self.flash.request.eq(0)
                             m.next = "IDLE"
                         with m.Else():
-                            m.d.sync += charctr.eq(charctr + 2)
-                            m.d.comb += self.gbuf_rd.en.eq(1)
-                            m.d.comb += self.gbuf_rd.col.eq(charctr + 2)
-                            m.next = "REQUEST_READ"
+                            self.next_char(m, charctr, charctr + 2)
                     with m.Else():
                         m.d.sync += rowctr.eq(rowctr + 1)
                         m.next = "COPYW1"
 
+        if self.cached:
+            m.d.comb += [
+                self.cache.wr_data.eq(self.rowbuf_wr.data),
+                self.cache.wr_en.eq(self.rowbuf_wr.en),
+            ]
+
         return m
 
+    def elaborate_cached(self, m, charctr, chwidth):
+        """States for looking glyphs up in the cache. A hit is copied from
+        the cache line to the row buffer, a clock behind the cache reads. A
+        miss is read from flash as usual, and written to the line allocated
+        for it as it goes to the row buffer, except for a double-wide in the
+        last column, which is cut off."""
+        cols = self.timings.cols
+        last_col = charctr == cols - 1
+        copyctr = Signal(5)
+        pending = Signal()
+        pending_row = Signal(4)
+        pending_right = Signal()
+
+        with m.State("PROBE"):
+            m.d.comb += self.cache.glyphid.eq(self.gbuf_rd.data)
+            m.d.comb += self.cache.probe.eq(1)
+            m.next = "CHECK"
+
+        with m.State("CHECK"):
+            m.d.sync += copyctr.eq(0)
+            m.d.sync += pending.eq(0)
+            with m.If(self.cache.hit):
+                m.next = "HIT"
+            with m.Else():
+                m.d.comb += self.cache.allocate.eq(~(chwidth & last_col))
+                m.d.sync += self.flash.request.eq(1)
+                # the flash stays granted from a previous miss in the row
+                with m.If(self.flash.ok):
+                    m.next = self.fetch_state()
+                with m.Else():
+                    m.next = "WAIT_MISS"
+
+        with m.State("WAIT_MISS"):
+            with m.If(self.flash.ok):
+                m.next = self.fetch_state()
+
+        # the rows of a single-wide are at the even offsets of its line
+        halfrow = Mux(chwidth, copyctr, Cat(0, copyctr[0:4]))
+        m.d.comb += self.cache.rd_offset.eq(halfrow)
+        def write_pending():
+            m.d.comb += [
+                self.rowbuf_wr.addr.eq(self.gen_addr(col=charctr + pending_right,
+                                                     row=pending_row)),
+                self.rowbuf_wr.data.eq(self.cache.rd_data),
+                self.rowbuf_wr.en.eq(pending & ~(pending_right & last_col)),
+            ]
+
+        with m.State("HIT"):
+            write_pending()
+            m.d.sync += [
+                pending.eq(1),
+                pending_row.eq(halfrow[1:5]),
+                pending_right.eq(halfrow[0]),
+                copyctr.eq(copyctr + 1),
+            ]
+            with m.If(copyctr == Mux(chwidth, 31, 15)):
+                m.next = "HIT_LAST"
+
+        with m.State("HIT_LAST"):
+            write_pending()
+            with m.If(charctr + chwidth >= cols - 1):
+                m.d.sync += self.flash.request.eq(0)
+                m.next = "IDLE"
+            with m.Else():
+                self.next_char(m, charctr, charctr + 1 + chwidth)
+
+    def elaborate_compressed(self, m, charctr):
+        """States for filling from compressed fonts. Each glyph is found
+        through its pool, then expanded: each byte from flash goes to the next
+        row set in the glyph's mask, and the rows not set are written as
+        zeros in the clocks between flash bytes."""
+        glyph_rel = Signal(16)
+        glyph_stride = Signal(range(34))
+        glyph_rows = Signal(range(17))
+        glyph_addr = Signal(24)
+        wide = Signal()
+        mask_lo = Signal(8)
+        cols = self.timings.cols
+
+        # Rows still to be written, from flash and as zeros. A double-wide
+        # has 32 half-rows, the left and right half of each row in turn.
+        stored = Signal(32)
+        blank = Signal(32)
+        m.submodules.stored_enc = stored_enc = PriorityEncoder(32)
+        m.submodules.blank_enc = blank_enc = PriorityEncoder(32)
+        m.d.comb += stored_enc.i.eq(stored)
+        m.d.comb += blank_enc.i.eq(blank)
+        def start_expand(mask):
+            halves = Cat(*(bit for i in range(16) for bit in (mask[i], mask[i])))
+            m.d.sync += [
+                stored.eq(Mux(wide, halves, mask)),
+                blank.eq(Mux(wide, ~halves, ~mask & 0xffff)),
+            ]
+            m.next = "EXPAND"
+
+        with m.State("LOOKUP"):
+            glyphid = self.gbuf_rd.data
+            # the pools are sorted by first glyph, so the last match wins
+            for first, rows, stride, addr in self.pools:
+                with m.If(glyphid >= first):
+                    m.d.sync += [
+                        glyph_rel.eq(glyphid - first),
+                        glyph_rows.eq(rows),
+                        glyph_stride.eq(stride),
+                        glyph_addr.eq(addr),
+                        wide.eq(first >= 16384),
+                    ]
+            m.next = "FETCH"
+
+        with m.State("FETCH"):
+            m.d.comb += self.flash.client.addr.eq(glyph_addr + glyph_rel * glyph_stride)
+            m.d.comb += self.flash.client.read_size.eq(glyph_stride)
+            with m.If(glyph_rows == 0):
+                # blank glyphs aren't stored at all
+                start_expand(Const(0, 16))
+            with m.Elif(glyph_rows == 16):
+                # and full ones are stored without a mask
+                m.d.comb += self.flash.client.read_trigger.eq(1)
+                start_expand(Const(0xffff, 16))
+            with m.Else():
+                m.d.comb += self.flash.client.read_trigger.eq(1)
+                m.next = "MASK0"
+
+        with m.State("MASK0"):
+            m.d.comb += self.rowbuf_wr.en.eq(0)
+            with m.If(self.flash.client.valid):
+                m.d.sync += mask_lo.eq(self.flash.client.data)
+                m.next = "MASK1"
+
+        with m.State("MASK1"):
+            m.d.comb += self.rowbuf_wr.en.eq(0)
+            with m.If(self.flash.client.valid):
+                start_expand(Cat(mask_lo, self.flash.client.data))
+
+        with m.State("EXPAND"):
+            from_flash = self.flash.client.valid
+            halfrow = Mux(from_flash, stored_enc.o, blank_enc.o)
+            row = Mux(wide, halfrow[1:5], halfrow[0:4])
+            right = wide & halfrow[0]
+            remaining = stored | blank
+            write = from_flash | ~blank_enc.n
+            with m.If(from_flash):
+                m.d.sync += stored.bit_select(stored_enc.o, 1).eq(0)
+            with m.Elif(~blank_enc.n):
+                m.d.sync += blank.bit_select(blank_enc.o, 1).eq(0)
+            self.write_at(m, charctr, row=row, right=right)
+            m.d.comb += [
+                self.rowbuf_wr.data.eq(Mux(from_flash, self.flash.client.data, 0)),
+                # the right half of a double-wide in the last column is dropped
+                self.rowbuf_wr.en.eq(write &
+                                     ~(right & (charctr == cols - 1))),
+            ]
+            # done once the last remaining row is being written
+            with m.If(write & ((remaining & (remaining - 1)) == 0)):
+                with m.If(charctr + wide >= cols - 1):
+                    m.d.sync += self.flash.request.eq(0)
+                    m.next = "IDLE"
+                with m.Else():
+                    self.next_char(m, charctr, charctr + 1 + wide)
+
+if __name__ == "__main__":
+    import itertools, sys
+    from amaranth.sim import *
+    from charmap import CHARMAP_PAGES_OFFSET
+    from flasharb import FlashArbiter
+    from glyphcache import GlyphCache
+    from flashreader import spiflash_model
+    from vgatimings import TIMINGS
+
+    # Fill a row from the fonts built by font/build_font.py, and check what
+    # lands in the row buffer against the glyphs decoded in Python.
+    variant = sys.argv[1] if len(sys.argv) > 1 else "full"
+    font1 = open(f"../font/build/font1-{variant}.bin", "rb").read()
+    font2 = open(f"../font/build/font2-{variant}.bin", "rb").read()
+    charmap_bin = open(f"../font/build/charmap-{variant}.bin", "rb").read()
+    # the charmap too, for the runs with a CharMap using the flash as well
+    blobs = [(flash_map.FONT1_OFFSET, font1), (flash_map.FONT2_OFFSET, font2),
+             (flash_map.CHARMAP_OFFSET, charmap_bin)]
+    base = min(offset for offset, blob in blobs)
+    image = bytearray(b"\xff") * (max(offset + len(blob) for offset, blob in blobs) - base)
+    for offset, blob in blobs:
+        image[offset - base:offset - base + len(blob)] = blob
+
+    def lookup(cp):
+        page = int.from_bytes(charmap_bin[(cp >> 8) * 2:(cp >> 8) * 2 + 2], "little")
+        entry = CHARMAP_PAGES_OFFSET + page * 512 + (cp & 0xff) * 2
+        return int.from_bytes(charmap_bin[entry:entry + 2], "little")
+
+    def glyph(glyphid):
+        """The rows of a glyph, as pairs of bytes for double-wides."""
+        if FONT_POOLS is None:
+            if glyphid >= 16384:
+                addr = flash_map.FONT2_OFFSET | (((glyphid & 0x3fff) << 5) & FONT2_MASK)
+                return [image[addr - base + i * 2:][:2] for i in range(16)]
+            addr = flash_map.FONT1_OFFSET | ((glyphid << 4) & FONT1_MASK)
+            return [image[addr - base + i:][:1] for i in range(16)]
+        first, nrows, stride, addr = [p for p in FONT_POOLS if glyphid >= p[0]][-1]
+        width = 2 if first >= 16384 else 1
+        data = image[addr - base + (glyphid - first) * stride:][:stride]
+        if nrows == 0:
+            mask = 0
+        elif nrows == 16:
+            mask = 0xffff
+        else:
+            mask = int.from_bytes(data[:2], "little")
+            data = data[2:]
+        rows = []
+        for i in range(16):
+            if mask & (1 << i):
+                rows.append(data[:width])
+                data = data[width:]
+            else:
+                rows.append(bytes(width))
+        return rows
+
+    timings = TIMINGS["640x480"]
+    cols = timings.cols
+    # digits have consecutive glyph ids, so their reads follow on from each other
+    text = "Hello, wörld! Ελληνικά Кириллица ┌─┐ 漢字かな 한국어 ⚠ €½ 0123456789 "
+    ids = []
+    for ch in text:
+        glyphid = lookup(ord(ch))
+        ids.append(glyphid)
+        if glyphid >= 16384:
+            ids.append(0)
+    ids = (ids * cols)[:cols]
+    expected = bytearray(cols * 16)
+    col = 0
+    while col < cols:
+        for row, data in enumerate(glyph(ids[col])):
+            data = data[:cols - col]
+            expected[row * cols + col:row * cols + col + len(data)] = data
+        col += 2 if ids[col] >= 16384 else 1
+
+    def add_memories(m, dut):
+        """The glyph buffer row and the row buffer, returning the latter."""
+        gbuf = Memory(width=16, depth=cols, init=ids)
+        m.submodules.gbuf_rd = gbuf_rd = gbuf.read_port()
+        rowbuf = Memory(width=8, depth=cols * 32)
+        m.submodules.rowbuf_wr = rowbuf_wr = rowbuf.write_port()
+        m.d.comb += [
+            gbuf_rd.addr.eq(dut.gbuf_rd.col),
+            gbuf_rd.en.eq(dut.gbuf_rd.en),
+            dut.gbuf_rd.data.eq(gbuf_rd.data),
+            rowbuf_wr.addr.eq(dut.rowbuf_wr.addr),
+            rowbuf_wr.data.eq(dut.rowbuf_wr.data),
+            rowbuf_wr.en.eq(dut.rowbuf_wr.en),
+        ]
+        return rowbuf
+
+    def fill(dut, rowbuf):
+        """Fill the row, check it and return how many clocks it took."""
+        yield dut.char_row.eq(0)
+        yield dut.start_fill.eq(1)
+        yield Tick()
+        yield dut.start_fill.eq(0)
+        clocks = 1
+        yield Tick()
+        while (yield dut.busy):
+            yield Tick()
+            clocks += 1
+            assert clocks < 100000, "fill didn't finish"
+        got = bytearray()
+        for i in range(cols * 16):
+            got.append((yield rowbuf[i]))
+            # clear it so the next fill is checked too
+            yield rowbuf[i].eq(0x55)
+        for i in range(cols * 16):
+            assert got[i] == expected[i], \
+                f"row {i // cols} col {i % cols}: got {got[i]:#04x}, expected {expected[i]:#04x}"
+        return clocks
+
+    def simulate(cache, xip):
+        m = Module()
+        m.submodules.dut = dut = RowFiller(timings, cache=cache)
+        m.submodules.arb = arb = FlashArbiter(dut.flash, xip=xip)
+        if cache:
+            m.submodules.cache = glyphcache = GlyphCache()
+            connect(m, dut.cache, glyphcache.client)
+        rowbuf = add_memories(m, dut)
+
+        sim = Simulator(m)
+        sim.add_clock(1e-6)
+        fmt = "raw" if FONT_POOLS is None else "compressed"
+        how = " with continuous reads" if xip else ""
+        def proc():
+            if not cache:
+                fill_clocks[cache, xip] = yield from fill(dut, rowbuf)
+                print(f"filled {cols} columns from {fmt} fonts{how} in {fill_clocks[cache, xip]} clocks")
+                return
+            for run in ("cold", "warm"):
+                fill_clocks[cache, xip] = yield from fill(dut, rowbuf)
+                hits = yield glyphcache.hits
+                misses = yield glyphcache.misses
+                print(f"filled {cols} columns from {fmt} fonts{how} with a {run} cache in "
+                      f"{fill_clocks[cache, xip]} clocks, {hits} hits and {misses} misses so far")
+
+        sim.add_sync_process(proc)
+        sim.add_sync_process(spiflash_model(arb._flashmod.sim_pins, image, base=base))
+        with sim.write_vcd(f"waves/rowfiller{'_cached' * cache}{'_xip' * xip}.vcd"):
+            sim.run()
+
+    def contend(aware):
+        """Fill the row twice, with a CharMap without a cache looking
+        codepoints up back to back, as under sustained input, and the
+        arbiter deadline-aware or not."""
+        from charmap import CharMap, LOOKUP_CLOCKS
+        m = Module()
+        # a row filled one row ahead of the display
+        deadline = 16 * timings.htotal
+        m.submodules.dut = dut = RowFiller(timings, cache=True, deadline=deadline)
+        m.d.comb += dut.deadline.eq(deadline)
+        m.submodules.cache = glyphcache = GlyphCache()
+        connect(m, dut.cache, glyphcache.client)
+        m.submodules.chmap = chmap = CharMap(cache_size=0, identity=0)
+        m.submodules.arb = arb = FlashArbiter(dut.flash, chmap.flash, xip=True,
+                                              slack=dut.slack if aware else None,
+                                              lease=LOOKUP_CLOCKS)
+        rowbuf = add_memories(m, dut)
+
+        sim = Simulator(m)
+        sim.add_clock(1e-6)
+        stats = {"lookups": 0, "hold": 0, "longest hold": 0, "min slack": deadline}
+        def filler():
+            clocks = []
+            for run in ("cold", "warm"):
+                clocks.append((yield from fill(dut, rowbuf)))
+            stats["fill clocks"] = clocks
+            stats["waits"] = []
+            for waits in arb.wait_cycles:
+                stats["waits"].append((yield waits))
+            stats["deadline misses"] = yield dut.deadline_misses
+        def lookups():
+            for cp in itertools.cycle(map(ord, text)):
+                if "fill clocks" in stats:
+                    return
+                yield chmap.ctrl.codepoint.eq(cp)
+                yield chmap.ctrl.en.eq(1)
+                yield Tick()
+                yield chmap.ctrl.en.eq(0)
+                while not (yield chmap.ctrl.valid):
+                    yield Tick()
+                assert (yield chmap.ctrl.glyphid) == lookup(cp)
+                stats["lookups"] += 1
+                yield Tick()
+        def monitor():
+            yield Passive()
+            while True:
+                if (yield chmap.flash.ok):
+                    stats["hold"] += 1
+                    stats["longest hold"] = max(stats["longest hold"], stats["hold"])
+                else:
+                    stats["hold"] = 0
+                if (yield dut.busy):
+                    stats["min slack"] = min(stats["min slack"], (yield dut.slack))
+                yield Tick()
+
+        sim.add_sync_process(filler)
+        sim.add_sync_process(lookups)
+        sim.add_sync_process(monitor)
+        sim.add_sync_process(spiflash_model(arb._flashmod.sim_pins, image, base=base))
+        with sim.write_vcd(f"waves/rowfiller_contend{'_aware' * aware}.vcd"):
+            sim.run()
+        how = "deadline-aware" if aware else "fixed priority"
+        print(f"{how}: filled in {stats['fill clocks'][0]} and {stats['fill clocks'][1]} clocks "
+              f"with {stats['lookups']} lookups meanwhile, waiting {stats['waits'][0]} and "
+              f"{stats['waits'][1]} clocks for the flash, lookups holding it for up to "
+              f"{stats['longest hold']} clocks, minimum slack {stats['min slack']}, "
+              f"{stats['deadline misses']} deadline misses")
+        assert stats["longest hold"] <= LOOKUP_CLOCKS
+        assert stats["deadline misses"] == 0
+
+    fill_clocks = {}
+    for cache in (False, True):
+        for xip in (False, True):
+            simulate(cache, xip)
+        print(f"continuous reads save {fill_clocks[cache, False] - fill_clocks[cache, True]} clocks "
+              f"per fill{' with a warm cache' * cache}")
+    for aware in (False, True):
+        contend(aware)
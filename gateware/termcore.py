@@ -1,17 +1,34 @@
 from amaranth import *
 from amaranth.lib.wiring import *
+from amaranth.lib.fifo import SyncFIFO
 from cursor import cursorControlsSig, CursorShape
 from signatures import *
 
+CR = 0x0d
+LF = 0x0a
+
 class TerminalCore(Component):
     """
     The core processing engine of the terminal, responsible for actually putting things
     into the glyphbuffer. Starts in the appropriately named "RESET" state to clear the contents
     of the glyphbuffer.
+
+    It is a pipeline of two stages: the charmap lookup of a character, and writing its glyph
+    to the glyphbuffer, with a FIFO of skid_depth glyph ids between them, so that the next
+    character is looked up while the last is being written. With skid_depth 0, a character
+    is only taken once the previous one is written, one at a time. Control characters skip
+    the charmap and go through the FIFO as they are; CR and LF are handled, the others are
+    dropped.
+
+    A line feed at the bottom of the scroll region, or writing past the end of that row,
+    scrolls the region up through the glyph buffer's scroll port and clears its bottom row.
+    The region is the whole screen after reset, and can be set through the region port,
+    as DECSTBM would.
     """
-    def __init__(self, timings):
+    def __init__(self, timings, *, skid_depth=2):
         self.rows = timings.rows
         self.cols = timings.cols
+        self.skid_depth = skid_depth
         super().__init__({
             "gbuf_write": Out(Signature({
                 "row": Out(range(self.rows)),
@@ -20,7 +37,17 @@ class TerminalCore(Component):
                 "data": Out(16),
                 "ack": In(1),
             })),
-            "scroll_offset": Out(range(self.rows)),
+            "scroll": Out(Signature({
+                "top": Out(range(self.rows)),
+                "bottom": Out(range(self.rows)),
+                "up": Out(1),
+                "down": Out(1),
+            })),
+            "region": In(Signature({
+                "top": Out(range(self.rows)),
+                "bottom": Out(range(self.rows)),
+                "en": Out(1),
+            })),
             "serial_in": In(streamSig(21)),
             "cursor": Out(cursorControlsSig(rows=self.rows, cols=self.cols)),
             "charmap": In(Signature({
@@ -40,33 +67,93 @@ class TerminalCore(Component):
 
         m.d.comb += self.gbuf_write.row.eq(self.cursor.row)
         m.d.comb += self.gbuf_write.col.eq(self.cursor.col)
-        m.d.comb += self.gbuf_write.data.eq(self.charmap.glyphid)
 
-        glyphid = Signal(16)
-        with m.FSM(reset="RESET"):
+        top = Signal(range(self.rows))
+        bottom = Signal(range(self.rows), reset=self.rows - 1)
+        with m.If(self.region.en & (self.region.top < self.region.bottom)):
+            m.d.sync += top.eq(self.region.top)
+            m.d.sync += bottom.eq(self.region.bottom)
+        m.d.comb += self.scroll.top.eq(top)
+        m.d.comb += self.scroll.bottom.eq(bottom)
+
+        # glyph ids, or control characters with the top bit set
+        m.submodules.skid = skid = SyncFIFO(width=17, depth=max(self.skid_depth, 1))
+        is_control = skid.r_data[16]
+        m.d.comb += [
+            skid.w_data.eq(self.charmap.glyphid),
+            skid.w_en.eq(self.charmap.valid),
+            self.gbuf_write.data.eq(skid.r_data[0:16]),
+        ]
+        # Only one lookup is in flight, and it's only started if there will be room for its
+        # glyph id, counting the one being pushed as the last lookup completes.
+        if self.skid_depth:
+            can_take = skid.w_rdy
+            can_take_next = skid.w_level < self.skid_depth - 1
+        else:
+            can_take = skid.w_level == 0
+            can_take_next = 0
+
+        control = self.serial_in.data < 0x20
+        def take(m, cond):
+            with m.If(self.serial_in.rdy & cond & ~control):
+                m.d.comb += self.serial_in.ack.eq(1)
+                m.d.comb += self.charmap.en.eq(1)
+                m.d.comb += self.charmap.codepoint.eq(self.serial_in.data)
+                m.next = "CHARMAP_WAIT"
+
+        with m.FSM(name="lookup"):
             with m.State("IDLE"):
-                with m.If(self.serial_in.rdy):
+                take(m, can_take)
+                # no lookup is in flight here to push its glyph id at the same time
+                with m.If(self.serial_in.rdy & can_take & control):
                     m.d.comb += self.serial_in.ack.eq(1)
-                    m.d.comb += self.charmap.en.eq(1)
-                    m.d.sync += self.charmap.codepoint.eq(self.serial_in.data)
-                    m.next = "CHARMAP_WAIT"
+                    m.d.comb += skid.w_data.eq(Cat(self.serial_in.data[0:16], 1))
+                    m.d.comb += skid.w_en.eq(1)
 
             with m.State("CHARMAP_WAIT"):
                 with m.If(self.charmap.valid):
-                    m.next = "PRINT"
+                    m.next = "IDLE"
+                    take(m, can_take_next)
+
+        clearctr = Signal(range(self.cols))
+        def newline(m):
+            """Move the cursor down a row, or at the bottom of the scroll region, scroll it
+            up and go on to clear its new bottom row."""
+            with m.If(self.cursor.row == bottom):
+                m.d.comb += self.scroll.up.eq(1)
+                m.next = "CLEAR"
+            with m.Elif(self.cursor.row != self.rows - 1):
+                m.d.sync += self.cursor.row.eq(self.cursor.row + 1)
 
+        with m.FSM(reset="RESET", name="write"):
             with m.State("PRINT"):
-                m.d.comb += self.gbuf_write.en.eq(1)
+                with m.If(is_control):
+                    with m.If(skid.r_rdy):
+                        m.d.comb += skid.r_en.eq(1)
+                        with m.If(skid.r_data[0:8] == CR):
+                            m.d.sync += self.cursor.col.eq(0)
+                        with m.Elif(skid.r_data[0:8] == LF):
+                            newline(m)
+                with m.Else():
+                    m.d.comb += self.gbuf_write.en.eq(skid.r_rdy)
                 with m.If(self.gbuf_write.ack):
+                    m.d.comb += skid.r_en.eq(1)
                     with m.If(self.cursor.col == self.cols - 1):
-                        with m.If(self.cursor.row == self.rows - 1):
-                            m.d.sync += self.cursor.row.eq(0)
-                        with m.Else():
-                            m.d.sync += self.cursor.row.eq(self.cursor.row + 1)
                         m.d.sync += self.cursor.col.eq(0)
+                        newline(m)
                     with m.Else():
                         m.d.sync += self.cursor.col.eq(self.cursor.col + 1)
-                    m.next = "IDLE"
+
+            with m.State("CLEAR"):
+                m.d.comb += self.gbuf_write.en.eq(1)
+                m.d.comb += self.gbuf_write.data.eq(0)
+                m.d.comb += self.gbuf_write.col.eq(clearctr)
+                with m.If(self.gbuf_write.ack):
+                    with m.If(clearctr == self.cols - 1):
+                        m.d.sync += clearctr.eq(0)
+                        m.next = "PRINT"
+                    with m.Else():
+                        m.d.sync += clearctr.eq(clearctr + 1)
 
             with m.State("RESET"):
                 m.d.comb += self.gbuf_write.en.eq(1)
@@ -76,7 +163,7 @@ class TerminalCore(Component):
                         with m.If(self.cursor.row == self.rows - 1):
                             m.d.sync += self.cursor.col.eq(0)
                             m.d.sync += self.cursor.row.eq(0)
-                            m.next = "IDLE"
+                            m.next = "PRINT"
                         with m.Else():
                             m.d.sync += self.cursor.col.eq(0)
                             m.d.sync += self.cursor.row.eq(self.cursor.row + 1)
@@ -86,3 +173,189 @@ class TerminalCore(Component):
 
         return m
 
+if __name__ == "__main__":
+    import sys
+    from amaranth.sim import *
+    from charmap import CharMap, CHARMAP_PAGES_OFFSET
+    from flasharb import FlashArbiter
+    from flashreader import spiflash_model
+    from glyphbuffer import GlyphBuffer
+    from vgatimings import TIMINGS
+    from build.flash_map import CHARMAP_OFFSET
+
+    # Print text through the charmap built by font/build_font.py, once one
+    # character at a time and once pipelined, and compare the throughput.
+    charmap_bin = open(sys.argv[1] if len(sys.argv) > 1 else
+                       "../font/build/charmap-full.bin", "rb").read()
+    def lookup(cp):
+        page = int.from_bytes(charmap_bin[(cp >> 8) * 2:(cp >> 8) * 2 + 2], "little")
+        entry = CHARMAP_PAGES_OFFSET + page * 512 + (cp & 0xff) * 2
+        return int.from_bytes(charmap_bin[entry:entry + 2], "little")
+
+    timings = TIMINGS["640x480"]
+    text = [ord(ch) for ch in "The quick brown fox jumps over the lazy dog. " * 8 +
+            "Съешь же ещё этих мягких французских булок. "]
+
+    def simulate(skid_depth):
+        m = Module()
+        m.submodules.dut = dut = TerminalCore(timings, skid_depth=skid_depth)
+        m.submodules.charmap = chmap = CharMap()
+        m.submodules.arb = arb = FlashArbiter(chmap.flash)
+        m.submodules.glyphbuf = glyphbuf = GlyphBuffer(timings)
+        connect(m, dut.gbuf_write, glyphbuf.write)
+        connect(m, dut.scroll, glyphbuf.scroll)
+        connect(m, chmap.ctrl, dut.charmap)
+
+        sim = Simulator(m)
+        sim.add_clock(1e-6)
+        def proc():
+            written = []
+            cleared = False
+            fed = clocks = 0
+            while len(written) < len(text):
+                yield Settle()
+                if cleared and not fed and not (yield dut.serial_in.rdy):
+                    # the glyph buffer is cleared, start printing
+                    yield dut.serial_in.data.eq(text[0])
+                    yield dut.serial_in.rdy.eq(1)
+                    yield Settle()
+                    clocks = 0
+                ack = yield dut.serial_in.ack
+                if (yield dut.gbuf_write.en) and (yield dut.gbuf_write.ack):
+                    cell = ((yield dut.gbuf_write.row), (yield dut.gbuf_write.col),
+                            (yield dut.gbuf_write.data))
+                    if cleared:
+                        written.append(cell)
+                    elif cell[:2] == (timings.rows - 1, timings.cols - 1):
+                        cleared = True
+                yield Tick()
+                clocks += 1
+                assert clocks < 100000, "printing didn't finish"
+                if ack:
+                    fed += 1
+                    if fed < len(text):
+                        yield dut.serial_in.data.eq(text[fed])
+                    else:
+                        yield dut.serial_in.rdy.eq(0)
+            for i, (cp, (row, col, glyphid)) in enumerate(zip(text, written)):
+                assert (row, col) == divmod(i, timings.cols), f"char {i} written at {row}, {col}"
+                assert glyphid == lookup(cp), \
+                    f"U+{cp:04X}: got {glyphid:#x}, expected {lookup(cp):#x}"
+            hits = yield chmap.hits
+            misses = yield chmap.misses
+            print(f"skid depth {skid_depth}: {len(text)} chars in {clocks} clocks, "
+                  f"{len(text) / clocks:.3f} chars/clock ({hits} charmap hits, {misses} misses)")
+
+        sim.add_sync_process(proc)
+        sim.add_sync_process(spiflash_model(arb._flashmod.sim_pins, charmap_bin,
+                                            base=CHARMAP_OFFSET))
+        with sim.write_vcd(f"waves/termcore{skid_depth}.vcd"):
+            sim.run()
+
+    simulate(0)
+    simulate(2)
+
+    def model(text, top, bottom):
+        """The glyph ids on screen after printing text, in Python."""
+        rows, cols = timings.rows, timings.cols
+        screen = [[0] * cols for i in range(rows)]
+        row = col = 0
+        def newline():
+            nonlocal row
+            if row == bottom:
+                screen[top:bottom + 1] = screen[top + 1:bottom + 1] + [[0] * cols]
+            elif row != rows - 1:
+                row += 1
+        for cp in text:
+            if cp == CR:
+                col = 0
+            elif cp == LF:
+                newline()
+            elif cp >= 0x20:
+                screen[row][col] = lookup(cp)
+                if col == cols - 1:
+                    col = 0
+                    newline()
+                else:
+                    col += 1
+        return screen
+
+    def simulate_scroll(name, text, top=0, bottom=timings.rows - 1):
+        """Print text with the scroll region set, check the screen against the
+        model and count the clocks."""
+        m = Module()
+        m.submodules.dut = dut = TerminalCore(timings)
+        m.submodules.charmap = chmap = CharMap()
+        m.submodules.arb = arb = FlashArbiter(chmap.flash)
+        m.submodules.glyphbuf = glyphbuf = GlyphBuffer(timings)
+        connect(m, dut.gbuf_write, glyphbuf.write)
+        connect(m, dut.scroll, glyphbuf.scroll)
+        connect(m, chmap.ctrl, dut.charmap)
+
+        sim = Simulator(m)
+        sim.add_clock(1e-6)
+        def proc():
+            yield dut.region.top.eq(top)
+            yield dut.region.bottom.eq(bottom)
+            yield dut.region.en.eq(1)
+            yield Tick()
+            yield dut.region.en.eq(0)
+            # wait for the glyph buffer to be cleared after reset
+            while not ((yield dut.gbuf_write.ack) and
+                       (yield dut.gbuf_write.row) == timings.rows - 1 and
+                       (yield dut.gbuf_write.col) == timings.cols - 1):
+                yield Tick()
+            yield Tick()
+            fed = clocks = last = scrolls = writes = 0
+            yield dut.serial_in.data.eq(text[0])
+            yield dut.serial_in.rdy.eq(1)
+            # until nothing has happened for a while after the last char
+            while fed < len(text) or clocks - last < 200:
+                yield Settle()
+                ack = yield dut.serial_in.ack
+                if (yield dut.gbuf_write.ack):
+                    writes += 1
+                    last = clocks
+                if (yield dut.scroll.up):
+                    scrolls += 1
+                    last = clocks
+                yield Tick()
+                clocks += 1
+                if ack:
+                    fed += 1
+                    last = clocks
+                    if fed < len(text):
+                        yield dut.serial_in.data.eq(text[fed])
+                    else:
+                        yield dut.serial_in.rdy.eq(0)
+            clocks = last
+            expected = model(text, top, bottom)
+            for row in range(timings.rows):
+                for col in range(timings.cols):
+                    yield glyphbuf.read.row.eq(row)
+                    yield glyphbuf.read.col.eq(col)
+                    yield glyphbuf.read.en.eq(1)
+                    yield Tick()
+                    yield Settle()
+                    got = yield glyphbuf.read.data
+                    assert got == expected[row][col], \
+                        f"{row}, {col}: got {got:#x}, expected {expected[row][col]:#x}"
+            lines = text.count(LF)
+            print(f"{name}: {lines} lines in {clocks} clocks, {clocks / lines:.0f} clocks and "
+                  f"{writes / lines:.0f} glyph buffer writes per line, with {scrolls} scrolls")
+
+        sim.add_sync_process(proc)
+        sim.add_sync_process(spiflash_model(arb._flashmod.sim_pins, charmap_bin,
+                                            base=CHARMAP_OFFSET))
+        sim.run()
+
+    # `yes`, which scrolls on every line once the screen is full. Copying the
+    # rows up instead would take a read and a write of every cell per line.
+    lines = 100
+    simulate_scroll("yes", [ord(ch) for ch in "y\r\n" * lines])
+    print(f"scrolling by copying would take {timings.rows * timings.cols} reads and as many "
+          f"writes per line")
+    # lines long enough to wrap, in a scroll region in the middle of the screen
+    text = "".join(f"line {i}: " + "abcdefghijklmnopqrstuvwxyz" * (i % 5) + "\r\n"
+                   for i in range(40))
+    simulate_scroll("scroll region 5 to 10", [ord(ch) for ch in text], top=5, bottom=10)
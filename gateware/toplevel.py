@@ -1,15 +1,35 @@
 from amaranth import *
 from amaranth.lib.wiring import *
 from amaranth.lib.fifo import SyncFIFO
-import bufserial, charmap, flasharb, glyphbuffer, icepll, rowbuftest, rowfiller, videoout, utf8
+import bufserial, charmap, fillsched, flasharb, framebuffer, glyphbuffer, glyphcache, icepll
+import rowbuftest, rowfiller, videoout, utf8
 from flashreader import *
 from termcore import *
 
 class Toplevel(Elaboratable):
     """ The top level of the terminal, everything goes under here. """
-    def __init__(self, pdata, timings):
+    def __init__(self, pdata, timings, *, rowbuf_rows=2, fill_ahead=1, framebuffer=False,
+                 xip=False, qpi=False):
         self.timings = timings
         self.pdata = pdata
+        # text rows in the row buffer, and how far ahead of the display they
+        # are filled. More rows cost block RAM, but absorb slow fills.
+        self.rowbuf_rows = rowbuf_rows
+        self.fill_ahead = fill_ahead
+        # render into a framebuffer in SPRAM instead, only the rows that change
+        self.framebuffer = framebuffer
+        # Leave the flash in continuous read mode between reads, see
+        # FlashReader. Nothing takes it out of that mode again, so if the
+        # FPGA is reconfigured without power cycling the flash, by CRESET or
+        # a warm boot, the flash ignores the read command of the
+        # configuration load, and the FPGA doesn't come up.
+        self.xip = xip
+        # Put the flash in QPI mode, for shorter read commands, see
+        # FlashReader. It stays in QPI mode until it's power cycled, so if
+        # the FPGA is reconfigured by CRESET or a warm boot, the flash
+        # doesn't understand the configuration load's SPI read command, and
+        # the FPGA doesn't come up either.
+        self.qpi = qpi
 
     def elaborate(self, platform):
         m = Module()
@@ -18,33 +38,48 @@ class Toplevel(Elaboratable):
         m.submodules.pll = icepll.ICEPLL(f_in, self.timings.pclk * 1e6,
                                       self.pdata.clkresource)
 
-        m.submodules.videoout = out = videoout.VideoOut(self.timings)
+        m.submodules.videoout = out = videoout.VideoOut(self.timings,
+                                                        rowbuf_rows=self.rowbuf_rows,
+                                                        ahead=self.fill_ahead,
+                                                        framebuffer=self.framebuffer)
 
-        rowbuf = Memory(width = 8,
-                        depth = self.timings.cols * 16 * 2,
-                        init = rowbuftest.gen_testpattern(self.timings.cols))
-        m.submodules.rowbuf_read = rowbuf_read = rowbuf.read_port(transparent = False)
-        m.submodules.rowbuf_write = rowbuf_write = rowbuf.write_port()
+        if self.framebuffer:
+            m.submodules.framebuf = framebuf = framebuffer.FrameBuffer(self.timings)
+            rowbuf_read, rowbuf_write = framebuf.read, framebuf.write
+        else:
+            rowbuf = Memory(width = 8,
+                            depth = self.timings.cols * 16 * self.rowbuf_rows,
+                            init = rowbuftest.gen_testpattern(self.timings.cols))
+            m.submodules.rowbuf_read = rowbuf_read = rowbuf.read_port(transparent = False)
+            m.submodules.rowbuf_write = rowbuf_write = rowbuf.write_port()
         m.d.comb += [
             rowbuf_read.addr.eq(out.rowbuf_addr),
             rowbuf_read.en.eq(out.rowbuf_en),
             out.rowbuf_data.eq(rowbuf_read.data),
         ]
 
-        m.submodules.rowfiller = rowfill = rowfiller.RowFiller(self.timings)
-        row_to_fill = Signal(range(self.timings.rows))
+        # a framebuffer is filled as rows change, with no deadline to meet
+        deadline = None if self.framebuffer else fillsched.fill_deadline(self.timings,
+                                                                        self.fill_ahead)
+        m.submodules.rowfiller = rowfill = rowfiller.RowFiller(self.timings, cache=True,
+                                                               deadline=deadline,
+                                                               rowbuf_rows=out.rowbuf_rows)
+        m.submodules.glyphcache = gcache = glyphcache.GlyphCache()
+        connect(m, rowfill.cache, gcache.client)
 
         m.submodules.glyphbuf = glyphbuf = glyphbuffer.GlyphBuffer(self.timings)
         connect(m, glyphbuf.read, rowfill.gbuf_rd)
 
-        m.d.sync += [
-            row_to_fill.eq((out.pos.vctr >> 4) + 1),
-        ]
+        if self.framebuffer:
+            m.submodules.dirtyrows = dirtyrows = fillsched.DirtyRows(self.timings)
+            fill = dirtyrows.fill
+        else:
+            fill = out.fill
+            m.d.comb += rowfill.deadline.eq(fill.deadline)
         m.d.comb += [
-            rowfill.char_row.eq(row_to_fill),
-            rowfill.start_fill.eq((row_to_fill >= 0) &
-                                  (out.pos.vctr[0:4] == 0) &
-                                  (out.pos.hctr == 0)),
+            rowfill.char_row.eq(fill.row),
+            rowfill.start_fill.eq(fill.start),
+            fill.busy.eq(rowfill.busy),
             rowbuf_write.addr.eq(rowfill.rowbuf_wr.addr),
             rowbuf_write.data.eq(rowfill.rowbuf_wr.data),
             rowbuf_write.en.eq(rowfill.rowbuf_wr.en),
@@ -60,9 +95,25 @@ class Toplevel(Elaboratable):
 
         connect(m, utf8decode.out, terminalcore.serial_in)
         connect(m, terminalcore.gbuf_write, glyphbuf.write)
+        connect(m, terminalcore.scroll, glyphbuf.scroll)
         connect(m, chmap.ctrl, terminalcore.charmap)
         connect(m, out.cursor, terminalcore.cursor)
 
-        m.submodules.flasharb = flasharb.FlashArbiter(rowfill.flash, chmap.flash)
+        if self.framebuffer:
+            # a row changes when one of its cells is written, and all of them
+            # on a scroll
+            m.d.comb += [
+                dirtyrows.mark.row.eq(terminalcore.gbuf_write.row),
+                dirtyrows.mark.en.eq(terminalcore.gbuf_write.en & terminalcore.gbuf_write.ack),
+                dirtyrows.mark_all.eq(terminalcore.scroll.up | terminalcore.scroll.down),
+            ]
+            # there is no deadline to meet, so lookups go first
+            m.submodules.flasharb = flasharb.FlashArbiter(chmap.flash, rowfill.flash,
+                                                          xip=self.xip, qpi=self.qpi)
+        else:
+            m.submodules.flasharb = flasharb.FlashArbiter(rowfill.flash, chmap.flash,
+                                                          xip=self.xip, qpi=self.qpi,
+                                                          slack=rowfill.slack,
+                                                          lease=charmap.LOOKUP_CLOCKS)
 
         return m
@@ -3,15 +3,27 @@ from amaranth.lib.wiring import *
 from signatures import *
 from cursor import *
 from vgasync import *
+from fillsched import *
+from framebuffer import framebuffer_rows
 from colorbuffer import BgFg, Color
 
 class VideoOut(Component):
-    def __init__(self, timings):
+    """The video output, from a row buffer of rowbuf_rows text rows, which
+    the fill port has filled ahead rows ahead of the display. See
+    FillScheduler, also for underrun and underruns.
+
+    With framebuffer set, the row buffer is a FrameBuffer holding every
+    row, which is filled as rows change rather than as they are displayed,
+    and there is no fill port."""
+    def __init__(self, timings, *, rowbuf_rows=2, ahead=1, framebuffer=False):
         self.timings = timings
-        super().__init__({
+        self.rowbuf_rows = framebuffer_rows(timings) if framebuffer else rowbuf_rows
+        self.ahead = ahead
+        self.framebuffer = framebuffer
+        members = {
             "pos": Out(videoPosSig(self.timings)),
             "cursor": In(cursorControlsSig(rows=self.timings.rows, cols=self.timings.cols)),
-            "rowbuf_addr": Out(range(self.timings.cols * 16 * 2)),
+            "rowbuf_addr": Out(range(self.timings.cols * 16 * self.rowbuf_rows)),
             "rowbuf_en": Out(1),
             "rowbuf_data": In(8),
             "cbuf": Out(Signature({
@@ -21,7 +33,13 @@ class VideoOut(Component):
                 "bgfg": In(BgFg),
                 "data": Out(Color)
             })),
-        })
+        }
+        if not framebuffer:
+            members["fill"] = Out(rowFillSig(self.timings,
+                                             deadline=fill_deadline(self.timings, ahead)))
+            members["underrun"] = Out(1)
+            members["underruns"] = Out(32)
+        super().__init__(members)
 
     def elaborate(self, platform):
         m = Module()
@@ -29,11 +47,23 @@ class VideoOut(Component):
         # Create the VGA sync module and wire up its outputs to the rowbuf addr/en
         m.submodules.vgasync = vgs = VGASync(self.timings)
         connect(m, flipped(self.pos), vgs.pos)
+        slotbits = (self.rowbuf_rows - 1).bit_length()
         m.d.comb += [
-            self.rowbuf_addr.eq(vgs.pos.vctr[0:5] * self.timings.cols + vgs.pos.hctr[3:]),
+            self.rowbuf_addr.eq(vgs.pos.vctr[0:4 + slotbits] * self.timings.cols + vgs.pos.hctr[3:]),
             self.rowbuf_en.eq(vgs.active),
         ]
 
+        if not self.framebuffer:
+            m.submodules.fillsched = fillsched = FillScheduler(
+                self.timings, rowbuf_rows=self.rowbuf_rows, ahead=self.ahead)
+            connect(m, flipped(self.fill), fillsched.fill)
+            m.d.comb += [
+                fillsched.pos.hctr.eq(vgs.pos.hctr),
+                fillsched.pos.vctr.eq(vgs.pos.vctr),
+                self.underrun.eq(fillsched.underrun),
+                self.underruns.eq(fillsched.underruns),
+            ]
+
         active1 = Signal()
         fetched_byte = Signal(7)
         fetched_bit = Signal()